@@ -0,0 +1,183 @@
+""" Benchmark of the evaluation harness itself, run end to end against the local Vectara emulator
+(vectara_emulator.py), so that its overhead can be measured and performance regressions caught release over release.
+
+Each phase of an evaluation is timed: fetching a token, creating a corpus, uploading a bundle's data, waiting for it
+to be searchable, running the queries, and scoring the queries again from the response cache (which is the harness's
+own scoring cost, with no requests). The throughput and time of each phase are printed and written to
+results/benchmark-<bundle>-<timestamp>.json, and can be compared with an earlier benchmark with --baseline.
+"""
+
+import argparse
+import contextlib
+import datetime
+import json
+import logging
+import os
+import platform
+import sys
+import tempfile
+import time
+
+#The emulator serves tokens over plain HTTP
+os.environ.setdefault("AUTHLIB_INSECURE_TRANSPORT", "1")
+
+import run_eval
+import vectara_emulator
+
+def _write_repeated_queries(queries_file: str, repeat: int, output_file: str):
+    """ Writes a queries file with the queries of another one repeated a number of times, renumbered so that every
+    query has its own number.
+
+    Returns:
+        Number of queries written
+    """
+    queries = run_eval._get_queries_list(queries_file)
+    num = 0
+    with open(output_file, "w") as f:
+        for _ in range(repeat):
+            for this_query in queries:
+                num += 1
+                matches = "|".join(f"{file_num}@{phrase}" for file_num, phrase in this_query.matches)
+                f.write(f"{num}|{this_query.query}|{matches}\n")
+    return num
+
+def _timed_phase(phases: {}, name: str, items: int, unit: str, run):
+    """ Runs one phase with the harness's output silenced, and records its time and throughput.
+
+    Returns:
+        The result of run()
+    """
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        start_time = time.perf_counter()
+        result = run()
+        seconds = time.perf_counter() - start_time
+    phases[name] = {"seconds": seconds, "items": items, "unit": unit, "per_second": items / max(seconds, 1e-9)}
+    print(f'{name:<12} {seconds:9.3f}s {items:>9g} {unit:<7} {items / max(seconds, 1e-9):12.1f} {unit}/s')
+    return result
+
+def run_benchmark(bundle: str, repeat: int = 1, upload_concurrency: int = 4, query_concurrency: int = 8,
+                  query_batch_size: int = 1, config: vectara_emulator.EmulatorConfig = None):
+    """ Runs all the phases of an evaluation of a bundle against a fresh emulator.
+
+    Args:
+        bundle: Which test bundle is used
+        repeat: Number of times the bundle's query set is repeated, to time a larger query set
+        upload_concurrency: Number of files uploaded at the same time
+        query_concurrency: Maximum number of query requests in flight at the same time
+        query_batch_size: Number of queries sent together in each query request
+        config: Settings of the emulator (latency, throttling and errors). Defaults to none of them.
+
+    Returns:
+        Dict with the settings and, for each phase, its time and throughput
+    """
+    server = vectara_emulator.start_emulator(config=config)
+    url = f"http://localhost:{server.server_port}"
+    customer_id = 1
+    data_dir = "bundles/" + bundle + "/data"
+    data_bytes = sum(os.path.getsize(os.path.join(subdir, file))
+                     for subdir, dirs, files in os.walk(data_dir) for file in files)
+    phases = {}
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        queries_file = os.path.join(tmp_dir, "queries.csv")
+        num_queries = _write_repeated_queries("bundles/" + bundle + "/queries.csv", repeat, queries_file)
+
+        print(f'{"phase":<12} {"time":>10} {"items":>9}')
+        token = run_eval.TokenProvider(url, "benchmark", "benchmark")
+        _timed_phase(phases, "auth", 1, "tokens", token.get)
+        _, _, corpus_id = _timed_phase(phases, "corpus", 1, "corpora",
+                                       lambda: run_eval.create_corpus(customer_id, url, token, bundle))
+        uploaded_at = {}
+        _timed_phase(phases, "upload", round(data_bytes / 1e6, 3), "MB",
+                     lambda: run_eval.upload_data(customer_id, corpus_id, url, data_dir, token, upload_concurrency,
+                                                  uploaded_at=uploaded_at))
+        _timed_phase(phases, "readiness", len(uploaded_at), "files",
+                     lambda: run_eval.wait_until_searchable(customer_id, corpus_id, url, token, queries_file,
+                                                            uploaded_at, min_delay_seconds=0.1))
+
+        cache = run_eval.ResponseCache(os.path.join(tmp_dir, "cache"))
+        metrics = _timed_phase(phases, "queries", num_queries, "queries",
+                               lambda: run_eval.run_queries(customer_id, corpus_id, url, token, queries_file,
+                                                            query_concurrency, batch_size=query_batch_size,
+                                                            cache=cache))
+        _timed_phase(phases, "scoring", num_queries, "queries",
+                     lambda: run_eval.run_queries(customer_id, corpus_id, url, None, queries_file,
+                                                  cache=cache, offline=True))
+        cache.close()
+        token.close()
+
+    server.shutdown()
+    return {
+        "bundle": bundle,
+        "settings": {"repeat": repeat, "upload_concurrency": upload_concurrency,
+                     "query_concurrency": query_concurrency, "query_batch_size": query_batch_size,
+                     "latency_ms": server.config.latency_ms, "jitter_ms": server.config.jitter_ms,
+                     "throttle_qps": server.config.throttle_qps, "error_rate": server.config.error_rate},
+        "python": platform.python_version(),
+        "phases": phases,
+        "file_match_mean_reciprocal_rank": metrics.get("file_match_mean_reciprocal_rank"),
+    }
+
+def compare_benchmarks(baseline: {}, current: {}, threshold: float):
+    """ Prints the change in time of each phase from a baseline benchmark.
+
+    Args:
+        baseline: Results of the earlier benchmark (see run_benchmark())
+        current: Results of this benchmark
+        threshold: Fraction by which a phase can get slower before it is reported as a regression
+
+    Returns:
+        List of the names of the phases that regressed
+    """
+    if (baseline["bundle"], baseline["settings"]) != (current["bundle"], current["settings"]):
+        logging.warning("The baseline was run with a different bundle or settings, so the times may not be comparable")
+    regressions = []
+    print(f'\n{"phase":<12} {"baseline":>10} {"current":>10} {"change":>8}')
+    for name, phase in current["phases"].items():
+        if name not in baseline["phases"]:
+            continue
+        before = baseline["phases"][name]["seconds"]
+        change = phase["seconds"] / max(before, 1e-9) - 1
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print(f'{name:<12} {before:9.3f}s {phase["seconds"]:9.3f}s {change:+8.1%}{"  REGRESSION" if regressed else ""}')
+    return regressions
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s", level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(description="Benchmark of the evaluation harness against a local emulator")
+    parser.add_argument("--bundle", default="app-search", help="Which test bundle to benchmark with.")
+    parser.add_argument("--repeat", type=int, default=100,
+                        help="Number of times the bundle's query set is repeated, to time a larger query set.")
+    parser.add_argument("--upload-concurrency", type=int, default=4,
+                        help="Number of files uploaded at the same time.")
+    parser.add_argument("--query-concurrency", type=int, default=8,
+                        help="Maximum number of query requests in flight at the same time.")
+    parser.add_argument("--query-batch-size", type=int, default=1,
+                        help="Number of queries sent together in each query request.")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Time the emulator takes to answer.")
+    parser.add_argument("--jitter-ms", type=float, default=0, help="Maximum random time added to the latency.")
+    parser.add_argument("--throttle-qps", type=float, help="Maximum number of requests the emulator accepts per second.")
+    parser.add_argument("--error-rate", type=float, default=0, help="Fraction of requests that fail with a 503.")
+    parser.add_argument("--baseline", help="Results file of an earlier benchmark to compare with.")
+    parser.add_argument("--regression-threshold", type=float, default=0.1,
+                        help="Fraction by which a phase can get slower than the baseline before it is a regression.")
+    args = parser.parse_args()
+
+    results = run_benchmark(args.bundle, args.repeat, args.upload_concurrency, args.query_concurrency,
+                            args.query_batch_size,
+                            vectara_emulator.EmulatorConfig(args.latency_ms, args.jitter_ms, args.throttle_qps,
+                                                            args.error_rate))
+    results_filename = "results/benchmark-" + args.bundle + "-" + \
+                       datetime.datetime.now().strftime("%m_%d_%Y_%H_%M_%S") + ".json"
+    with open(results_filename, "w") as text_file:
+        text_file.write(json.dumps(results))
+    print("Benchmark results written to " + results_filename)
+
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            if compare_benchmarks(json.load(baseline_file), results, args.regression_threshold):
+                sys.exit(1)
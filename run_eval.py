@@ -3,20 +3,474 @@ It calls the Vectara API via python using HTTP/REST as communication protocol.
 """
 
 import argparse
+import concurrent.futures
+import contextlib
 import logging
 import datetime
+import email.utils
+import fractions
+import gzip
+import hashlib
+import itertools
 import json
+import math
+import mmap
+import random
+import re
 import requests
+import sqlite3
 import os
+import queue
+import sys
+import threading
+import time
+import numpy as np
 from authlib.integrations.requests_client import OAuth2Session
 
-def _get_jwt_token(auth_url: str, app_client_id: str, app_client_secret: str):
-    """Connect to the server and get a JWT token."""
+#orjson is optional: it parses query responses several times faster than the json module when it is installed
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+#HTTP status codes that indicate a transient failure, so the request is worth retrying
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+#Number of results requested for each query when it isn't derived from the K values (see _get_result_depth())
+NUM_RESULTS = 100
+
+#Default cut-offs (K) for the metrics computed over the top K results
+DEFAULT_K_VALUES = (1, 3, 5, 10)
+
+#Runs of characters that the normalized phrase match modes treat as a single space
+NON_WORD_PATTERN = re.compile(r"[\W_]+")
+
+#Number of bytes at the start of a data file from which a phrase is taken to probe whether it is searchable
+PROBE_PREFIX_BYTES = 64 * 1024
+
+#Number of queries whose relevance rows are scored together when metrics are computed as the responses arrive
+METRICS_BLOCK_SIZE = 1024
+
+#Metrics of the original script (relevance @ K, percent first match in top K and mean reciprocal rank), whose means
+#are computed as it did, so that results files can be diffed against those of older runs
+LEGACY_METRIC_PATTERN = re.compile(r"_mean_r_at_\d+$|_percent_first_match_in_top_\d+$|_mean_reciprocal_rank$")
+
+#Default path of the run history database (see RunHistory)
+DEFAULT_HISTORY_PATH = ".cache/history.sqlite"
+
+#Command line settings that are recorded with each run in the run history
+HISTORY_CONFIG_KEYS = ("k_values", "num_results", "phrase_match", "fuzzy_threshold", "overlap_threshold",
+                       "query_batch_size", "query_concurrency", "max_qps", "shard", "offline", "cache_dir")
+
+#Levels of detail of the per-query trace (see TraceWriter)
+TRACE_LEVELS = ("query", "hits")
+
+#Layers of the relevance matrix (see compute_metrics())
+FILE_LAYER = 0
+FILE_AND_PHRASE_LAYER = 1
+
+class LatencyHistogram:
+    """ HDR-style latency histogram.
+
+    Values are counted in buckets whose width grows with the value: each power of two (in microseconds) is split
+    into 2^SUB_BUCKET_BITS buckets of equal width, so any percentile is accurate to within 1% while the memory
+    used is bounded by the range of the values rather than by how many there are. Histograms can be merged by
+    adding their counts.
+    """
+
+    SUB_BUCKET_BITS = 7
+
+    def __init__(self):
+        #Bucket lower bound (in microseconds) -> number of values in the bucket
+        self.counts = {}
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds: float):
+        """ Adds one value, in seconds. """
+        micros = max(int(seconds * 1e6), 0)
+        shift = max(micros.bit_length() - 1 - self.SUB_BUCKET_BITS, 0)
+        bucket = (micros >> shift) << shift
+        self.counts[bucket] = self.counts.get(bucket, 0) + 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def merge(self, other: "LatencyHistogram"):
+        """ Adds all the values of another histogram to this one. """
+        for bucket, count in other.counts.items():
+            self.counts[bucket] = self.counts.get(bucket, 0) + count
+        self.count += other.count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def percentile(self, percent: float):
+        """ Returns the value (in seconds) below which the given percentage of the values fall. """
+        if self.count == 0:
+            return 0.0
+        rank = percent / 100 * self.count
+        seen = 0
+        for bucket in sorted(self.counts):
+            seen += self.counts[bucket]
+            if seen >= rank:
+                #Report the middle of the bucket, but never more than the largest value recorded
+                width = 1 << max(bucket.bit_length() - 1 - self.SUB_BUCKET_BITS, 0)
+                return min((bucket + width / 2) / 1e6, self.max)
+        return self.max
+
+    def summary(self):
+        """ Returns a dict with the count, mean, p50, p90, p99 and max of the values, in milliseconds. """
+        return {
+            "count": self.count,
+            "mean_ms": self.total / self.count * 1000 if self.count else 0.0,
+            "p50_ms": self.percentile(50) * 1000,
+            "p90_ms": self.percentile(90) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": self.max * 1000,
+        }
+
+class RequestStats:
+    """ Thread-safe record of the wall time, time to first byte, response size and status code of every request,
+    grouped by endpoint. """
+
+    def __init__(self, keep_samples: bool = False):
+        """
+        Args:
+            keep_samples: If True then every request is also kept as a raw sample, which can be written out with
+                dump_samples(). Otherwise only the histograms and totals are kept.
+        """
+        self.keep_samples = keep_samples
+        self.samples = []
+        self.endpoints = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint: str, wall_seconds: float, response: requests.Response = None):
+        """ Records one request. 'response' is None if the request failed without a response. """
+        ttfb_seconds = response.elapsed.total_seconds() if response is not None else None
+        size = len(response.content) if response is not None else 0
+        status = str(response.status_code) if response is not None else "error"
+
+        with self.lock:
+            stats = self.endpoints.get(endpoint)
+            if stats is None:
+                stats = {"wall": LatencyHistogram(), "ttfb": LatencyHistogram(), "bytes": 0, "status_codes": {}}
+                self.endpoints[endpoint] = stats
+            stats["wall"].record(wall_seconds)
+            if ttfb_seconds is not None:
+                stats["ttfb"].record(ttfb_seconds)
+            stats["bytes"] += size
+            stats["status_codes"][status] = stats["status_codes"].get(status, 0) + 1
+            if self.keep_samples:
+                self.samples.append({"endpoint": endpoint, "time": time.time(), "wall_seconds": wall_seconds,
+                                     "ttfb_seconds": ttfb_seconds, "bytes": size, "status": status})
+
+    def timed(self, endpoint: str, send):
+        """ Returns a function that calls 'send' (which sends a request and returns its response) and records it. """
+        def timed_send():
+            start = time.perf_counter()
+            try:
+                response = send()
+            except requests.exceptions.RequestException:
+                self.record(endpoint, time.perf_counter() - start)
+                raise
+            self.record(endpoint, time.perf_counter() - start, response)
+            return response
+        return timed_send
+
+    def summary(self):
+        """ Returns a dict with the latency percentiles, sizes and status codes of the requests to each endpoint. """
+        with self.lock:
+            return {endpoint: {"requests": stats["wall"].count,
+                               "wall_time": stats["wall"].summary(),
+                               "time_to_first_byte": stats["ttfb"].summary(),
+                               "response_bytes": stats["bytes"],
+                               "status_codes": dict(stats["status_codes"])}
+                    for endpoint, stats in self.endpoints.items()}
+
+    def dump_samples(self, path: str):
+        """ Writes the raw samples to a JSONL file, one request per line. """
+        with self.lock, open(path, "w") as samples_file:
+            for sample in self.samples:
+                samples_file.write(json.dumps(sample) + "\n")
+
+#Statistics of all the requests sent by this process
+REQUEST_STATS = RequestStats()
+
+class _Span:
+    """ One timed span of a Profiler (see Profiler.span()). """
+
+    __slots__ = ("profiler", "name", "args", "start", "child_seconds")
+
+    def __init__(self, profiler: "Profiler", name: str, args: {}):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.child_seconds = 0.0
+        self.profiler._stack().append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        end = time.perf_counter()
+        stack = self.profiler._stack()
+        stack.pop()
+        duration = end - self.start
+        if stack:
+            stack[-1].child_seconds += duration
+        self.profiler._record(self.name, self.start, duration, duration - self.child_seconds, self.args)
+
+class Profiler:
+    """ Records how long the phases of a run and their sub-steps take, as nested spans on each thread.
+
+    Spans are opened with 'with PROFILER.span(name):'. When the profiler is disabled, span() returns a shared no-op
+    context, so the spans cost next to nothing. The spans can be written as a Chrome trace (viewable in
+    chrome://tracing or Perfetto), which shows how the work of concurrent threads overlaps, and summed up by name
+    into the total time of each span and its self time (the time not spent in nested spans).
+    """
+
+    NO_SPAN = contextlib.nullcontext()
+
+    def __init__(self, enabled: bool = False):
+        self.enabled = enabled
+        self.events = []
+        self.merged = {}
+        self.thread_names = {}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.start = time.perf_counter()
+
+    def span(self, name: str, **args):
+        """ Returns a context manager that times a span. 'args' are shown with the span in the trace. """
+        if not self.enabled:
+            return self.NO_SPAN
+        return _Span(self, name, args)
+
+    def _stack(self):
+        stack = getattr(self.local, "stack", None)
+        if stack is None:
+            stack = self.local.stack = []
+        return stack
+
+    def _record(self, name: str, start: float, duration: float, self_duration: float, args: {}):
+        thread_id = threading.get_ident()
+        with self.lock:
+            if thread_id not in self.thread_names:
+                self.thread_names[thread_id] = threading.current_thread().name
+            self.events.append((name, thread_id, start, duration, self_duration, args))
+
+    def merge(self, summary: {}):
+        """ Adds the summary of another process's profiler (see summary()), e.g. of a bundle's worker process, to the
+        summary of this one. """
+        with self.lock:
+            for name, total in summary.items():
+                merged = self.merged.setdefault(name, {"count": 0, "total_seconds": 0.0, "self_seconds": 0.0})
+                for key in merged:
+                    merged[key] += total[key]
+
+    def summary(self):
+        """ Returns a dict from span name to its count, total time and self time (in seconds), by self time, including
+        any merged summaries. """
+        with self.lock:
+            totals = {name: dict(total) for name, total in self.merged.items()}
+            for name, _, _, duration, self_duration, _ in self.events:
+                total = totals.setdefault(name, {"count": 0, "total_seconds": 0.0, "self_seconds": 0.0})
+                total["count"] += 1
+                total["total_seconds"] += duration
+                total["self_seconds"] += self_duration
+        return dict(sorted(totals.items(), key=lambda item: item[1]["self_seconds"], reverse=True))
+
+    def print_summary(self):
+        """ Prints the summary as a table. """
+        print(f'{"span":<24} {"count":>8} {"total (s)":>12} {"self (s)":>12}')
+        for name, total in self.summary().items():
+            print(f'{name:<24} {total["count"]:>8} {total["total_seconds"]:>12.3f} {total["self_seconds"]:>12.3f}')
+
+    def write_trace(self, path: str):
+        """ Writes the spans as a Chrome trace-event JSON file, with the summary under 'otherData'. """
+        pid = os.getpid()
+        with self.lock:
+            trace_events = [{"name": "thread_name", "ph": "M", "pid": pid, "tid": thread_id,
+                             "args": {"name": thread_name}}
+                            for thread_id, thread_name in self.thread_names.items()]
+            trace_events.extend({"name": name, "ph": "X", "pid": pid, "tid": thread_id,
+                                 "ts": (start - self.start) * 1e6, "dur": duration * 1e6, "args": args}
+                                for name, thread_id, start, duration, _, args in self.events)
+        with open(path, "w") as trace_file:
+            json.dump({"traceEvents": trace_events, "displayTimeUnit": "ms",
+                       "otherData": {"summary": self.summary()}}, trace_file)
+
+#Spans of this process, enabled with --profile
+PROFILER = Profiler()
+
+#Tokens without an expiry are assumed to be valid for this long (in seconds)
+DEFAULT_TOKEN_LIFETIME_SECONDS = 3600
+
+def _fetch_jwt_token(auth_url: str, app_client_id: str, app_client_secret: str):
+    """ Connect to the server and get a JWT token together with its expiry.
+
+    Returns:
+        Dict with the token ('access_token') and the time at which it expires ('expires_at', in seconds since
+        the epoch)
+    """
     token_endpoint = f"{auth_url}/oauth2/token"
     session = OAuth2Session(
         app_client_id, app_client_secret, scope="")
     token = session.fetch_token(token_endpoint, grant_type="client_credentials")
-    return token["access_token"]
+    expires_at = token.get("expires_at") or time.time() + DEFAULT_TOKEN_LIFETIME_SECONDS
+    return {"access_token": token["access_token"], "expires_at": float(expires_at)}
+
+class TokenProvider:
+    """ Thread-safe source of JWT tokens that can be shared by all the upload and query workers.
+
+    The token is cached together with its expiry and refreshed in the background some time before it expires, so
+    workers normally never wait for a token. If a worker does find the token expired (or invalidated after a 401),
+    only one of them fetches a new one while the others wait for it. The token can also be kept in a cache file so
+    that a still-valid token is reused when the process is started again.
+    """
+
+    def __init__(self, auth_url: str, app_client_id: str, app_client_secret: str,
+                 refresh_margin_seconds: float = 300, cache_path: str = None, token: {} = None):
+        """
+        Args:
+            auth_url: Authentication URL for this customer
+            app_client_id: App client ID of the OAuth app
+            app_client_secret: App client secret of the OAuth app
+            refresh_margin_seconds: How long before the token expires it is refreshed in the background. Tokens
+                read from the cache file are only reused if they are valid for longer than this.
+            cache_path: Optional file in which the token is kept between runs. It is only readable by the user.
+            token: Optional token to start with, e.g. one fetched by a parent process, as a dict with
+                'access_token' and 'expires_at' (see _fetch_jwt_token())
+        """
+        self.auth_url = auth_url
+        self.app_client_id = app_client_id
+        self.app_client_secret = app_client_secret
+        self.refresh_margin_seconds = refresh_margin_seconds
+        self.cache_path = cache_path
+        self.cache_key = f"{auth_url} {app_client_id}"
+        self.lock = threading.Lock()
+        self.token = token if token is not None else self._load_cached_token()
+        self.timer = None
+        self.closed = False
+        if self.token is not None:
+            logging.info("Reusing an auth token, which expires in %.0fs", self.token["expires_at"] - time.time())
+            self._schedule_refresh()
+
+    def get(self):
+        """ Returns a valid token, fetching a new one first if it has expired. """
+        token = self.token
+        if token is not None and time.time() < token["expires_at"]:
+            return token["access_token"]
+        with self.lock:
+            #Another worker may have fetched a new token while we were waiting for the lock
+            if self.token is None or time.time() >= self.token["expires_at"]:
+                self._refresh()
+            return self.token["access_token"]
+
+    def invalidate(self, access_token: str):
+        """ Discards a token that the server rejected, so that the next get() fetches a new one.
+        Args:
+            access_token: The rejected token. Nothing is done if the token has already been replaced.
+        """
+        with self.lock:
+            if self.token is not None and self.token["access_token"] == access_token:
+                self.token = None
+
+    def close(self):
+        """ Stops the background refresh. """
+        with self.lock:
+            self.closed = True
+            if self.timer is not None:
+                self.timer.cancel()
+
+    def _refresh(self):
+        """ Fetches a new token. The lock must be held. """
+        with PROFILER.span("auth"):
+            self.token = _fetch_jwt_token(self.auth_url, self.app_client_id, self.app_client_secret)
+        logging.info("Fetched a new auth token, which expires in %.0fs", self.token["expires_at"] - time.time())
+        self._save_cached_token()
+        self._schedule_refresh()
+
+    def _schedule_refresh(self, delay: float = None):
+        if self.closed:
+            return
+        if self.timer is not None:
+            self.timer.cancel()
+        if delay is None:
+            #Refresh at least halfway through the token's life, in case the margin is longer than the lifetime
+            remaining = self.token["expires_at"] - time.time()
+            delay = max(remaining - self.refresh_margin_seconds, remaining / 2, 0)
+        self.timer = threading.Timer(delay, self._background_refresh)
+        self.timer.daemon = True
+        self.timer.start()
+
+    def _background_refresh(self):
+        with self.lock:
+            if self.closed:
+                return
+            try:
+                self._refresh()
+            except Exception as error:
+                #Keep using the current token until it expires and try again a bit later
+                logging.warning("Refreshing the auth token failed with %s, retrying", error)
+                self._schedule_refresh(min(30, self.refresh_margin_seconds / 4))
+
+    def _load_cached_token(self):
+        if self.cache_path is None or not os.path.exists(self.cache_path):
+            return None
+        try:
+            with open(self.cache_path, "r") as f:
+                token = json.load(f).get(self.cache_key)
+        except (OSError, ValueError) as error:
+            logging.warning("Could not read the token cache %s: %s", self.cache_path, error)
+            return None
+        if token is None or token["expires_at"] - time.time() <= self.refresh_margin_seconds:
+            return None
+        return token
+
+    def _save_cached_token(self):
+        if self.cache_path is None:
+            return
+        try:
+            cached = {}
+            if os.path.exists(self.cache_path):
+                with open(self.cache_path, "r") as f:
+                    cached = json.load(f)
+            cached[self.cache_key] = self.token
+            os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+            #Write the new cache next to the old one and swap them, so a crash never leaves a partial file
+            tmp_path = f"{self.cache_path}.{os.getpid()}.tmp"
+            with os.fdopen(os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "w") as f:
+                json.dump(cached, f)
+            os.replace(tmp_path, self.cache_path)
+        except (OSError, ValueError) as error:
+            logging.warning("Could not write the token cache %s: %s", self.cache_path, error)
+
+def _authorized(send, jwt_token):
+    """ Returns a function that sends a request with a current Authorization header.
+    Args:
+        send: Function that sends the request given the headers to add to it, and returns the response.
+        jwt_token: A valid Auth token, or a TokenProvider. With a TokenProvider the token is looked up every time
+            the request is sent, and if the server rejects it (401) a new token is fetched and the request is sent
+            once more.
+
+    Returns:
+        Function with no arguments that sends the request and returns the response
+    """
+    if not isinstance(jwt_token, TokenProvider):
+        return lambda: send({"Authorization": f"Bearer {jwt_token}"})
+
+    def send_authorized():
+        access_token = jwt_token.get()
+        response = send({"Authorization": f"Bearer {access_token}"})
+        if response.status_code == 401:
+            logging.warning("The auth token was rejected, fetching a new one")
+            jwt_token.invalidate(access_token)
+            response = send({"Authorization": f"Bearer {jwt_token.get()}"})
+        return response
+    return send_authorized
 
 def _get_create_corpus_json(bundle: str):
     """ Returns a create corpus json.
@@ -34,12 +488,94 @@ def _get_create_corpus_json(bundle: str):
 
     return json.dumps({"corpus":corpus})
 
+def _get_endpoint_url(address: str, path: str):
+    """ Returns the URL of an API endpoint.
+    Args:
+        address: Address of the server, e.g. serving.vectara.io. It can also be a full base URL such as
+            http://localhost:8080 (e.g. for a local stand-in server), which is used as is.
+        path: Path of the endpoint, e.g. /v1/query
+
+    Returns:
+        The URL of the endpoint
+    """
+    if "://" in address:
+        return address.rstrip("/") + path
+    return f"https://h.{address}{path}"
+
+def _get_http_session(pool_size: int = 10):
+    """ Returns a requests Session that keeps connections alive and can be shared between threads.
+    Args:
+        pool_size: Maximum number of connections kept open per host. This should be at least the
+            number of threads that will use the session at the same time.
+
+    Returns:
+        A requests.Session with a connection pool of the given size
+    """
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+def _get_retry_after_seconds(retry_after: str):
+    """ Returns the number of seconds a Retry-After header asks to wait, or None if it's neither an integer number
+    of seconds nor an HTTP date. """
+    retry_after = retry_after.strip()
+    if retry_after.isdigit():
+        return int(retry_after)
+    try:
+        date = email.utils.parsedate_to_datetime(retry_after)
+    except (TypeError, ValueError):
+        return None
+    if date.tzinfo is None:
+        return None
+    return max(0.0, (date - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+def _send_with_retries(send, max_retries: int = 5, backoff_seconds: float = 0.5):
+    """ Sends a request, retrying with exponential backoff on throttling, server errors and connection errors.
+    Args:
+        send: Function with no arguments that sends the request and returns the response. It is called
+            again for every attempt, so it must build a fresh request body each time (e.g. reopen files).
+        max_retries: Maximum number of times the request is retried after the first attempt.
+        backoff_seconds: Delay before the first retry. The delay doubles with every retry, and a random
+            jitter is applied so that concurrent workers don't all retry at the same time.
+
+    Returns:
+        The response of the last attempt
+    """
+
+    attempt = 0
+    while True:
+        try:
+            response = send()
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as error:
+            if attempt >= max_retries:
+                raise
+            logging.warning("Request failed with %s, retrying (attempt %d of %d)", error, attempt + 1, max_retries)
+            retry_after = None
+        else:
+            if response.status_code not in RETRY_STATUS_CODES or attempt >= max_retries:
+                return response
+            logging.warning("Request failed with code %d, retrying (attempt %d of %d)",
+                            response.status_code, attempt + 1, max_retries)
+            retry_after = response.headers.get("Retry-After")
+
+        delay = backoff_seconds * (2 ** attempt) * random.uniform(0.5, 1.0)
+        #Honour the server's Retry-After header (in seconds or as an HTTP date) when it asks us to wait longer. Any
+        #other value is ignored and the backoff is used.
+        retry_after_seconds = _get_retry_after_seconds(retry_after) if retry_after is not None else None
+        if retry_after_seconds is not None:
+            delay = max(delay, retry_after_seconds)
+        time.sleep(delay)
+        attempt += 1
+
 def create_corpus(customer_id: int, admin_address: str, jwt_token: str, bundle: str):
     """Create a corpus.
     Args:
         customer_id: Unique customer ID in vectara platform.
         admin_address: Address of the admin server. e.g., admin.vectara.io
-        jwt_token: A valid Auth token.
+        jwt_token: A valid Auth token, or a TokenProvider that supplies one.
         bundle: Which test bundle is being used this run
 
     Returns:
@@ -47,14 +583,14 @@ def create_corpus(customer_id: int, admin_address: str, jwt_token: str, bundle:
     """
 
     post_headers = {
-        "customer-id": f"{customer_id}",
-        "Authorization": f"Bearer {jwt_token}"
+        "customer-id": f"{customer_id}"
     }
-    response = requests.post(
-        f"https://h.{admin_address}/v1/create-corpus",
-        data=_get_create_corpus_json(bundle),
-        verify=True,
-        headers=post_headers)
+    with PROFILER.span("create-corpus"):
+        response = REQUEST_STATS.timed("create-corpus", _authorized(lambda auth_headers: requests.post(
+            _get_endpoint_url(admin_address, "/v1/create-corpus"),
+            data=_get_create_corpus_json(bundle),
+            verify=True,
+            headers={**post_headers, **auth_headers}), jwt_token))()
 
     if response.status_code != 200:
         logging.error("Create Corpus failed with code %d, reason %s, text %s",
@@ -68,23 +604,102 @@ def create_corpus(customer_id: int, admin_address: str, jwt_token: str, bundle:
 
     return response, True, corpus_id
 
-def upload_file(customer_id: int, corpus_id: int, idx_address: str, filepath: str, jwt_token: str):
-    """ Uploads a file to the corpus.
+class MultipartFileStream:
+    """ A multipart/form-data request body with one file and some text fields, which is streamed while it is sent.
+
+    The file is read in fixed-size chunks as the body is sent, so the memory used by an upload doesn't depend on
+    the size of the file. The file is opened when the body starts being sent and is closed as soon as it has been
+    read, or when the stream is closed (e.g. if sending fails part way). Since len() gives the size of the whole
+    body, requests sends it with a Content-Length header rather than chunked. The parts are encoded the same way
+    requests encodes a 'files' dict.
+    """
+
+    def __init__(self, field_name: str, filepath: str, fields: {} = None, chunk_size: int = 64 * 1024,
+                 progress=None):
+        """
+        Args:
+            field_name: Name of the form field of the file
+            filepath: Path to the file. It is also sent as the file name.
+            fields: Optional dict of other form fields, from name to string value
+            chunk_size: Number of bytes of the file read and sent at a time
+            progress: Optional function called after each chunk with (bytes sent, total bytes) of the body
+        """
+        self.boundary = os.urandom(16).hex()
+        self.filepath = filepath
+        self.chunk_size = chunk_size
+        self.progress = progress
+        self.head = (f'--{self.boundary}\r\n'
+                     f'Content-Disposition: form-data; name="{self._quote(field_name)}"; '
+                     f'filename="{self._quote(filepath)}"\r\n\r\n').encode()
+        self.tail = b"\r\n"
+        for name, value in (fields or {}).items():
+            self.tail += (f'--{self.boundary}\r\n'
+                          f'Content-Disposition: form-data; name="{self._quote(name)}"; '
+                          f'filename="{self._quote(name)}"\r\n\r\n{value}\r\n').encode()
+        self.tail += f'--{self.boundary}--\r\n'.encode()
+        self.length = len(self.head) + os.path.getsize(filepath) + len(self.tail)
+        self.chunks = None
+
+    @staticmethod
+    def _quote(value: str):
+        return value.replace("\\", "\\\\").replace('"', "%22")
+
+    @property
+    def content_type(self):
+        """ The value of the Content-Type header to send with this body. """
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self.length
+
+    def __iter__(self):
+        self.chunks = self._generate_chunks()
+        return self.chunks
+
+    def _generate_chunks(self):
+        sent = 0
+        for chunk in self._read_parts():
+            sent += len(chunk)
+            yield chunk
+            if self.progress is not None:
+                self.progress(sent, self.length)
+
+    def _read_parts(self):
+        yield self.head
+        with open(self.filepath, 'rb') as file_handle:
+            for chunk in iter(lambda: file_handle.read(self.chunk_size), b""):
+                yield chunk
+        yield self.tail
+
+    def close(self):
+        """ Stops the stream, which closes the file if it is still open. """
+        if self.chunks is not None:
+            self.chunks.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+def upload_file(customer_id: int, corpus_id: int, idx_address: str, filepath: str, jwt_token: str,
+                session: requests.Session = None, max_retries: int = 5, progress=None):
+    """ Uploads a file to the corpus. The file is streamed, so the upload uses the same memory whatever its size.
     Args:
         customer_id: Unique customer ID in vectara platform.
         corpus_id: ID of the corpus to which data needs to be indexed.
         idx_address: Address of the indexing server. e.g., indexing.vectara.io
         filepath: Path to a file to be uploaded to the indexing service
-        jwt_token: A valid Auth token.
+        jwt_token: A valid Auth token, or a TokenProvider that supplies one.
+        session: Optional requests Session to reuse pooled connections. If not provided then a new
+            connection is opened for this upload.
+        max_retries: Maximum number of retries if the upload is throttled or fails with a server error.
+        progress: Optional function called as the file is sent, with (file path, bytes sent, total bytes)
 
     Returns:
         (response, True) in case of success and returns (error, False) in case of failure.
     """
 
-    post_headers = {
-        "Authorization": f"Bearer {jwt_token}"
-    }
-
     #File being posted and also a custom metadata attribute called 'filepath' with the
     #path from which the file was loaded.
 
@@ -92,15 +707,26 @@ def upload_file(customer_id: int, corpus_id: int, idx_address: str, filepath: st
     doc_metadata = {"filepath": f"{filepath}"}
     #Encode it into a well-formatted JSON string
     doc_metadata_json = json.dumps(doc_metadata)
-    #Create the dictionary that stores the file being uploaded and also the metadata field
-    files={"file": (filepath, open(filepath, 'rb')), "doc_metadata": f"{doc_metadata_json}"}
 
-    #Send the request
-    response = requests.post(
-        f"https://h.{idx_address}/upload?c={customer_id}&o={corpus_id}",
-        files=files,
-        verify=True,
-        headers=post_headers)
+    http = session if session is not None else requests
+    file_progress = None
+    if progress is not None:
+        file_progress = lambda sent, total: progress(filepath, sent, total)
+
+    def send(auth_headers):
+        #Stream the file being uploaded and also the metadata field.
+        #A new stream is created for every attempt since a retry has to send the whole body again.
+        with MultipartFileStream("file", filepath, {"doc_metadata": doc_metadata_json},
+                                 progress=file_progress) as body:
+            #Send the request
+            return http.post(
+                _get_endpoint_url(idx_address, f"/upload?c={customer_id}&o={corpus_id}"),
+                data=body,
+                verify=True,
+                headers={**auth_headers, "Content-Type": body.content_type})
+
+    with PROFILER.span("upload.file", file=filepath):
+        response = _send_with_retries(REQUEST_STATS.timed("upload", _authorized(send, jwt_token)), max_retries)
 
     if response.status_code != 200:
         logging.error("REST upload failed with code %d, reason %s, text %s",
@@ -110,46 +736,316 @@ def upload_file(customer_id: int, corpus_id: int, idx_address: str, filepath: st
         return response, False
     return response, True
 
-def upload_data(customer_id: int, corpus_id: int, idx_address: str, dirpath: str, jwt_token: str):
-    """ Uploads a file to the corpus.
+def _hash_file(filepath: str, chunk_size: int = 1 << 20):
+    """ Returns the SHA-256 of a file's content, reading it in chunks so that large files aren't loaded into memory.
+    Args:
+        filepath: Path to the file
+        chunk_size: Number of bytes read at a time
+
+    Returns:
+        Hex digest of the file's SHA-256
+    """
+    digest = hashlib.sha256()
+    with open(filepath, 'rb') as file_handle:
+        for chunk in iter(lambda: file_handle.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _get_file_hashes(filepaths: [str], previous_files: {} = None, concurrency: int = None):
+    """ Returns the size, modification time and content hash of files, hashing them in parallel.
+    Args:
+        filepaths: Paths to the files
+        previous_files: Optional 'files' of a manifest (see _load_manifest()). The hash of a file whose size and
+            modification time are the same as in this manifest is reused instead of being computed again.
+        concurrency: Number of files hashed at the same time. Defaults to the number of CPUs.
+
+    Returns:
+        Dict from file path to a dict with its 'size', 'mtime' and 'sha256'
+    """
+    previous_files = previous_files or {}
+    file_hashes = {}
+    to_hash = []
+    for filepath in filepaths:
+        stat = os.stat(filepath)
+        file_hashes[filepath] = {"size": stat.st_size, "mtime": stat.st_mtime}
+        previous = previous_files.get(filepath, {})
+        if previous.get("size") == stat.st_size and previous.get("mtime") == stat.st_mtime and "sha256" in previous:
+            file_hashes[filepath]["sha256"] = previous["sha256"]
+        else:
+            to_hash.append(filepath)
+
+    #hashlib releases the GIL while it hashes large chunks, so threads hash files in parallel
+    with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency or os.cpu_count()) as executor:
+        for filepath, sha256 in zip(to_hash, executor.map(_hash_file, to_hash)):
+            file_hashes[filepath]["sha256"] = sha256
+    return file_hashes
+
+def _get_manifest_path(manifest_dir: str, idx_address: str, customer_id: int, corpus_id: int, bundle: str):
+    """ Returns the path of the upload manifest of a bundle's data in a corpus. The indexing endpoint is part of the
+    name, since another endpoint (e.g. a local emulator) can have corpora with the same IDs. """
+    endpoint = re.sub(r"[^A-Za-z0-9.]+", "_", re.sub(r"^https?://", "", idx_address)).strip("_")
+    return os.path.join(manifest_dir, f"manifest-{endpoint}-{customer_id}-{corpus_id}-{bundle}.json")
+
+def _load_manifest(manifest_path: str):
+    """ Loads an upload manifest, which records what has been uploaded to a corpus.
+    Args:
+        manifest_path: Path to the manifest (see _get_manifest_path())
+
+    Returns:
+        Dict with a 'files' dict from file path to a dict with its 'size', 'mtime' and 'sha256' when it was last
+        uploaded, and the 'status' ('uploaded' or 'failed'), 'status_code' and 'uploaded_at' time of that upload.
+        The 'files' dict is empty if the manifest doesn't exist yet.
+    """
+    if not os.path.exists(manifest_path):
+        return {"files": {}}
+    with open(manifest_path) as manifest_file:
+        return json.load(manifest_file)
+
+def _save_manifest(manifest_path: str, manifest: {}):
+    """ Writes an upload manifest, replacing the previous one atomically so that a crash can't corrupt it. """
+    os.makedirs(os.path.dirname(manifest_path) or ".", exist_ok=True)
+    with open(manifest_path + ".tmp", "w") as manifest_file:
+        json.dump(manifest, manifest_file)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+def upload_data(customer_id: int, corpus_id: int, idx_address: str, dirpath: str, jwt_token: str,
+                concurrency: int = 4, max_retries: int = 5, manifest_path: str = None, progress=None,
+                uploaded_at: {} = None, new_corpus: bool = False):
+    """ Uploads all files in a directory to the corpus, using a pool of concurrent workers.
+
+    If a manifest is used, only files that are new or have changed since they were last uploaded (or whose upload
+    failed) are uploaded. The manifest is updated as each upload finishes, so an interrupted upload can be resumed
+    by running it again.
+
     Args:
         customer_id: Unique customer ID in vectara platform.
         corpus_id: ID of the corpus to which data needs to be indexed.
         idx_address: Address of the indexing server. e.g., indexing.vectara.io
         dirpath: Path to a directory containing files (and nested directories) to be uploaded to the indexing service
-        jwt_token: A valid Auth token.
+        jwt_token: A valid Auth token, or a TokenProvider that supplies one.
+        concurrency: Number of files that are uploaded at the same time.
+        max_retries: Maximum number of retries for each file if the upload is throttled or fails with a server error.
+        manifest_path: Optional path to the upload manifest of this directory's files in the corpus
+            (see _get_manifest_path()).
+        progress: Optional function called as each file is sent, with (file path, bytes sent, total bytes)
+        uploaded_at: Optional dict that is filled in with the time (from time.time()) at which each file that was
+            uploaded successfully finished uploading, keyed by file path.
+        new_corpus: If True then the corpus was just created, so any existing manifest is out of date (e.g. left over
+            from before the account or emulator was reset) and every file is uploaded.
 
     Returns:
-        (response, True) in case of success and returns (error, False) in case of failure.
+        (responses, True) if every file was uploaded and (responses, False) if any upload failed, where
+        'responses' is a dict from file path to the response of its upload.
     """
-    
+
+    #Walk through the directory and all nested directories, and collect each file found
+    filepaths = []
+    with PROFILER.span("upload.walk"):
+        for subdir, dirs, files in os.walk(dirpath):
+            for file in files:
+                filepaths.append(os.path.join(subdir, file))
+
+    if manifest_path is not None:
+        #Skip the files that were uploaded before and haven't changed since
+        manifest = {"files": {}} if new_corpus else _load_manifest(manifest_path)
+        with PROFILER.span("upload.hash"):
+            file_hashes = _get_file_hashes(filepaths, manifest["files"])
+        unchanged = {filepath for filepath in filepaths
+                     if manifest["files"].get(filepath, {}).get("status") == "uploaded"
+                     and manifest["files"][filepath]["sha256"] == file_hashes[filepath]["sha256"]}
+        print(f'Skipping {len(unchanged)} files that are already uploaded and unchanged (manifest {manifest_path})')
+        filepaths = [filepath for filepath in filepaths if filepath not in unchanged]
+
+    #Upload the largest files first, so that the run isn't left waiting on one big file at the end
+    file_sizes = {filepath: os.path.getsize(filepath) for filepath in filepaths}
+    filepaths.sort(key=lambda filepath: file_sizes[filepath], reverse=True)
+
     responses = {}
+    all_uploaded = True
+    uploaded_bytes = 0
+    start_time = time.perf_counter()
+
+    print(f'\nUploading {len(filepaths)} files from {dirpath} with {concurrency} concurrent workers...')
+    with _get_http_session(concurrency) as session, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = {executor.submit(upload_file, customer_id, corpus_id, idx_address, filepath, jwt_token,
+                                   session, max_retries, progress): filepath
+                   for filepath in filepaths}
+
+        for done_ct, future in enumerate(concurrent.futures.as_completed(futures), start=1):
+            filepath = futures[future]
+            try:
+                response, status = future.result()
+            except requests.exceptions.RequestException as error:
+                logging.error("Upload of %s failed: %s", filepath, error)
+                all_uploaded = False
+                print(f'[{done_ct}/{len(filepaths)}] FAILED {filepath}')
+                if manifest_path is not None:
+                    manifest["files"][filepath] = dict(file_hashes[filepath], status="failed", status_code=None,
+                                                       uploaded_at=time.time())
+                    _save_manifest(manifest_path, manifest)
+                continue
 
-    #Walk through the directory and all nested directories, and upload each file found
-    for subdir, dirs, files in os.walk(dirpath):
-        for file in files:
-            filepath = os.path.join(subdir, file)
-            print('\nUploading ' + filepath + '...')
-            response, status = upload_file(customer_id,
-                                      corpus_id,
-                                      idx_address,
-                                      filepath,
-                                      jwt_token)
             logging.info("Upload File response: %s", response.text)
             responses[filepath] = response
-            print('Uploaded ' + filepath)
-    
-    return responses, True
+            if status:
+                uploaded_bytes += file_sizes[filepath]
+                if uploaded_at is not None:
+                    uploaded_at[filepath] = time.time()
+                print(f'[{done_ct}/{len(filepaths)}] Uploaded {filepath} ({file_sizes[filepath] / 1e6:.2f} MB)')
+            else:
+                all_uploaded = False
+                print(f'[{done_ct}/{len(filepaths)}] FAILED {filepath} (code {response.status_code})')
+            if manifest_path is not None:
+                manifest["files"][filepath] = dict(file_hashes[filepath], status="uploaded" if status else "failed",
+                                                   status_code=response.status_code, uploaded_at=time.time())
+                _save_manifest(manifest_path, manifest)
+
+    elapsed = time.perf_counter() - start_time
+    print(f'Uploaded {uploaded_bytes / 1e6:.2f} MB in {elapsed:.2f}s '
+          f'({uploaded_bytes / 1e6 / max(elapsed, 1e-9):.2f} MB/s)')
+
+    return responses, all_uploaded
+
+def wait_until_searchable(customer_id: int, corpus_id: int, query_address: str, jwt_token: str, queries_file: str,
+                          uploaded_at: {}, timeout_seconds: float = 600, batch_size: int = 10,
+                          max_retries: int = 5, min_delay_seconds: float = 1, max_delay_seconds: float = 30):
+    """ Waits until the files that were just uploaded can be found by a search, so that the evaluation doesn't
+    count documents that are still being indexed as misses.
+
+    Each uploaded file is probed by searching for one of its expected phrases (see _iter_queries()), which appears
+    verbatim in the file, or if it has none, for a phrase from its own text (see _get_probe_phrase()). A file is
+    searchable once it is returned for its probe. The probes of the files that are not searchable yet are sent again,
+    in batches, until they all are or the timeout is reached. The delay between rounds starts short, doubles every round in which no new
+    file became searchable, and goes back to the start when one did.
 
-def _get_queries_list(queries_file: str):
-    """This parses the queries.csv file into a data structure that contains all the
-    queries to be run and the expected matches.
+    Args:
+        customer_id: Unique customer ID in vectara platform.
+        corpus_id: ID of the corpus that will be searched.
+        query_address: Address of the querying service. e.g., serving.vectara.io
+        jwt_token: A valid Auth token, or a TokenProvider that supplies one.
+        queries_file: Path to the file containing the queries of this evaluation.
+        uploaded_at: Dict from the path of each uploaded file to the time it finished uploading (see upload_data())
+        timeout_seconds: Maximum time to wait.
+        batch_size: Number of probes sent in each query request.
+        max_retries: Maximum number of retries if a probe is throttled or fails with a server error.
+        min_delay_seconds: Delay between probe rounds while files are becoming searchable.
+        max_delay_seconds: Longest delay between probe rounds.
+
+    Returns:
+        Dict with the indexing latency: the number of files probed and found, percentiles of the time from the
+        end of each file's upload until it was searchable, how long we waited, and the time of each file (None
+        for files that were not searchable before the timeout). Files that have no expected phrase and whose text
+        can't be read (PDFs) can't be probed, so they are listed as not probed instead.
+    """
+
+    #One known phrase for each file number
+    phrases = {}
+    for this_query in _iter_queries(queries_file):
+        for file_num, phrase in this_query.matches:
+            phrases.setdefault(file_num, phrase)
+
+    pending = {}
+    not_probed = []
+    for filepath in uploaded_at:
+        file_num = os.path.basename(filepath).split('-')[0]
+        if file_num not in phrases:
+            phrases[file_num] = _get_probe_phrase(filepath)
+        if phrases[file_num] is not None:
+            pending[file_num] = filepath
+        else:
+            not_probed.append(filepath)
+
+    print(f'\nWaiting for {len(pending)} uploaded files to be searchable...')
+    if not_probed:
+        logging.warning("%d files have no expected phrase and no readable text, so they can't be probed and may "
+                        "not be searchable yet: %s", len(not_probed), sorted(not_probed))
+    searchable_after = {}
+    start_time = time.time()
+    delay = min_delay_seconds
+    with _get_http_session(1) as session:
+        while pending:
+            probes = [QueryRecord(file_num, phrases[file_num]) for file_num in pending]
+            found = 0
+            for batch_start in range(0, len(probes), batch_size):
+                for probe, response_set in _run_query_batch(customer_id, corpus_id, query_address, jwt_token,
+                                                            probes[batch_start:batch_start + batch_size],
+                                                            session, max_retries):
+                    if response_set is None:
+                        continue
+                    doc_ids = {os.path.basename(doc["id"]).split('-')[0] for doc in response_set.get("document", [])}
+                    if probe.num in doc_ids:
+                        filepath = pending.pop(probe.num)
+                        searchable_after[filepath] = max(time.time() - uploaded_at[filepath], 0)
+                        found += 1
+            print(f'{len(searchable_after)}/{len(searchable_after) + len(pending)} files searchable '
+                  f'after {time.time() - start_time:.1f}s')
+            if not pending:
+                break
+            if time.time() - start_time + delay > timeout_seconds:
+                logging.warning("%d files were still not searchable after %.0fs: %s",
+                                len(pending), timeout_seconds, sorted(pending.values()))
+                break
+            delay = min_delay_seconds if found else min(delay * 2, max_delay_seconds)
+            time.sleep(delay)
+
+    times = np.array(list(searchable_after.values()))
+    indexing_latency = {
+        "files_probed": len(searchable_after) + len(pending),
+        "files_searchable": len(searchable_after),
+        "files_not_probed": sorted(not_probed),
+        "waited_seconds": time.time() - start_time,
+    }
+    for percentile in (50, 90, 99, 100):
+        name = "max_seconds" if percentile == 100 else f"p{percentile}_seconds"
+        indexing_latency[name] = float(np.percentile(times, percentile)) if len(times) else None
+    indexing_latency["per_file_seconds"] = dict(sorted(
+        itertools.chain(searchable_after.items(), ((filepath, None) for filepath in pending.values()))))
+    return indexing_latency
+
+def _get_probe_phrase(filepath: str, num_words: int = 25):
+    """ Returns a phrase from the text of a data file with which to probe whether the file is searchable: the first
+    words of the longest line in its first PROBE_PREFIX_BYTES, which are unlikely to appear in any other file.
+    Returns None if the file's text can't be read (see _read_document_text()). """
+    text = _read_document_text(filepath, PROBE_PREFIX_BYTES)
+    if text is None or not text.strip():
+        return None
+    return " ".join(max(text.splitlines(), key=len).split()[:num_words])
+
+class QueryRecord:
+    """ One query of a query set and its expected matches. Slotted, since a query set can have hundreds of thousands
+    of them. """
+
+    __slots__ = ("num", "query", "matches", "overrides")
+
+    def __init__(self, num: int, query: str, matches: tuple = (), overrides: {} = None):
+        """
+        Args:
+            num: Number of the query in the query set
+            query: Text of the query
+            matches: Tuple of (file_num, phrase) tuples, one for each expected match
+            overrides: Optional query body parameters that the query is run with (see _get_query_obj()), e.g. one
+                configuration of a sweep
+        """
+        self.num = num
+        self.query = query
+        self.matches = matches
+        self.overrides = overrides
+
+    def __repr__(self):
+        return f"QueryRecord(num={self.num!r}, query={self.query!r}, matches={self.matches!r}, " \
+               f"overrides={self.overrides!r})"
+
+def _iter_queries(queries_file: str):
+    """This parses the queries.csv file one line at a time, yielding each query to be run and its expected matches,
+    so that the whole query set never has to be held in memory.
 
     Args:
         queries_file: Path to the file containing the queries to run in this evaluation.
             Each line represents one query in a pipe-separated list, with the following format:
                 query_number|query_text|[matching_file_num@matching_file_phrase]+
-            'query_number' should start with 1 and increase by one for each query
+            'query_number' is a unique number for each query. The numbers don't have to start at 1, be in order, or
+                be consecutive.
             'query_text' can be any query, but it cannot contain a pipe (|)
             'matching_file_num' must correspond to the prefix number of a file in this bundle's data directory that
                 should be returned as a match for this query
@@ -161,81 +1057,186 @@ def _get_queries_list(queries_file: str):
             mentions Clemmons, and one in the file that starts with "8-" (at the text that mentions brisket).
 
     Returns:
-        Array of dicts, each one representing a query to be executed, and having type
-        {num:int, query:str, matches:[{file-num:str, phrase:str}]}
+        Generator of QueryRecord objects, one for each query in the file
     """
 
-    file_handle = open(queries_file, 'r')
-    lines = file_handle.readlines()
-    queries = []
-    for line in lines:
-        fields = line.split('|')
-        if len(fields) < 3:
-            continue
-        this_query = {}
-        this_query["num"] = int(fields[0])
-        this_query["query"] = fields[1]
-        this_query["matches"] = [{}] * (len(fields) - 2)
-        for i in range(2, len(fields)):
-            matches = fields[i].split('@')
-            this_query["matches"][i-2] = {}
-            this_query["matches"][i-2]["file-num"] = matches[0]
-            this_query["matches"][i-2]["phrase"] = matches[1].strip()
-        queries.append(this_query)
-    file_handle.close()
-
-    return queries
-
-def _get_query_json(customer_id: int, corpus_id: int, query_text: str):
-    """ Returns a query JSON string.
+    with open(queries_file, 'r') as file_handle:
+        for line in file_handle:
+            fields = line.split('|')
+            if len(fields) < 3:
+                continue
+            matches = []
+            for field in fields[2:]:
+                match = field.split('@')
+                matches.append((match[0], match[1].strip()))
+            yield QueryRecord(int(fields[0]), fields[1], tuple(matches))
+
+def _get_queries_list(queries_file: str):
+    """ Returns all the queries of a queries.csv file (see _iter_queries() for the format) as a list of
+    QueryRecord objects. """
+    return list(_iter_queries(queries_file))
+
+def _get_k_values(k_values: [int]):
+    """ Returns the cut-offs (K) of the @K metrics in increasing order.
+    Raises:
+        ValueError: If a K is not positive or is given more than once
+    """
+    if any(k <= 0 for k in k_values):
+        raise ValueError(f"--k-values must be positive, got {','.join(map(str, k_values))}")
+    if len(set(k_values)) != len(k_values):
+        raise ValueError(f"--k-values must not repeat a K, got {','.join(map(str, k_values))}")
+    return sorted(k_values)
+
+def _get_result_depth(k_values: [int], num_results: int = None):
+    """ Returns the number of results to request for each query. Every metric only looks at the top max(K)
+    results, so by default no more than that are requested.
+
+    Args:
+        k_values: The cut-offs (K) for which the @K metrics are computed
+        num_results: Optional number of results to request instead, e.g. for a deep recall study
+
+    Returns:
+        Number of results to request for each query
+    """
+    if num_results is None:
+        return max(k_values)
+    if num_results < max(k_values):
+        logging.warning("Only %d results are requested for each query, so the @K metrics for K above %d only count "
+                        "the top %d results", num_results, num_results, num_results)
+    return num_results
+
+def _json_loads(data):
+    """ Parses a JSON document (str or bytes) with orjson if it is installed, or with the json module if not. The
+    whole document is parsed, so query responses should only ask for as many results as are scored. """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+def _apply_overrides(query_obj: {}, overrides: {}):
+    """ Sets parameters of a query object, in place.
+
+    Args:
+        query_obj: The query object (see _get_query_obj())
+        overrides: Dict from the dotted path of a parameter to its value, e.g.
+            {"num_results": 20, "corpus_key.lexical_interpolation_config.lambda": 0.025}. A path that goes through a
+            list (such as 'corpus_key') sets the parameter in every item of the list, missing dicts along the path are
+            created, and a value of None removes the parameter.
+
+    Raises:
+        ValueError: If a path goes through a parameter that is neither a dict nor a list of dicts
+    """
+    for path, value in overrides.items():
+        parents = [query_obj]
+        keys = path.split(".")
+        for depth, key in enumerate(keys[:-1]):
+            children = []
+            for parent in parents:
+                child = parent.setdefault(key, {})
+                children.extend(child if isinstance(child, list) else [child])
+            if not all(isinstance(child, dict) for child in children):
+                raise ValueError(f"Parameter path '{path}' goes through '{'.'.join(keys[:depth + 1])}', which is "
+                                 f"not an object")
+            parents = children
+        for parent in parents:
+            if value is None:
+                parent.pop(keys[-1], None)
+            else:
+                parent[keys[-1]] = value
+
+def _get_query_obj(customer_id: int, corpus_id: int, query_text: str, num_results: int = NUM_RESULTS,
+                   overrides: {} = None):
+    """ Returns the dict that describes a single query within a query request.
 
     Args:
         customer_id: Unique customer ID in vectara platform.
         corpus_id: ID of the corpus that will be searched.
         query_text: The query to be run.
+        num_results: Number of results to request.
+        overrides: Optional parameters set in the query object (see _apply_overrides()), e.g. the hybrid search or
+            reranking settings of one configuration of a sweep.
 
     Returns:
-        JSON string that can be used to execute the query
+        Dict that can be added to the 'query' list of a query request
     """
-    query = {}
     query_obj = {}
 
     query_obj["query"] = query_text
-    query_obj["num_results"] = 100
+    query_obj["num_results"] = num_results
 
     corpus_key = {}
     corpus_key["customer_id"] = customer_id
     corpus_key["corpus_id"] = corpus_id
 
     query_obj["corpus_key"] = [ corpus_key ]
-    query["query"] = [ query_obj ]
-    return json.dumps(query)
+    if overrides:
+        _apply_overrides(query_obj, overrides)
+    return query_obj
 
-def _run_query(customer_id: int, corpus_id: int, query_address: str, jwt_token: str, this_query: {}):
-    """ Runs a query in the Vectara platform.
+def _get_query_json(customer_id: int, corpus_id: int, query_text: str, num_results: int = NUM_RESULTS):
+    """ Returns a query JSON string.
 
     Args:
         customer_id: Unique customer ID in vectara platform.
         corpus_id: ID of the corpus that will be searched.
-        query_address: Address of the querying service. e.g., serving.vectara.io
-        jwt_token: A valid Auth token.
-        this_query: A dict representing a single query (see _get_queries_list() for the format)
+        query_text: The query to be run.
+        num_results: Number of results to request.
 
     Returns:
-        (response, True) in case of success and returns (error, False) in case of failure.
+        JSON string that can be used to execute the query
+    """
+    return _get_batch_query_json(customer_id, corpus_id, [query_text], num_results)
+
+def _get_batch_query_json(customer_id: int, corpus_id: int, query_texts: [str], num_results: int = NUM_RESULTS,
+                          overrides: [{}] = None):
+    """ Returns a query JSON string that runs several queries in a single request.
 
+    Args:
+        customer_id: Unique customer ID in vectara platform.
+        corpus_id: ID of the corpus that will be searched.
+        query_texts: The queries to be run. The response contains one entry in 'responseSet' for
+            each of them, in the same order.
+        num_results: Number of results to request for each query.
+        overrides: Optional list with the parameters set in the query object of each query (see _apply_overrides())
+
+    Returns:
+        JSON string that can be used to execute the queries
+    """
+    overrides = overrides or [None] * len(query_texts)
+    query = {}
+    query["query"] = [ _get_query_obj(customer_id, corpus_id, query_text, num_results, query_overrides)
+                       for query_text, query_overrides in zip(query_texts, overrides) ]
+    return json.dumps(query)
+
+def _post_query(customer_id: int, query_address: str, jwt_token: str, query_json: str,
+                session: requests.Session = None, max_retries: int = 5):
+    """ Sends a query request to the Vectara platform.
+
+    Args:
+        customer_id: Unique customer ID in vectara platform.
+        query_address: Address of the querying service. e.g., serving.vectara.io
+        jwt_token: A valid Auth token, or a TokenProvider that supplies one.
+        query_json: JSON string with the body of the query request
+        session: Optional requests Session to reuse pooled connections. If not provided then a new
+            connection is opened for this request.
+        max_retries: Maximum number of retries if the request is throttled or fails with a server error.
+
+    Returns:
+        The response of the request
     """
     post_headers = {
-        "customer-id": f"{customer_id}",
-        "Authorization": f"Bearer {jwt_token}"
+        "customer-id": f"{customer_id}"
     }
+    http = session if session is not None else requests
 
     # Send the request
-    response = requests.post(
-        f"https://h.{query_address}/v1/query",
-        data=_get_query_json(customer_id, corpus_id, this_query["query"]),
-        verify=True,
-        headers=post_headers)
+    with PROFILER.span("query.request"):
+        response = _send_with_retries(
+            REQUEST_STATS.timed("query", _authorized(lambda auth_headers: http.post(
+                _get_endpoint_url(query_address, "/v1/query"),
+                data=query_json,
+                verify=True,
+                headers={**post_headers, **auth_headers}), jwt_token)),
+            max_retries)
 
     if response.status_code != 200:
         logging.error("Query failed with code %d, reason %s, text %s",
@@ -244,6 +1245,369 @@ def _run_query(customer_id: int, corpus_id: int, query_address: str, jwt_token:
                        response.text)
     return response
 
+def _run_query(customer_id: int, corpus_id: int, query_address: str, jwt_token: str, this_query: {},
+               session: requests.Session = None, max_retries: int = 5, num_results: int = NUM_RESULTS):
+    """ Runs a query in the Vectara platform.
+
+    Args:
+        customer_id: Unique customer ID in vectara platform.
+        corpus_id: ID of the corpus that will be searched.
+        query_address: Address of the querying service. e.g., serving.vectara.io
+        jwt_token: A valid Auth token, or a TokenProvider that supplies one.
+        this_query: The QueryRecord of the query
+        session: Optional requests Session to reuse pooled connections. If not provided then a new
+            connection is opened for this query.
+        max_retries: Maximum number of retries if the query is throttled or fails with a server error.
+        num_results: Number of results to request.
+
+    Returns:
+        The response of the query request
+
+    """
+    return _post_query(customer_id, query_address, jwt_token,
+                       _get_query_json(customer_id, corpus_id, this_query.query, num_results),
+                       session, max_retries)
+
+def _response_set_failed(response_set: {}):
+    """ Determines whether the entry of 'responseSet' for one query reports that the query failed.
+
+    Args:
+        response_set: One entry of the 'responseSet' list of a query response
+
+    Returns:
+        True if the query failed (it has no results and a status other than OK). False otherwise.
+    """
+    if response_set.get("response"):
+        return False
+    return any(status.get("code", "OK") != "OK" for status in response_set.get("status", []))
+
+class TokenBucket:
+    """ Thread-safe token bucket rate limiter, used to keep the number of requests per second under a quota. """
+
+    def __init__(self, rate: float, burst: float = 1):
+        """
+        Args:
+            rate: Number of tokens added to the bucket per second, i.e. the maximum sustained requests per second.
+            burst: Maximum number of tokens the bucket can hold, i.e. how many requests can be sent back to back.
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """ Blocks until a token is available and then takes it. """
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.last_refill) * self.rate)
+                self.last_refill = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+def _run_query_batch(customer_id: int, corpus_id: int, query_address: str, jwt_token: str, batch: [],
+                     session: requests.Session = None, max_retries: int = 5, num_results: int = NUM_RESULTS,
+                     rate_limiter: TokenBucket = None):
+    """ Runs a batch of queries in a single request to the Vectara platform.
+
+    If the request as a whole fails, each query of the batch is run again on its own, so that one bad
+    query doesn't discard the results of the others.
+
+    Args:
+        customer_id: Unique customer ID in vectara platform.
+        corpus_id: ID of the corpus that will be searched.
+        query_address: Address of the querying service. e.g., serving.vectara.io
+        jwt_token: A valid Auth token, or a TokenProvider that supplies one.
+        batch: List of QueryRecord objects
+        session: Optional requests Session to reuse pooled connections. If not provided then a new
+            connection is opened for this request.
+        max_retries: Maximum number of retries if a request is throttled or fails with a server error.
+        num_results: Number of results to request for each query, unless its overrides set another number. Any
+            results beyond it in a response are dropped.
+        rate_limiter: Optional TokenBucket of the run's query rate limit. The caller waits for it before this batch
+            is sent, and the queries of a failed batch each wait for it before they are sent again on their own.
+
+    Returns:
+        List of (query, response_set) tuples, one for each query in the batch. 'response_set' is the entry
+        of 'responseSet' in the query response for that query, or None if the query failed.
+    """
+    try:
+        response = _post_query(customer_id, query_address, jwt_token,
+                               _get_batch_query_json(customer_id, corpus_id,
+                                                     [this_query.query for this_query in batch], num_results,
+                                                     [this_query.overrides for this_query in batch]),
+                               session, max_retries)
+    except requests.exceptions.RequestException as error:
+        logging.error("Queries %s could not be sent: %s", [this_query.num for this_query in batch], error)
+        response = None
+
+    response_sets = None
+    if response is not None and response.status_code == 200:
+        with PROFILER.span("query.parse"):
+            response_sets = _json_loads(response.content).get("responseSet", [])
+        if len(response_sets) != len(batch):
+            logging.error("Expected %d response sets for queries %s but got %d",
+                          len(batch), [this_query.num for this_query in batch], len(response_sets))
+            response_sets = None
+
+    if response_sets is None:
+        if len(batch) > 1:
+            #Split the batch up so that a single bad query doesn't fail all the others
+            results = []
+            for this_query in batch:
+                if rate_limiter is not None:
+                    with PROFILER.span("query.throttle"):
+                        rate_limiter.acquire()
+                results.extend(_run_query_batch(customer_id, corpus_id, query_address, jwt_token, [this_query],
+                                                session, max_retries, num_results, rate_limiter))
+            return results
+        return [(batch[0], None)]
+
+    results = []
+    for this_query, response_set in zip(batch, response_sets):
+        if _response_set_failed(response_set):
+            logging.error("Query %s failed with status %s", this_query.num, response_set.get("status"))
+            response_set = None
+        else:
+            #Don't keep (or cache) results that are deeper than any metric looks
+            depth = (this_query.overrides or {}).get("num_results") or num_results
+            if len(response_set.get("response", [])) > depth:
+                response_set["response"] = response_set["response"][:depth]
+        results.append((this_query, response_set))
+    return results
+
+class ResponseCache:
+    """ Content-addressed on-disk cache of query results.
+
+    Each query's entry of 'responseSet' is stored under a hash of the URL of the query endpoint, the customer ID and
+    its query object, which includes the corpus IDs, the query text and every request parameter, so that another
+    endpoint or account with the same corpus IDs (e.g. a local emulator) can't be served its entries. The number of
+    results is left out of the hash and stored with the entry instead, so that an entry also serves requests for
+    fewer results, truncated to that many. Entries are kept in gzip-compressed JSONL shards (one line per entry),
+    chosen by the first two hex digits of the hash. A shard is only read the first time one of its entries is
+    needed, and new entries are appended to it as a compressed member when the cache is closed. Closing the cache
+    also evicts entries that are too old, or the oldest entries if the cache has grown larger than its size limit.
+    """
+
+    def __init__(self, cache_dir: str, max_age_days: float = None, max_size_mb: float = None):
+        """
+        Args:
+            cache_dir: Directory the shards are stored in. It is created if it doesn't exist.
+            max_age_days: Optional age after which an entry is no longer used and is evicted.
+            max_size_mb: Optional limit on the total size of the shards on disk.
+        """
+        self.cache_dir = cache_dir
+        self.max_age_seconds = max_age_days * 86400 if max_age_days is not None else None
+        self.max_size_bytes = max_size_mb * 1e6 if max_size_mb is not None else None
+        self.shards = {}
+        self.pending = {}
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def key(query_address: str, customer_id: int, query_obj: {}):
+        """ Returns the cache key for a query object (see _get_query_obj()) sent to a querying service. The number of
+        results isn't part of the key. """
+        query_obj = {name: value for name, value in query_obj.items() if name != "num_results"}
+        keyed = {"url": _get_endpoint_url(query_address, "/v1/query"), "customer_id": customer_id, "query": query_obj}
+        return hashlib.sha256(json.dumps(keyed, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+    def _shard_path(self, shard: str):
+        return os.path.join(self.cache_dir, f"shard-{shard}.jsonl.gz")
+
+    def _load_shard(self, shard: str):
+        """ Returns the entries of a shard as a dict from key to (timestamp, response_set, num_results), reading it
+        if needed.
+        The caller must hold the lock. """
+        if shard not in self.shards:
+            entries = {}
+            path = self._shard_path(shard)
+            if os.path.exists(path):
+                with gzip.open(path, "rt", encoding="utf-8") as shard_file:
+                    for line in shard_file:
+                        entry = _json_loads(line)
+                        entries[entry["key"]] = (entry["ts"], entry["response_set"], entry["num_results"])
+            self.shards[shard] = entries
+        return self.shards[shard]
+
+    def _is_expired(self, timestamp: float, now: float):
+        return self.max_age_seconds is not None and now - timestamp > self.max_age_seconds
+
+    def get(self, query_address: str, customer_id: int, query_obj: {}):
+        """ Returns the cached response set for a query object sent to a querying service, or None if it isn't in the
+        cache with at least as many results as the query object asks for. A deeper response is truncated. """
+        key = self.key(query_address, customer_id, query_obj)
+        with self.lock:
+            entry = self._load_shard(key[:2]).get(key)
+        if entry is None or self._is_expired(entry[0], time.time()) or entry[2] < query_obj["num_results"]:
+            return None
+        timestamp, response_set, num_results = entry
+        if len(response_set.get("response", [])) > query_obj["num_results"]:
+            response_set = dict(response_set, response=response_set["response"][:query_obj["num_results"]])
+        return response_set
+
+    def put(self, query_address: str, customer_id: int, query_obj: {}, response_set: {}):
+        """ Adds the response set for a query object sent to a querying service to the cache. It is written to disk
+        by close(). """
+        key = self.key(query_address, customer_id, query_obj)
+        timestamp = time.time()
+        num_results = query_obj["num_results"]
+        line = json.dumps({"key": key, "ts": timestamp, "response_set": response_set, "num_results": num_results},
+                          separators=(',', ':'))
+        with self.lock:
+            self._load_shard(key[:2])[key] = (timestamp, response_set, num_results)
+            self.pending.setdefault(key[:2], []).append(line)
+
+    def _rewrite_shard(self, shard: str):
+        """ Replaces a shard on disk with its in-memory entries. The caller must hold the lock. """
+        path = self._shard_path(shard)
+        entries = self.shards[shard]
+        if not entries:
+            if os.path.exists(path):
+                os.remove(path)
+            return
+        with gzip.open(path + ".tmp", "wt", encoding="utf-8") as shard_file:
+            for key, (timestamp, response_set, num_results) in entries.items():
+                shard_file.write(json.dumps({"key": key, "ts": timestamp, "response_set": response_set,
+                                             "num_results": num_results}, separators=(',', ':')) + "\n")
+        os.replace(path + ".tmp", path)
+
+    def _size_on_disk(self):
+        return sum(entry.stat().st_size for entry in os.scandir(self.cache_dir) if entry.name.startswith("shard-"))
+
+    def evict(self):
+        """ Removes expired entries, and then the oldest entries until the cache fits in its size limit. """
+        with self.lock:
+            if self.max_age_seconds is None and \
+                    (self.max_size_bytes is None or self._size_on_disk() <= self.max_size_bytes):
+                return
+
+            shards = [entry.name[len("shard-"):-len(".jsonl.gz")] for entry in os.scandir(self.cache_dir)
+                      if entry.name.startswith("shard-") and entry.name.endswith(".jsonl.gz")]
+            changed = set()
+            now = time.time()
+            for shard in shards:
+                entries = self._load_shard(shard)
+                for key in [key for key, (timestamp, _, _) in entries.items() if self._is_expired(timestamp, now)]:
+                    del entries[key]
+                    changed.add(shard)
+            for shard in changed:
+                self._rewrite_shard(shard)
+
+            size = self._size_on_disk()
+            if self.max_size_bytes is not None and size > self.max_size_bytes:
+                #Drop the oldest entries, assuming every entry takes up about the same share of the compressed size
+                oldest = sorted((timestamp, shard, key) for shard in shards
+                                for key, (timestamp, _, _) in self.shards[shard].items())
+                num_to_drop = len(oldest) - int(len(oldest) * self.max_size_bytes / size)
+                for _, shard, key in oldest[:num_to_drop]:
+                    del self.shards[shard][key]
+                    changed.add(shard)
+                for shard in changed:
+                    self._rewrite_shard(shard)
+            logging.info("Response cache eviction rewrote %d shards", len(changed))
+
+    def close(self):
+        """ Writes new entries to disk, each shard's new entries as one more compressed member, then evicts. """
+        with self.lock:
+            for shard, lines in self.pending.items():
+                #Append the whole member with a single write, so that processes sharing the cache directory
+                #can't interleave their entries
+                with open(self._shard_path(shard), "ab") as shard_file:
+                    shard_file.write(gzip.compress(("\n".join(lines) + "\n").encode("utf-8")))
+            self.pending = {}
+        self.evict()
+
+def _execute_queries(customer_id: int, corpus_id: int, query_address: str, jwt_token: str, queries: [],
+                     concurrency: int = 1, max_qps: float = None, max_retries: int = 5, batch_size: int = 1,
+                     cache: ResponseCache = None, offline: bool = False, num_results: int = NUM_RESULTS):
+    """ Runs queries, optionally concurrently and in batches, and yields each result as soon as it arrives.
+
+    Args:
+        customer_id: Unique customer ID in vectara platform.
+        corpus_id: ID of the corpus that will be searched.
+        query_address: Address of the querying service. e.g., serving.vectara.io
+        jwt_token: A valid Auth token, or a TokenProvider that supplies one.
+        queries: Iterable of QueryRecord objects. It is consumed lazily, so it can be a generator.
+        concurrency: Maximum number of requests in flight at the same time. 1 runs the requests serially.
+        max_qps: Optional maximum number of requests sent per second.
+        max_retries: Maximum number of retries for each request if it is throttled or fails with a server error.
+        batch_size: Number of queries sent together in each request.
+        cache: Optional response cache. Queries found in it are not sent, and new results are added to it.
+        offline: If True then no requests are sent at all, and a query that isn't in the cache is an error.
+        num_results: Number of results to request for each query.
+
+    Returns:
+        Generator of (query, response_set, latency) tuples in the order the responses arrive. 'response_set' is
+        the entry of 'responseSet' in the query response for that query, or None if the query failed. 'latency' is
+        the time in seconds of the request that ran the query (shared by the queries of a batch), or None if the
+        query wasn't sent.
+
+    Raises:
+        ValueError: If 'offline' is set and a query isn't in the cache
+    """
+
+    rate_limiter = TokenBucket(max_qps) if max_qps else None
+    queries_iter = iter(queries)
+    batches = iter(lambda: list(itertools.islice(queries_iter, batch_size)), [])
+
+    with _get_http_session(concurrency) as session:
+        def run(batch):
+            results = []
+            to_send = batch
+            if cache is not None:
+                to_send = []
+                for this_query in batch:
+                    query_obj = _get_query_obj(customer_id, corpus_id, this_query.query, num_results,
+                                               this_query.overrides)
+                    with PROFILER.span("query.cache"):
+                        response_set = cache.get(query_address, customer_id, query_obj)
+                    if response_set is not None:
+                        results.append((this_query, response_set, None))
+                    elif offline:
+                        raise ValueError(f"Query {this_query.num} is not in the response cache {cache.cache_dir} with "
+                                         f"{query_obj['num_results']} or more results for {query_address}, so it "
+                                         f"can't be scored offline")
+                    else:
+                        to_send.append(this_query)
+
+            if to_send:
+                if rate_limiter is not None:
+                    with PROFILER.span("query.throttle"):
+                        rate_limiter.acquire()
+                start_time = time.perf_counter()
+                batch_results = _run_query_batch(customer_id, corpus_id, query_address, jwt_token, to_send, session,
+                                                 max_retries, num_results, rate_limiter)
+                latency = time.perf_counter() - start_time
+                for this_query, response_set in batch_results:
+                    if cache is not None and response_set is not None:
+                        cache.put(query_address, customer_id,
+                                  _get_query_obj(customer_id, corpus_id, this_query.query, num_results,
+                                                 this_query.overrides), response_set)
+                    results.append((this_query, response_set, latency))
+            return results
+
+        if concurrency <= 1:
+            for batch in batches:
+                yield from run(batch)
+            return
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+            #Only keep a small window of batches submitted ahead of the workers, so that a large query set
+            #isn't all queued up front
+            pending = {executor.submit(run, batch) for batch in itertools.islice(batches, 2 * concurrency)}
+            while pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    next_batch = next(batches, None)
+                    if next_batch is not None:
+                        pending.add(executor.submit(run, next_batch))
+                    yield from future.result()
+
 def strings_overlap(str1: str, str2: str):
     """ Determines whether two strings overlap (case insensitively)
 
@@ -276,305 +1640,2154 @@ def strings_overlap(str1: str, str2: str):
 
     return False
 
-def compute_metrics(num_matches_on_file_top_1:[[]], num_matches_on_file_top_3:[[]],
-                    num_matches_on_file_top_5:[[]], num_matches_on_file_top_10:[[]],
-                    num_matches_on_file_and_phrase_top_1:[], num_matches_on_file_and_phrase_top_3:[],
-                    num_matches_on_file_and_phrase_top_5:[], num_matches_on_file_and_phrase_top_10:[],
-                    first_matches_on_file: [], first_matches_on_file_and_phrase:[]):
-    """ Computes various metrics quantifying how this test run executed. Each input is an array that contains
-     raw data corresponding to one metric for each query. Each of these arrays have a length the same as the
-     total number of queries that were executed in the test.
-
-    Args:
-        num_matches_on_file_top_1: array of arrays of size 1 where each item is 0 if the corresponding
-            result number for that query was a match (based only on the file)
-        num_matches_on_file_top_3: array of arrays of size 3 where each item is 0 if the corresponding
-            result number for that query was a match (based only on the file)
-        num_matches_on_file_top_5: array of arrays of size 5 where each item is 0 if the corresponding
-            result number for that query was a match (based only on the file)
-        num_matches_on_file_top_10: array of arrays of size 10 where each item is 0 if the corresponding
-            result number for that query was a match (based only on the file)
-        num_matches_on_file_and_phrase_top_1: array of ints where each item is the number of results in
-            the top 1 for that query that represented a match (based on both the file and the phrase)
-        num_matches_on_file_and_phrase_top_3: array of ints where each item is the number of results in
-            the top 3 for that query that represented a match (based on both the file and the phrase)
-        num_matches_on_file_and_phrase_top_5: array of ints where each item is the number of results in
-            the top 5 for that query that represented a match (based on both the file and the phrase)
-        num_matches_on_file_and_phrase_top_10: array of ints where each item is the number of results in
-            the top 10 for that query that represented a match (based on both the file and the phrase)
-        first_matches_on_file: array of ints where each value is the result number where
-            that query's first match (based only on the file) was found
-        first_matches_on_file_and_phrase: array of ints where each value is the result number where
-            that query's first match (based on both the file and the phrase) was found
+def _normalize_text(text: str):
+    """ Returns text in lower case with runs of whitespace and punctuation replaced by a single space. """
+    return NON_WORD_PATTERN.sub(" ", text.lower()).strip()
+
+def _read_document_text(filepath: str, max_bytes: int = None):
+    """ Returns the text of one of a bundle's data files: the 'title' and 'text' fields of a JSON document, or else
+    the file decoded as UTF-8. Returns None for a PDF, whose text can't be extracted without a PDF library.
+
+    Args:
+        filepath: Path to the data file
+        max_bytes: Optional number of bytes at the start of the file to read. The text of a longer file is then
+            that of its complete lines, or of the complete 'title' and 'text' strings of a JSON document, within
+            those bytes.
+    """
+    with open(filepath, "rb") as file_handle:
+        data = file_handle.read() if max_bytes is None else file_handle.read(max_bytes + 1)
+    if data.startswith(b"%PDF"):
+        return None
+    if max_bytes is not None and len(data) > max_bytes:
+        text = data[:max_bytes].decode("utf-8", errors="replace")
+        if filepath.endswith(".json"):
+            #The document is cut off, so it can't be parsed: take the strings of the fields that are complete
+            try:
+                return "\n".join(json.loads(value, strict=False) for value in
+                                 re.findall(r'"(?:title|text)"\s*:\s*("(?:[^"\\]|\\.)*")', text))
+            except ValueError:
+                pass
+        #Leave out the last line, which may be cut off, unless it's the only one
+        return text[:text.rfind("\n") + 1] or text
+    if filepath.endswith(".json"):
+        try:
+            texts = []
+            stack = [json.loads(data)]
+            while stack:
+                item = stack.pop()
+                if isinstance(item, dict):
+                    texts.extend(item[key] for key in ("title", "text") if isinstance(item.get(key), str))
+                    stack.extend(reversed([value for value in item.values() if isinstance(value, (dict, list))]))
+                elif isinstance(item, list):
+                    stack.extend(reversed(item))
+            return "\n".join(texts)
+        except ValueError:
+            pass
+    return data.decode("utf-8", errors="replace")
+
+class DocumentIndex:
+    """ Local index of the normalized text of a bundle's data files, used to find where in its source file a result's
+    snippet and an expected phrase are, so that they can be compared by how much their spans overlap (the 'aligned'
+    phrase match mode).
+
+    The index is built once per bundle and kept in a directory: text.bin holds the normalized text (see
+    _normalize_text()) of every file one after the other, and index.json holds the content hash of each of the bundle's
+    files, the span of each file's text in text.bin by its file number prefix, and the offsets in text.bin of each
+    expected phrase of the bundle's queries. The index is rebuilt when a file is added, removed or changes hash.
+    text.bin is memory-mapped, so loading the index doesn't read the texts and locating a snippet is a search of
+    only its own file's span.
+    """
+
+    VERSION = 1
+
+    #Number of words at the start and end of a snippet used to locate it when the whole snippet isn't in its file
+    ANCHOR_WORDS = 6
+
+    def __init__(self, bundle_dir: str, index_dir: str):
+        """
+        Args:
+            bundle_dir: Directory of the bundle, with its 'data' directory and 'queries.csv' file
+            index_dir: Directory the index of the bundle is stored in. It is created if it doesn't exist.
+        """
+        self.index_dir = index_dir
+        os.makedirs(index_dir, exist_ok=True)
+        index_path = os.path.join(index_dir, "index.json")
+        text_path = os.path.join(index_dir, "text.bin")
+
+        filepaths = [os.path.join(subdir, file) for subdir, dirs, files in os.walk(bundle_dir + "/data")
+                     for file in files]
+        queries_file = bundle_dir + "/queries.csv"
+        if os.path.exists(queries_file):
+            filepaths.append(queries_file)
+
+        index = {}
+        if os.path.exists(index_path) and os.path.exists(text_path):
+            try:
+                with open(index_path) as index_file:
+                    index = json.load(index_file)
+            except (OSError, ValueError) as error:
+                logging.warning("Could not read the document index %s, so it is rebuilt: %s", index_path, error)
+        file_hashes = _get_file_hashes(filepaths, index.get("files"))
+        if index.get("version") != self.VERSION or \
+                {path: file["sha256"] for path, file in index.get("files", {}).items()} != \
+                {path: file["sha256"] for path, file in file_hashes.items()}:
+            index = self._build(file_hashes, queries_file, index_path, text_path)
+
+        self.docs = index["docs"]
+        self.phrases = {key: [tuple(span) for span in spans] for key, spans in index["phrases"].items()}
+        self.text_file = open(text_path, "rb")
+        #An empty file can't be memory-mapped
+        self.text = mmap.mmap(self.text_file.fileno(), 0, access=mmap.ACCESS_READ) \
+            if os.path.getsize(text_path) else b""
+        self.lock = threading.Lock()
+
+    def _build(self, file_hashes: {}, queries_file: str, index_path: str, text_path: str):
+        """ Extracts and normalizes the text of the bundle's files, finds the expected phrases of its queries in
+        them, and writes the index. Returns the contents of index.json. """
+        start_time = time.time()
+        docs = {}
+        texts = {}
+        no_text = []
+        offset = 0
+        with open(text_path + ".tmp", "wb") as text_file:
+            for filepath in sorted(file_hashes):
+                if filepath == queries_file:
+                    continue
+                text = _read_document_text(filepath)
+                if text is None:
+                    no_text.append(filepath)
+                    continue
+                file_num = os.path.basename(filepath).split('-')[0]
+                data = _normalize_text(text).encode("utf-8")
+                docs[file_num] = [offset, offset + len(data)]
+                texts[file_num] = (offset, data)
+                text_file.write(data + b"\n")
+                offset += len(data) + 1
+
+        phrases = {}
+        if os.path.exists(queries_file):
+            for this_query in _iter_queries(queries_file):
+                for file_num, phrase in this_query.matches:
+                    key = f"{file_num}@{_normalize_text(phrase)}"
+                    if key not in phrases and file_num in texts:
+                        phrases[key] = self._find_all(*texts[file_num], _normalize_text(phrase).encode("utf-8"))
+
+        index = {"version": self.VERSION, "files": file_hashes, "docs": docs, "phrases": phrases}
+        with open(index_path + ".tmp", "w") as index_file:
+            json.dump(index, index_file)
+        os.replace(text_path + ".tmp", text_path)
+        os.replace(index_path + ".tmp", index_path)
+        logging.info("Built the document index %s of %d files and %d phrases in %.1fs",
+                     self.index_dir, len(docs), len(phrases), time.time() - start_time)
+        if no_text:
+            logging.warning("No text could be extracted from %d files (e.g. %s), so their snippets are compared with "
+                            "the normalized phrase match mode instead", len(no_text), no_text[0])
+        return index
+
+    @staticmethod
+    def _find_all(offset: int, data: bytes, phrase: bytes):
+        """ Returns the (start, end) spans in text.bin of every occurrence of a phrase in a file's text, which starts
+        at 'offset' in text.bin. """
+        spans = []
+        start = data.find(phrase) if phrase else -1
+        while start != -1:
+            spans.append([offset + start, offset + start + len(phrase)])
+            start = data.find(phrase, start + 1)
+        return spans
+
+    def phrase_spans(self, file_num: str, phrase: str):
+        """ Returns the (start, end) spans of every occurrence of an expected phrase in a file, or an empty list if
+        it isn't in the file (or the file isn't in the index). """
+        key = f"{file_num}@{_normalize_text(phrase)}"
+        spans = self.phrases.get(key)
+        if spans is None:
+            #A phrase of a queries file other than the bundle's own, so it wasn't located when the index was built
+            doc = self.docs.get(file_num)
+            spans = []
+            if doc is not None:
+                spans = [tuple(span) for span in self._find_all(doc[0], self.text[doc[0]:doc[1]],
+                                                                 _normalize_text(phrase).encode("utf-8"))]
+            with self.lock:
+                self.phrases[key] = spans
+        return spans
+
+    def locate(self, file_num: str, snippet: str):
+        """ Returns the (start, end) span of a result's snippet in its file, or None if it can't be found there.
+        A snippet that isn't in the file as a whole (e.g. because it was cut off or highlighted) is located by the
+        words at its start and end. """
+        doc = self.docs.get(file_num)
+        if doc is None or snippet is None:
+            return None
+        data = _normalize_text(snippet).encode("utf-8")
+        if not data:
+            return None
+        start = self.text.find(data, doc[0], doc[1])
+        if start != -1:
+            return start, start + len(data)
+
+        words = data.split()
+        if len(words) < 2 * self.ANCHOR_WORDS:
+            return None
+        head = b" ".join(words[:self.ANCHOR_WORDS])
+        tail = b" ".join(words[-self.ANCHOR_WORDS:])
+        start = self.text.find(head, doc[0], doc[1])
+        end = self.text.find(tail, start if start != -1 else doc[0], doc[1])
+        if end != -1:
+            end += len(tail)
+        if start != -1 and end != -1:
+            return start, end
+        if start != -1:
+            return start, min(start + len(data), doc[1])
+        if end != -1:
+            return max(end - len(data), doc[0]), end
+        return None
+
+    def close(self):
+        if isinstance(self.text, mmap.mmap):
+            self.text.close()
+        self.text_file.close()
+
+#Ways of comparing a result's snippet with an expected phrase (see PhraseMatcher)
+PHRASE_MATCH_MODES = ("exact", "normalized", "fuzzy", "aligned")
+
+class PhraseMatcher:
+    """ Finds which of a query's expected phrases overlap a result's snippet.
+
+    The phrases are normalized once per query and each snippet is normalized once, however many phrases it is
+    compared with. The modes are:
+        exact: case-insensitive, a phrase matches if either the phrase or the snippet contains the other
+            (the same as strings_overlap()).
+        normalized: like exact, but runs of whitespace and punctuation are treated as a single space.
+        fuzzy: like normalized, but a phrase also matches if a contiguous run of at least 'fuzzy_threshold' of its
+            words appears in the snippet, which catches phrases that are cut off at the start or end of a snippet.
+        aligned: the snippet and the phrase are located in the source file of the result (see DocumentIndex), and
+            the phrase matches if at least 'overlap_threshold' of its span is covered by the snippet's span, so a
+            snippet that only overlaps one end of the phrase can match. If either can't be located in the file, it
+            falls back to normalized.
+    """
 
+    def __init__(self, phrases: [str], mode: str = "exact", fuzzy_threshold: float = 0.6, file_nums: [str] = None,
+                 doc_index: DocumentIndex = None, overlap_threshold: float = 0.5):
+        """
+        Args:
+            phrases: The expected phrases of the query
+            mode: One of PHRASE_MATCH_MODES
+            fuzzy_threshold: Fraction of a phrase's words that must appear in a row for a fuzzy match
+            file_nums: For the aligned mode, the file number of each phrase
+            doc_index: For the aligned mode, the DocumentIndex of the bundle
+            overlap_threshold: Fraction of a phrase's span that the snippet must cover for an aligned match
+        """
+        if mode not in PHRASE_MATCH_MODES:
+            raise ValueError(f"Unknown phrase match mode {mode}, expected one of {PHRASE_MATCH_MODES}")
+        if mode == "aligned" and (doc_index is None or file_nums is None):
+            raise ValueError("The aligned phrase match mode needs a document index and the file of each phrase")
+        self.mode = mode
+        self.fuzzy_threshold = fuzzy_threshold
+        self.file_nums = file_nums
+        self.doc_index = doc_index
+        self.overlap_threshold = overlap_threshold
+        self.raw_phrases = phrases
+        self.phrases = [self._normalize(phrase) for phrase in phrases]
+        self.phrase_words = [phrase.split() for phrase in self.phrases]
+
+    def _normalize(self, text: str):
+        if self.mode != "exact":
+            return _normalize_text(text)
+        return text.lower()
+
+    def _longest_common_run(self, phrase_words: [str], snippet_words: [str]):
+        """ Returns the length of the longest run of consecutive words that is in both lists. """
+        longest = 0
+        previous = [0] * (len(snippet_words) + 1)
+        for phrase_word in phrase_words:
+            current = [0] * (len(snippet_words) + 1)
+            for i, snippet_word in enumerate(snippet_words):
+                if phrase_word == snippet_word:
+                    current[i + 1] = previous[i] + 1
+                    longest = max(longest, current[i + 1])
+            previous = current
+        return longest
+
+    def _aligned_matches(self, snippet: str, file_num: str):
+        """ Returns the set of indexes of the phrases of file 'file_num' whose span the snippet's span covers enough
+        of. Phrases that can't be located fall back to a normalized comparison. """
+        snippet_span = self.doc_index.locate(file_num, snippet)
+        text = None
+        found = set()
+        for phrase_idx, phrase in enumerate(self.phrases):
+            if self.file_nums[phrase_idx] != file_num:
+                continue
+            phrase_spans = self.doc_index.phrase_spans(file_num, self.raw_phrases[phrase_idx]) \
+                if snippet_span is not None else []
+            if phrase_spans:
+                start, end = snippet_span
+                if any(min(end, phrase_end) - max(start, phrase_start) >=
+                       self.overlap_threshold * (phrase_end - phrase_start)
+                       for phrase_start, phrase_end in phrase_spans):
+                    found.add(phrase_idx)
+            else:
+                text = text if text is not None else self._normalize(snippet)
+                if phrase in text or text in phrase:
+                    found.add(phrase_idx)
+        return found
+
+    def matches(self, snippet: str, file_num: str = None):
+        """ Returns the set of indexes of the phrases that overlap the snippet. In the aligned mode only the phrases
+        of the snippet's file 'file_num' are compared with it. """
+        if snippet is None:
+            return set()
+        if self.mode == "aligned":
+            return self._aligned_matches(snippet, file_num)
+        text = self._normalize(snippet)
+        found = {phrase_idx for phrase_idx, phrase in enumerate(self.phrases) if phrase in text or text in phrase}
+
+        if self.mode == "fuzzy" and len(found) < len(self.phrases):
+            snippet_words = text.split()
+            for phrase_idx, phrase_words in enumerate(self.phrase_words):
+                if phrase_idx not in found and phrase_words and \
+                        self._longest_common_run(phrase_words, snippet_words) >= \
+                        self.fuzzy_threshold * len(phrase_words):
+                    found.add(phrase_idx)
+        return found
+
+def _per_query_metrics(relevance: np.ndarray, match_ranks: np.ndarray, num_expected: np.ndarray,
+                       k_values: [int] = DEFAULT_K_VALUES):
+    """ Computes the value of every metric for each query, in vectorized passes over the relevance matrix.
+    See compute_metrics() for the arguments and for a description of the metrics.
 
     Returns:
-        Dict where each item represents a metric type and its corresponding value
+        Dict from metric name to an array with the value of that metric for each query
     """
 
-    metrics = {}
-
-    """
-    print('num_matches_on_file_top_1=' + str(num_matches_on_file_top_1))
-    print('num_matches_on_file_top_3=' + str(num_matches_on_file_top_3))
-    print('num_matches_on_file_top_5=' + str(num_matches_on_file_top_5))
-    print('num_matches_on_file_top_10=' + str(num_matches_on_file_top_10))
-    print('num_matches_on_file_and_phrase_top_1=' + str(num_matches_on_file_and_phrase_top_1))
-    print('num_matches_on_file_and_phrase_top_3=' + str(num_matches_on_file_and_phrase_top_3))
-    print('num_matches_on_file_and_phrase_top_5=' + str(num_matches_on_file_and_phrase_top_5))
-    print('num_matches_on_file_and_phrase_top_10=' + str(num_matches_on_file_and_phrase_top_10))
-    print('first_matches_on_file=' + str(first_matches_on_file))
-    print('first_matches_on_file_and_phrase=' + str(first_matches_on_file_and_phrase))
-    """
-
-    #Relevance @ K metrics for matches based only on identifying the target file.
-    #Each of these metrics is the mean, across all test queries, of how many results in the top K represent
-    #a relevant match. For example, file_match_mean_r_at_5=.6 indicates that across all test queries, the average
-    #number of relevant matches within the first 5 search results was 3 (i.e. 60% of the top 5 results were relevant).
-    metrics["file_match_mean_r_at_1"] = \
-        sum(map(lambda n: sum(n) / 1, num_matches_on_file_top_1)) / len(num_matches_on_file_top_1)
-    metrics["file_match_mean_r_at_3"] = \
-        sum(map(lambda n: sum(n) / 3, num_matches_on_file_top_3)) / len(num_matches_on_file_top_3)
-    metrics["file_match_mean_r_at_5"] = \
-        sum(map(lambda n: sum(n) / 5, num_matches_on_file_top_5)) / len(num_matches_on_file_top_5)
-    metrics["file_match_mean_r_at_10"] = \
-        sum(map(lambda n: sum(n) / 10, num_matches_on_file_top_10)) / len(num_matches_on_file_top_10)
-
-    #Relevance @ K metrics for matches based on identifying the target file and also the relevant phrase.
-    #Each of these metrics is the mean, across all test queries, of how many results in the top K represent a relevant
-    #match. For example, file_and_phrase_match_mean_r_at_10=.4 indicates that across all test queries, the average
-    #number of relevant matches within the first 10 search results was 4 (i.e. 40% of the top 10 results were relevant).
-    metrics["file_and_phrase_match_mean_r_at_1"] = \
-        sum(map(lambda n: n / 1, num_matches_on_file_and_phrase_top_1)) / len(num_matches_on_file_and_phrase_top_1)
-    metrics["file_and_phrase_match_mean_r_at_3"] = \
-        sum(map(lambda n: n / 3, num_matches_on_file_and_phrase_top_3)) / len(num_matches_on_file_and_phrase_top_3)
-    metrics["file_and_phrase_match_mean_r_at_5"] = \
-        sum(map(lambda n: n / 5, num_matches_on_file_and_phrase_top_5)) / len(num_matches_on_file_and_phrase_top_5)
-    metrics["file_and_phrase_match_mean_r_at_10"] = \
-        sum(map(lambda n: n / 10, num_matches_on_file_and_phrase_top_10)) / len(num_matches_on_file_and_phrase_top_10)
-
-    #Percent first match metrics give the percentage of queries that had their first relevant match within the top K results.
-    #For example, file_match_percent_first_match_in_top_5=.8 means that 80% of the queries had the first relevant match
-    #(when considering only the target file), show up within the first 5 results.
-    #For example, file_and_phrase_match_percent_first_match_in_top_10=.7 means that 70% of the queries had the first
-    #relevant match (when considering both the target file and matching phrase), show up within the first 10 results.
-    metrics["file_match_percent_first_match_in_top_1"] = \
-        len([x for x in first_matches_on_file if 1<=x<=1]) / len(first_matches_on_file)
-    metrics["file_match_percent_first_match_in_top_3"] = \
-        len([x for x in first_matches_on_file if 1<=x<=3]) / len(first_matches_on_file)
-    metrics["file_match_percent_first_match_in_top_5"] = \
-        len([x for x in first_matches_on_file if 1<=x<=5]) / len(first_matches_on_file)
-    metrics["file_match_percent_first_match_in_top_10"] = \
-        len([x for x in first_matches_on_file if 1<=x<=10]) / len(first_matches_on_file)
-    metrics["file_and_phrase_match_percent_first_match_in_top_1"] = \
-        len([x for x in first_matches_on_file_and_phrase if 1<=x<=1]) / len(first_matches_on_file_and_phrase)
-    metrics["file_and_phrase_match_percent_first_match_in_top_3"] = \
-        len([x for x in first_matches_on_file_and_phrase if 1<=x<=3]) / len(first_matches_on_file_and_phrase)
-    metrics["file_and_phrase_match_percent_first_match_in_top_5"] = \
-        len([x for x in first_matches_on_file_and_phrase if 1<=x<=5]) / len(first_matches_on_file_and_phrase)
-    metrics["file_and_phrase_match_percent_first_match_in_top_10"] = \
-        len([x for x in first_matches_on_file_and_phrase if 1<=x<=10]) / len(first_matches_on_file_and_phrase)
+    values = {}
+    num_queries, depth = relevance.shape[1], relevance.shape[2]
+    #Only the first max_k results are needed for the @K metrics
+    max_k = min(max(k_values), depth)
+    discounts = 1 / np.log2(np.arange(2, max_k + 2))
+    cumulative_discounts = np.concatenate(([0.0], np.cumsum(discounts)))
+    layers = ((FILE_LAYER, "file_match"), (FILE_AND_PHRASE_LAYER, "file_and_phrase_match"))
+
+    hits = relevance > 0
+    has_hit = hits.any(axis=2)
+    #Rank of the first relevant result of each query (0 if there wasn't one)
+    first_ranks = np.where(has_hit, hits.argmax(axis=2) + 1, 0)
+    #Number of relevant results (counting multiple phrase matches in the same result) within the top r
+    cumulative_relevance = np.cumsum(relevance[:, :, :max_k], axis=2)
+
+    #Relevance @ K metrics. For example, file_match_mean_r_at_5=.6 indicates that across all test queries, the average
+    #number of relevant matches (based only on identifying the target file) within the first 5 search results was 3.
+    #For the file and phrase layer a result counts once for each expected phrase that it matches.
+    for layer, prefix in layers:
+        for k in k_values:
+            values[f"{prefix}_mean_r_at_{k}"] = cumulative_relevance[layer, :, min(k, depth) - 1] / k
+
+    #Percent first match metrics give the percentage of queries that had their first relevant match within the
+    #top K results.
+    for layer, prefix in layers:
+        for k in k_values:
+            values[f"{prefix}_percent_first_match_in_top_{k}"] = \
+                ((first_ranks[layer] >= 1) & (first_ranks[layer] <= k)).astype(np.float64)
 
     #Mean Reciprocal Rank metrics. The reciprocal rank of a query response is the multiplicative inverse of the rank
-    #of the first correct answer: 1 for first place, 1⁄2 for second place, 1⁄3 for third place and so on.
-    #The mean reciprocal rank is the average of the reciprocal ranks of results for across all test queries.
-    metrics["file_match_mean_reciprocal_rank"] = \
-        sum(map(lambda n: 1 / n, first_matches_on_file)) / len(first_matches_on_file)
-    metrics["file_match_and_phrase_mean_reciprocal_rank"] = \
-        sum(map(lambda n: 1 / n, first_matches_on_file_and_phrase)) / len(first_matches_on_file_and_phrase)
+    #of the first correct answer: 1 for first place, 1⁄2 for second place, 1⁄3 for third place and so on (and 0 if
+    #there was no correct answer).
+    reciprocal_ranks = np.divide(1, first_ranks, out=np.zeros(first_ranks.shape), where=first_ranks > 0)
+    values["file_match_mean_reciprocal_rank"] = reciprocal_ranks[FILE_LAYER]
+    values["file_match_and_phrase_mean_reciprocal_rank"] = reciprocal_ranks[FILE_AND_PHRASE_LAYER]
+
+    #Standard IR metrics, where every result that matches is relevant with a gain of 1. The number of relevant
+    #documents is the number of expected matches, or the number of relevant results found in the top K if that is
+    #larger (e.g. several results from an expected file). Results below the top K aren't counted, so that the
+    #metrics only depend on the ranking of the top K and not on how many results were requested.
+    top_hits = hits[:, :, :max_k]
+    cumulative_hits = np.cumsum(top_hits, axis=2)
+    for layer, prefix in layers:
+        #nDCG @ K: discounted cumulative gain of the top K, divided by the gain of an ideal ranking of the top K
+        gains = np.cumsum(top_hits[layer] * discounts, axis=1)
+        for k in k_values:
+            num_relevant = np.maximum(num_expected, cumulative_hits[layer, :, min(k, depth) - 1])
+            ideal = cumulative_discounts[np.minimum(num_relevant, min(k, depth))]
+            values[f"{prefix}_ndcg_at_{k}"] = \
+                np.divide(gains[:, min(k, depth) - 1], ideal, out=np.zeros(num_queries), where=ideal > 0)
+
+        #Recall @ K: the fraction of the expected matches that were found within the top K results
+        for k in k_values:
+            found = ((match_ranks[layer] >= 1) & (match_ranks[layer] <= k)).sum(axis=1)
+            values[f"{prefix}_recall_at_{k}"] = found / np.maximum(num_expected, 1)
+
+        #Average precision over the top max(K) results: the mean of the precision at the rank of each relevant
+        #result. Relevant results are sparse, so this only looks at their positions; nonzero() lists them row by
+        #row, so a hit's position among the hits of its row is its index minus the index of the row's first hit.
+        rows, cols = np.nonzero(top_hits[layer])
+        row_starts = np.concatenate(([0], np.cumsum(np.bincount(rows, minlength=num_queries))[:-1]))
+        precisions = (np.arange(len(rows)) - row_starts[rows] + 1) / (cols + 1)
+        num_relevant = np.maximum(num_expected, cumulative_hits[layer, :, -1])
+        values[f"{prefix}_mean_average_precision"] = \
+            np.bincount(rows, weights=precisions, minlength=num_queries) / np.maximum(num_relevant, 1)
+
+    return values
+
+def compute_metrics(relevance: np.ndarray, match_ranks: np.ndarray, num_expected: np.ndarray,
+                    k_values: [int] = DEFAULT_K_VALUES):
+    """ Computes various metrics quantifying how this test run executed, from the relevance matrix of the run.
+
+    Args:
+        relevance: Array of shape (2, number of queries, result depth). Layer FILE_LAYER has a 1 for each result
+            that is from one of the query's expected files (a match based only on the file). Layer
+            FILE_AND_PHRASE_LAYER has, for each result, the number of the query's expected matches it matches
+            based on both the file and the phrase. Rows of queries that failed are all 0.
+        match_ranks: Array of shape (2, number of queries, maximum number of expected matches of a query) with,
+            for each expected match of each query, the rank of the first result that matched it (based only on
+            the file for FILE_LAYER and on both the file and the phrase for FILE_AND_PHRASE_LAYER), or 0 if no
+            result matched it.
+        num_expected: Array with the number of expected matches of each query
+        k_values: The cut-offs (K) for which the @K metrics are computed
+
+    Returns:
+        Dict where each item represents a metric type and its corresponding value
+    """
+
+    accumulator = MetricAccumulator()
+    accumulator.add(_per_query_metrics(relevance, match_ranks, num_expected, k_values))
+    return accumulator.means()
 
+class MetricAccumulator:
+    """ Mergeable running totals of the per-query values of each metric, from which the metrics (the means over all
+    the queries) are computed.
+
+    The totals are exact: each value is added as an integer multiple of the smallest float (2^-1074), so the means
+    are correctly rounded and don't depend on the order in which queries are added or accumulators are merged.
+    Only the distinct values of each batch are converted, since most metrics only take a few distinct values.
+
+    The metrics of the original script (see LEGACY_METRIC_PATTERN) are the exception: their values are kept with the
+    number of their query, and their means are a float sum in order of query number divided by the number of
+    queries, exactly as the original script computed them, so that their values don't change in the last bit.
+    """
+
+    SCALE_BITS = 1074
+
+    def __init__(self):
+        #Metric name -> sum of its values, scaled by 2^SCALE_BITS
+        self.sums = {}
+        #Metric name -> list of (query numbers, values) arrays, for the metrics of the original script
+        self.ordered = {}
+        #Metric names in the order they were first added
+        self.names = {}
+        self.count = 0
+
+    def add(self, values: {}, query_nums: np.ndarray = None):
+        """ Adds the values of a batch of queries.
+        Args:
+            values: Dict from metric name to an array with the value of that metric for each query of the batch
+                (see _per_query_metrics())
+            query_nums: Optional array with the number of each query of the batch, which orders the sums of the
+                metrics of the original script. Defaults to the order in which queries are added.
+        """
+        num_queries = len(next(iter(values.values()))) if values else 0
+        #One copy of the query numbers is shared by all the metrics of the batch
+        query_nums = np.arange(self.count, self.count + num_queries) if query_nums is None else np.array(query_nums)
+        for name, metric_values in values.items():
+            self.names.setdefault(name)
+            if LEGACY_METRIC_PATTERN.search(name):
+                self.ordered.setdefault(name, []).append((query_nums, np.array(metric_values)))
+                continue
+            distinct, counts = np.unique(metric_values, return_counts=True)
+            total = 0
+            for value, count in zip(distinct.tolist(), counts.tolist()):
+                numerator, denominator = value.as_integer_ratio()
+                total += count * numerator * ((1 << self.SCALE_BITS) // denominator)
+            self.sums[name] = self.sums.get(name, 0) + total
+        self.count += num_queries
+
+    def merge(self, other: "MetricAccumulator"):
+        """ Adds the totals of another accumulator to this one. """
+        for name in other.names:
+            self.names.setdefault(name)
+        for name, total in other.sums.items():
+            self.sums[name] = self.sums.get(name, 0) + total
+        for name, chunks in other.ordered.items():
+            self.ordered.setdefault(name, []).extend(chunks)
+        self.count += other.count
+
+    def means(self):
+        """ Returns a dict from metric name to its mean over all the queries that were added, in the order the
+        metrics were added. """
+        means = {}
+        for name in self.names:
+            if name in self.ordered:
+                query_nums = np.concatenate([chunk_nums for chunk_nums, _ in self.ordered[name]])
+                values = np.concatenate([chunk_values for _, chunk_values in self.ordered[name]])
+                #A sequential float sum in order of query number, as the original script did
+                means[name] = sum(values[np.argsort(query_nums, kind="stable")].tolist()) / self.count
+            else:
+                means[name] = float(fractions.Fraction(self.sums[name], self.count << self.SCALE_BITS))
+        return means
+
+class RelevanceBlocks:
+    """ Relevance rows and ranks of the expected matches (see compute_metrics()) for a block of queries at a time.
+
+    Rows are handed out in the order the queries are scored, and each full block is scored and added to a
+    MetricAccumulator, so memory doesn't grow with the number of queries and query numbers don't index the rows.
+    """
+
+    def __init__(self, k_values: [int] = DEFAULT_K_VALUES, depth: int = NUM_RESULTS,
+                 block_size: int = METRICS_BLOCK_SIZE, keep_values: bool = False):
+        """
+        Args:
+            k_values: The cut-offs (K) for which the @K metrics are computed
+            depth: Number of results of each query that are scored
+            block_size: Number of queries scored together
+            keep_values: Whether to keep the value of every metric for every query (see values()), e.g. for
+                bootstrap_confidence_intervals()
+        """
+        self.k_values = k_values
+        self.accumulator = MetricAccumulator()
+        self.kept_values = [] if keep_values else None
+        self.relevance = np.zeros((2, block_size, depth), dtype=np.int32)
+        self.match_ranks = np.zeros((2, block_size, 1), dtype=np.int32)
+        self.num_expected = np.zeros(block_size, dtype=np.int64)
+        self.query_nums = np.zeros(block_size, dtype=np.int64)
+        self.added = 0
+        self.rows = 0
+
+    def new_row(self, num_expected: int, query_num: int = None):
+        """ Returns the index of an all-0 row for the next query, which has 'num_expected' expected matches.
+        'query_num' is the number of the query, which orders the sums of the metrics of the original script (see
+        MetricAccumulator); it defaults to the order in which rows are handed out. """
+        if self.rows == len(self.num_expected):
+            self._score_block()
+        if num_expected > self.match_ranks.shape[2]:
+            self.match_ranks = np.pad(self.match_ranks,
+                                      ((0, 0), (0, 0), (0, num_expected - self.match_ranks.shape[2])))
+        self.num_expected[self.rows] = num_expected
+        self.query_nums[self.rows] = self.added if query_num is None else query_num
+        self.added += 1
+        self.rows += 1
+        return self.rows - 1
+
+    def _score_block(self):
+        rows = self.rows
+        with PROFILER.span("metrics.score", queries=rows):
+            values = _per_query_metrics(self.relevance[:, :rows], self.match_ranks[:, :rows],
+                                        self.num_expected[:rows], self.k_values)
+            self.accumulator.add(values, self.query_nums[:rows])
+        if self.kept_values is not None:
+            self.kept_values.append(values)
+        self.relevance.fill(0)
+        self.match_ranks.fill(0)
+        self.rows = 0
+
+    def finish(self):
+        """ Scores the last (partial) block and returns the accumulator with the metrics of all the queries. """
+        if self.rows > 0:
+            self._score_block()
+        return self.accumulator
+
+    def values(self):
+        """ Returns a dict from metric name to an array with its value for each query, in the order the rows were
+        handed out. Only available with keep_values, after finish(). """
+        if not self.kept_values:
+            return {}
+        return {name: np.concatenate([values[name] for values in self.kept_values]) for name in self.kept_values[0]}
+
+def _resample_chunks(num_queries: int, num_resamples: int, chunk_elements: int):
+    """ Yields the sizes of the chunks that resamples are drawn in, so that a chunk has about chunk_elements
+    (resample, query) entries. """
+    chunk_size = max(1, min(num_resamples, chunk_elements // max(num_queries, 1)))
+    for start in range(0, num_resamples, chunk_size):
+        yield min(chunk_size, num_resamples - start)
+
+def bootstrap_confidence_intervals(values: {}, num_resamples: int = 10000, confidence: float = 0.95,
+                                   seed: int = None, chunk_elements: int = 1 << 22):
+    """ Computes percentile bootstrap confidence intervals for the mean of every metric.
+
+    Resamples are drawn a chunk at a time: the queries drawn for each resample of the chunk are counted into a
+    (resamples × queries) matrix with a single bincount, and the means of every metric in every resample of the chunk
+    are then one matrix product of the counts with the (queries × metrics) matrix of per-query values.
+
+    Args:
+        values: Dict from metric name to an array with the value of that metric for each query
+            (see _per_query_metrics()). The result only depends on the order of the queries through the random draws,
+            so for reproducible intervals the queries should be in a fixed order, e.g. by query number.
+        num_resamples: Number of bootstrap resamples
+        confidence: Confidence level of the intervals
+        seed: Optional seed of the random draws, for reproducible intervals
+        chunk_elements: Approximate number of (resample, query) entries drawn at a time, which bounds the memory used
+
+    Returns:
+        Dict from metric name to its [lower bound, upper bound]
+    """
+    names = list(values)
+    matrix = np.column_stack([np.asarray(values[name], dtype=np.float64) for name in names])
+    num_queries = len(matrix)
+    rng = np.random.default_rng(seed)
+    means = np.empty((num_resamples, len(names)))
+    start = 0
+    for size in _resample_chunks(num_queries, num_resamples, chunk_elements):
+        draws = rng.integers(0, num_queries, (size, num_queries)) + np.arange(size)[:, np.newaxis] * num_queries
+        counts = np.bincount(draws.ravel(), minlength=size * num_queries).reshape(size, num_queries)
+        means[start:start + size] = counts.astype(np.float64) @ matrix / num_queries
+        start += size
+    tail = (1 - confidence) / 2
+    lower, upper = np.quantile(means, [tail, 1 - tail], axis=0)
+    return {name: [float(lower[idx]), float(upper[idx])] for idx, name in enumerate(names)}
+
+def paired_randomization_test(values_a: {}, values_b: {}, num_resamples: int = 10000, seed: int = None,
+                              chunk_elements: int = 1 << 22):
+    """ Computes the two-sided p-value of a paired randomization (sign-flip) test of whether the means of each metric
+    differ between two runs over the same queries.
+
+    Under the null hypothesis the two runs' values of a query are exchangeable, so the sign of the difference of each
+    query is flipped at random. As in bootstrap_confidence_intervals(), a chunk of resamples is drawn as a
+    (resamples × queries) matrix of signs, and the mean differences of every metric are one matrix product.
+
+    Args:
+        values_a: Dict from metric name to an array with the value of that metric for each query in one run
+        values_b: The same for the other run, with the queries in the same order
+        num_resamples: Number of random sign flips
+        seed: Optional seed of the random flips, for reproducible p-values
+        chunk_elements: Approximate number of (resample, query) entries drawn at a time, which bounds the memory used
+
+    Returns:
+        Dict from metric name (of the metrics in both runs) to its p-value
+    """
+    names = [name for name in values_a if name in values_b]
+    differences = np.column_stack([np.asarray(values_a[name], dtype=np.float64) -
+                                   np.asarray(values_b[name], dtype=np.float64) for name in names])
+    num_queries = len(differences)
+    observed = np.abs(differences.mean(axis=0))
+    #Differences that are equal in exact arithmetic can differ in the last bits after summing in another order
+    tolerance = 1e-12 * np.maximum(np.abs(differences).sum(axis=0) / max(num_queries, 1), 1e-300)
+    rng = np.random.default_rng(seed)
+    at_least_as_extreme = np.zeros(len(names), dtype=np.int64)
+    for size in _resample_chunks(num_queries, num_resamples, chunk_elements):
+        signs = rng.integers(0, 2, (size, num_queries)).astype(np.float64) * 2 - 1
+        means = np.abs(signs @ differences / num_queries)
+        at_least_as_extreme += (means >= observed - tolerance).sum(axis=0)
+    p_values = (at_least_as_extreme + 1) / (num_resamples + 1)
+    return {name: float(p_values[idx]) for idx, name in enumerate(names)}
+
+def _get_query_shard(query_num, num_shards: int):
+    """ Returns the shard (from 0 to num_shards - 1) that a query belongs to. It only depends on the query number,
+    so every worker assigns the queries the same way whatever the order of the queries file. """
+    digest = hashlib.sha256(str(query_num).encode()).digest()
+    return int.from_bytes(digest[:8], "big") % num_shards
+
+class PartialResultWriter:
+    """ Writes the raw match data of each query of a shard to a partial result file, which merge_partial_results()
+    combines with the partial results of the other shards.
+
+    The file is gzip-compressed JSONL. The first line describes the run (bundle, shard, depth, K values), and each
+    other line holds one query: its number, its number of expected matches, whether it failed, the ranks and values
+    of its nonzero relevance entries, and the ranks of its expected matches.
+    """
+
+    def __init__(self, path: str, header: {}):
+        """
+        Args:
+            path: Path of the partial result file
+            header: Description of the run, written as the first line
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.file = gzip.open(path, "wt")
+        self.file.write(json.dumps(header) + "\n")
+
+    def write(self, query_num, num_expected: int, failed: bool, relevance: np.ndarray, match_ranks: np.ndarray):
+        """ Writes one query.
+        Args:
+            query_num: Number of the query
+            num_expected: Number of expected matches of the query
+            failed: Whether the query failed
+            relevance: The query's relevance rows, of shape (2, depth)
+            match_ranks: The query's match ranks, of shape (2, at least num_expected)
+        """
+        ranks = np.flatnonzero(relevance.any(axis=0))
+        self.file.write(json.dumps({
+            "num": query_num,
+            "expected": num_expected,
+            "failed": failed,
+            "relevance": [ranks.tolist(), relevance[FILE_LAYER, ranks].tolist(),
+                          relevance[FILE_AND_PHRASE_LAYER, ranks].tolist()],
+            "match_ranks": match_ranks[:, :num_expected].tolist(),
+        }) + "\n")
+
+    def close(self):
+        self.file.close()
+
+def merge_partial_results(partial_paths: [str], k_values: [int] = None):
+    """ Combines the partial results of the shards of a run into the metrics of the whole run. These are exactly the
+    metrics that the run would have had without sharding.
+
+    Args:
+        partial_paths: Paths of the partial result files (see PartialResultWriter), one for each shard
+        k_values: The cut-offs (K) for which the @K metrics are computed. Defaults to those of the run.
+
+    Returns:
+        Dict with the metrics, plus 'shards' with the number of queries and failed queries of each shard
+
+    Raises:
+        ValueError: If the partial results are not from the same run, or a shard is missing or given twice
+    """
+    headers = []
+    for path in partial_paths:
+        with gzip.open(path, "rt") as partial_file:
+            headers.append(json.loads(partial_file.readline()))
+
+    run = {key: value for key, value in headers[0].items() if key != "shard"}
+    for path, header in zip(partial_paths, headers):
+        if {key: value for key, value in header.items() if key != "shard"} != run:
+            raise ValueError(f"{path} is not a partial result of the same run as {partial_paths[0]}")
+    shards = sorted(header["shard"] for header in headers)
+    if shards != list(range(run["num_shards"])):
+        raise ValueError(f"Expected one partial result for each of the {run['num_shards']} shards but got shards "
+                         f"{shards}")
+
+    blocks = RelevanceBlocks(k_values if k_values is not None else run["k_values"], run["depth"])
+    shard_counts = {}
+    for path, header in zip(partial_paths, headers):
+        counts = {"queries": 0, "failed": 0}
+        with gzip.open(path, "rt") as partial_file:
+            partial_file.readline()
+            for line in partial_file:
+                query = json.loads(line)
+                row = blocks.new_row(query["expected"], query["num"])
+                ranks, file_values, phrase_values = query["relevance"]
+                blocks.relevance[FILE_LAYER, row, ranks] = file_values
+                blocks.relevance[FILE_AND_PHRASE_LAYER, row, ranks] = phrase_values
+                blocks.match_ranks[:, row, :query["expected"]] = np.array(query["match_ranks"]).reshape(2, -1)
+                counts["queries"] += 1
+                counts["failed"] += query["failed"]
+        shard_counts[header["shard"]] = counts
+
+    accumulator = blocks.finish()
+    if accumulator.count == 0:
+        return {"no_queries_found_in": run["queries_file"]}
+    metrics = accumulator.means()
+    metrics["shards"] = {f"{shard}/{run['num_shards']}": shard_counts[shard] for shard in shards}
     return metrics
 
-def run_queries(customer_id: int, corpus_id: int, query_address: str, jwt_token: str, queries_file: str):
+def _reciprocal_rank(rank: int):
+    return 1 / rank if rank else 0.0
+
+class RunHistory:
+    """ Local SQLite store of the per-query outcomes of evaluation runs, so that any two runs can be compared query by
+    query (see compare()).
+
+    The 'runs' table has one row for each run: its bundle, corpus, start and finish times, settings and metrics, and
+    is indexed by bundle and by corpus. The 'query_results' table has one row for each query of each run: whether it
+    failed, its latency, the rank of its first result from an expected file and of its first result that also
+    matched an expected phrase, the ranks at which each expected match was found, and its nonzero relevance entries
+    (as in PartialResultWriter), from which its metrics can be computed again. Its primary key is (run, query)
+    and it is also indexed by query, so comparing two runs is a join on the key whatever the number of runs stored.
+    The text of each bundle's queries is stored once, in the 'queries' table. The database is in WAL mode, so the
+    processes of a multi-bundle run can record their runs at the same time.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS runs (
+            run_id INTEGER PRIMARY KEY,
+            bundle TEXT NOT NULL,
+            corpus_id INTEGER,
+            started_at TEXT NOT NULL,
+            finished_at TEXT,
+            config TEXT NOT NULL,
+            metrics TEXT);
+        CREATE INDEX IF NOT EXISTS runs_by_bundle ON runs (bundle, corpus_id, run_id);
+        CREATE INDEX IF NOT EXISTS runs_by_corpus ON runs (corpus_id, run_id);
+        CREATE TABLE IF NOT EXISTS query_results (
+            run_id INTEGER NOT NULL REFERENCES runs (run_id),
+            query_num INTEGER NOT NULL,
+            num_expected INTEGER NOT NULL,
+            failed INTEGER NOT NULL,
+            latency_ms REAL,
+            file_rank INTEGER NOT NULL,
+            phrase_rank INTEGER NOT NULL,
+            match_ranks TEXT NOT NULL,
+            relevance TEXT,
+            PRIMARY KEY (run_id, query_num)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS query_results_by_query ON query_results (query_num, run_id);
+        CREATE TABLE IF NOT EXISTS queries (
+            bundle TEXT NOT NULL,
+            query_num INTEGER NOT NULL,
+            query TEXT NOT NULL,
+            PRIMARY KEY (bundle, query_num)) WITHOUT ROWID;
+    """
+
+    #Number of query rows written to the database at a time
+    FLUSH_ROWS = 1000
+
+    def __init__(self, path: str = DEFAULT_HISTORY_PATH):
+        """
+        Args:
+            path: Path of the database. It is created if it doesn't exist.
+        """
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.connection = sqlite3.connect(path, timeout=60)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(self.SCHEMA)
+        self.rows = []
+        self.query_texts = []
+
+    def start_run(self, bundle: str, corpus_id: int, config: {}):
+        """ Records the start of a run and returns its run ID. The run only counts as recorded once finish_run() is
+        called. """
+        with self.connection:
+            cursor = self.connection.execute(
+                "INSERT INTO runs (bundle, corpus_id, started_at, config) VALUES (?, ?, ?, ?)",
+                (bundle, corpus_id, datetime.datetime.now().isoformat(timespec="seconds"),
+                 json.dumps(config, sort_keys=True)))
+        return cursor.lastrowid
+
+    def add_query(self, run_id: int, bundle: str, this_query: QueryRecord, failed: bool, latency: float,
+                  relevance: np.ndarray, match_ranks: np.ndarray):
+        """ Records the outcome of one query of a run. Rows are buffered and written FLUSH_ROWS at a time.
+        Args:
+            run_id: ID of the run (see start_run())
+            bundle: Which test bundle the query is from
+            this_query: The QueryRecord of the query
+            failed: Whether the query failed
+            latency: Time in seconds of the query's request, or None if it wasn't sent
+            relevance: The query's relevance rows, of shape (2, depth)
+            match_ranks: The query's match ranks, of shape (2, at least the number of expected matches)
+        """
+        first_ranks = [int(np.argmax(row)) + 1 if row.any() else 0 for row in relevance]
+        num_expected = len(this_query.matches)
+        ranks = np.flatnonzero(relevance.any(axis=0))
+        self.rows.append((run_id, this_query.num, num_expected, failed,
+                          latency * 1000 if latency is not None else None,
+                          first_ranks[FILE_LAYER], first_ranks[FILE_AND_PHRASE_LAYER],
+                          json.dumps(match_ranks[:, :num_expected].tolist()),
+                          json.dumps([ranks.tolist(), relevance[FILE_LAYER, ranks].tolist(),
+                                      relevance[FILE_AND_PHRASE_LAYER, ranks].tolist()])))
+        self.query_texts.append((bundle, this_query.num, this_query.query))
+        if len(self.rows) >= self.FLUSH_ROWS:
+            self._flush()
+
+    def _flush(self):
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO query_results (run_id, query_num, num_expected, failed, latency_ms, file_rank, "
+                "phrase_rank, match_ranks, relevance) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", self.rows)
+            self.connection.executemany("INSERT OR REPLACE INTO queries VALUES (?, ?, ?)", self.query_texts)
+        self.rows = []
+        self.query_texts = []
+
+    def finish_run(self, run_id: int, metrics: {}):
+        """ Writes the remaining query rows and the metrics of a run, and marks it as finished. """
+        self._flush()
+        with self.connection:
+            self.connection.execute("UPDATE runs SET finished_at = ?, metrics = ? WHERE run_id = ?",
+                                    (datetime.datetime.now().isoformat(timespec="seconds"), json.dumps(metrics),
+                                     run_id))
+
+    def get_run(self, run_id: int):
+        """ Returns a dict describing a finished run, or None if there is no such run. """
+        row = self.connection.execute(
+            "SELECT run_id, bundle, corpus_id, started_at, config, metrics FROM runs "
+            "WHERE run_id = ? AND finished_at IS NOT NULL", (run_id,)).fetchone()
+        if row is None:
+            return None
+        return {"run_id": row[0], "bundle": row[1], "corpus_id": row[2], "started_at": row[3],
+                "config": json.loads(row[4]), "metrics": json.loads(row[5])}
+
+    def latest_runs(self, bundle: str = None, limit: int = 2):
+        """ Returns the IDs of the latest finished runs (of a bundle, if given), the latest first. """
+        if bundle is None:
+            rows = self.connection.execute("SELECT run_id FROM runs WHERE finished_at IS NOT NULL "
+                                           "ORDER BY run_id DESC LIMIT ?", (limit,))
+        else:
+            rows = self.connection.execute("SELECT run_id FROM runs WHERE bundle = ? AND finished_at IS NOT NULL "
+                                           "ORDER BY run_id DESC LIMIT ?", (bundle, limit))
+        return [row[0] for row in rows]
+
+    def query_metrics(self, run_id: int, query_nums: [int], k_values: [int], depth: int):
+        """ Computes the value of every metric for some of the queries of a run, from their recorded relevance
+        entries (see _per_query_metrics()).
+
+        Args:
+            run_id: ID of the run
+            query_nums: Numbers of the queries, which must all be in the run
+            k_values: The cut-offs (K) for which the @K metrics are computed
+            depth: Number of results of each query that were scored
+
+        Returns:
+            Dict from metric name to an array with its value for each query, in the order of query_nums, or None if
+            the run's relevance entries weren't recorded
+        """
+        rows = {num: (num_expected, match_ranks, relevance) for num, num_expected, match_ranks, relevance in
+                self.connection.execute("SELECT query_num, num_expected, match_ranks, relevance FROM query_results "
+                                        "WHERE run_id = ?", (run_id,))}
+        max_expected = max([rows[num][0] for num in query_nums] + [1])
+        relevance = np.zeros((2, len(query_nums), depth), dtype=np.int32)
+        match_ranks = np.zeros((2, len(query_nums), max_expected), dtype=np.int32)
+        num_expected = np.zeros(len(query_nums), dtype=np.int64)
+        for row, num in enumerate(query_nums):
+            expected, query_match_ranks, query_relevance = rows[num]
+            if query_relevance is None:
+                return None
+            ranks, file_values, phrase_values = json.loads(query_relevance)
+            relevance[FILE_LAYER, row, ranks] = file_values
+            relevance[FILE_AND_PHRASE_LAYER, row, ranks] = phrase_values
+            match_ranks[:, row, :expected] = np.array(json.loads(query_match_ranks)).reshape(2, -1)
+            num_expected[row] = expected
+        return _per_query_metrics(relevance, match_ranks, num_expected, k_values)
+
+    @staticmethod
+    def _depth(config: {}):
+        """ Returns the number of results that each query of a run with these settings was scored over. """
+        return config.get("num_results") or max(config.get("k_values") or DEFAULT_K_VALUES)
+
+    def compare(self, baseline_id: int, run_id: int, num_resamples: int = 0, seed: int = None):
+        """ Compares the per-query outcomes of a run with those of a baseline run.
+
+        A query regressed if the reciprocal rank of its first file and phrase match went down, or if that stayed
+        the same and the reciprocal rank of its first file match went down (and the other way round for an
+        improvement). A query that failed in one of the runs counts as having no matches in it.
+
+        Args:
+            baseline_id: ID of the baseline run
+            run_id: ID of the run compared with it
+            num_resamples: If not 0, the change of each metric also gets the p-value of a paired randomization test
+                (see paired_randomization_test()) with this many resamples, over the queries that are in both runs
+            seed: Optional seed of the randomization test
+
+        Returns:
+            Dict with both runs (see get_run()), the settings that differ, the change of each metric (as
+            [baseline, run, change, p-value or None]), the number of queries that are unchanged or only in one of the
+            runs, and the lists of 'regressions' and 'improvements', each entry with the query's number and text and
+            its ranks, failure and latency in both runs, the biggest changes first.
+
+        Raises:
+            ValueError: If either run isn't in the history
+        """
+        runs = [self.get_run(baseline_id), self.get_run(run_id)]
+        for requested_id, run in zip((baseline_id, run_id), runs):
+            if run is None:
+                raise ValueError(f"Run {requested_id} is not in the run history {self.path}")
+        baseline, run = runs
+
+        changed = self.connection.execute("""
+            SELECT a.query_num, q.query, a.file_rank, b.file_rank, a.phrase_rank, b.phrase_rank, a.failed, b.failed,
+                   a.latency_ms, b.latency_ms
+            FROM query_results a
+            JOIN query_results b ON b.run_id = ? AND b.query_num = a.query_num
+            LEFT JOIN queries q ON q.bundle = ? AND q.query_num = a.query_num
+            WHERE a.run_id = ? AND (a.file_rank != b.file_rank OR a.phrase_rank != b.phrase_rank
+                                    OR a.failed != b.failed)""",
+            (run_id, run["bundle"], baseline_id)).fetchall()
+        (common,) = self.connection.execute(
+            "SELECT COUNT(*) FROM query_results a JOIN query_results b ON b.run_id = ? AND b.query_num = a.query_num "
+            "WHERE a.run_id = ?", (run_id, baseline_id)).fetchone()
+        counts = dict(self.connection.execute(
+            "SELECT run_id, COUNT(*) FROM query_results WHERE run_id IN (?, ?) GROUP BY run_id",
+            (baseline_id, run_id)).fetchall())
+
+        regressions = []
+        improvements = []
+        for num, query, file_a, file_b, phrase_a, phrase_b, failed_a, failed_b, latency_a, latency_b in changed:
+            change = (_reciprocal_rank(phrase_b) - _reciprocal_rank(phrase_a),
+                      _reciprocal_rank(file_b) - _reciprocal_rank(file_a))
+            entry = {"num": num, "query": query, "file_rank": [file_a, file_b], "phrase_rank": [phrase_a, phrase_b],
+                     "failed": [bool(failed_a), bool(failed_b)], "latency_ms": [latency_a, latency_b],
+                     "change": change}
+            if change > (0, 0):
+                improvements.append(entry)
+            elif change < (0, 0):
+                regressions.append(entry)
+        regressions.sort(key=lambda entry: entry["change"])
+        improvements.sort(key=lambda entry: entry["change"], reverse=True)
+
+        #The per-query metrics are computed again with the baseline's K values, in order of query number
+        p_values = {}
+        if num_resamples > 0:
+            query_nums = [row[0] for row in self.connection.execute(
+                "SELECT a.query_num FROM query_results a JOIN query_results b ON b.run_id = ? "
+                "AND b.query_num = a.query_num WHERE a.run_id = ? ORDER BY a.query_num", (run_id, baseline_id))]
+            k_values = baseline["config"].get("k_values") or list(DEFAULT_K_VALUES)
+            values = [self.query_metrics(baseline_id, query_nums, k_values, self._depth(baseline["config"])),
+                      self.query_metrics(run_id, query_nums, k_values, self._depth(run["config"]))]
+            if None in values:
+                logging.warning("The relevance of each query wasn't recorded for one of the runs, so the changes "
+                                "can't be tested for significance")
+            elif query_nums:
+                p_values = paired_randomization_test(values[0], values[1], num_resamples, seed)
+
+        config_keys = sorted(set(baseline["config"]) | set(run["config"]))
+        return {
+            "baseline": baseline,
+            "run": run,
+            "config_changes": {key: [baseline["config"].get(key), run["config"].get(key)] for key in config_keys
+                               if baseline["config"].get(key) != run["config"].get(key)},
+            "metric_changes": {name: [value, run["metrics"][name], run["metrics"][name] - value, p_values.get(name)]
+                               for name, value in baseline["metrics"].items()
+                               if isinstance(value, (int, float)) and isinstance(run["metrics"].get(name), (int, float))},
+            "unchanged": common - len(regressions) - len(improvements),
+            "only_in_baseline": counts.get(baseline_id, 0) - common,
+            "only_in_run": counts.get(run_id, 0) - common,
+            "regressions": regressions,
+            "improvements": improvements,
+        }
+
+    def close(self):
+        self.connection.close()
+
+class RunRecorder:
+    """ Records the queries of one run in a RunHistory as they are scored (see run_queries()). """
+
+    def __init__(self, history: RunHistory, bundle: str, corpus_id: int, config: {}):
+        """
+        Args:
+            history: The RunHistory the run is recorded in
+            bundle: Which test bundle is being run
+            corpus_id: ID of the corpus that is searched
+            config: Settings of the run
+        """
+        self.history = history
+        self.bundle = bundle
+        self.run_id = history.start_run(bundle, corpus_id, config)
+
+    def add_query(self, this_query: QueryRecord, failed: bool, latency: float, relevance: np.ndarray,
+                  match_ranks: np.ndarray):
+        """ Records one query (see RunHistory.add_query()). """
+        self.history.add_query(self.run_id, self.bundle, this_query, failed, latency, relevance, match_ranks)
+
+    def finish(self, metrics: {}):
+        """ Records the metrics of the run and marks it as finished. """
+        self.history.finish_run(self.run_id, metrics)
+
+class TraceWriter:
+    """ Writes a JSONL trace of a run, one record per query, from a background thread, so that the scoring loop only
+    hands each record over and never waits for the disk or the terminal.
+
+    At the 'query' level each record has the query's number and text, whether it failed, the latency of its request,
+    the document ID of each of its results in rank order, and the ranks at which each expected match was found (based
+    on the file only and on both the file and the phrase). The 'hits' level also lists every result from an expected
+    file with its snippet and the expected phrases it matched. Records are queued, and serialized and written
+    through a large buffer by the background thread. The queue is bounded, so if the disk can't keep up the scoring
+    loop waits rather than the queue growing without limit.
+    """
+
+    def __init__(self, path: str, level: str = "query", max_queued: int = 10000):
+        """
+        Args:
+            path: Path of the trace file
+            level: One of TRACE_LEVELS
+            max_queued: Maximum number of records waiting to be written
+        """
+        if level not in TRACE_LEVELS:
+            raise ValueError(f"Unknown trace level {level}, expected one of {TRACE_LEVELS}")
+        self.path = path
+        self.level = level
+        self.queue = queue.Queue(max_queued)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.thread = threading.Thread(target=self._write_records, args=(open(path, "w", buffering=1 << 20),),
+                                       daemon=True)
+        self.thread.start()
+
+    def _write_records(self, trace_file):
+        with trace_file:
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    break
+                trace_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    def write(self, record: {}):
+        """ Queues a record to be written. It must not be changed afterwards. """
+        self.queue.put(record)
+
+    def close(self):
+        """ Writes the records that are still queued and closes the file. """
+        self.queue.put(None)
+        self.thread.join()
+
+def _record_matches(this_query: QueryRecord, response_set: {}, relevance: np.ndarray, match_ranks: np.ndarray,
+                    phrase_match: str = "exact", fuzzy_threshold: float = 0.6, doc_index: DocumentIndex = None,
+                    overlap_threshold: float = 0.5, trace_record: {} = None):
+    """ Compares the results of a query with its expected matches, and records them in the query's relevance rows
+    and match ranks (see compute_metrics()).
+
+    Args:
+        this_query: The QueryRecord of the query
+        response_set: The entry of 'responseSet' in the query response for the query
+        relevance: The query's relevance rows, of shape (2, depth), which are filled in
+        match_ranks: The query's match ranks, of shape (2, at least the number of expected matches), which are
+            filled in
+        phrase_match: How snippets are compared with expected phrases, one of PHRASE_MATCH_MODES (see PhraseMatcher)
+        fuzzy_threshold: Fraction of a phrase's words that must appear in a row for a fuzzy phrase match
+        doc_index: The bundle's DocumentIndex, for the aligned phrase match mode
+        overlap_threshold: Fraction of a phrase's span that a snippet must cover for an aligned phrase match
+        trace_record: Optional trace record of the query (see TraceWriter), to which the document IDs of the results
+            are added as 'doc_ids', and each result from an expected file if the record has a 'hits' list
+    """
+
+    #Document IDs stripped down to just the number prefix of the originating file name, worked out only for the
+    #documents that the scored results refer to
+    documents = response_set["document"]
+    doc_ids = {}
+
+    #Index the expected matches by file, so that each result is only compared with the matches for its own file,
+    #and normalize the expected phrases once for all the results
+    matches_by_file = {}
+    for match_idx, (file_num, phrase) in enumerate(this_query.matches):
+        matches_by_file.setdefault(file_num, []).append(match_idx)
+    matcher = PhraseMatcher([phrase for file_num, phrase in this_query.matches], phrase_match, fuzzy_threshold,
+                            [file_num for file_num, phrase in this_query.matches], doc_index, overlap_threshold)
+
+    #For each result (up to the requested depth), record whether it matches on one of the expected docs, and how
+    #many expected matches it matches on both the doc and its phrase. Also record the rank at which each expected
+    #match was first found.
+    for response_ct, this_response in enumerate(response_set["response"][:relevance.shape[1]], start=1):
+        doc_index = this_response["documentIndex"]
+        doc_id = doc_ids.get(doc_index)
+        if doc_id is None:
+            doc_id = doc_ids[doc_index] = os.path.basename(documents[doc_index]["id"]).split('-')[0]
+        if trace_record is not None:
+            trace_record["doc_ids"].append(doc_id)
+        file_match_idxs = matches_by_file.get(doc_id)
+        if not file_match_idxs:
+            continue
+
+        snippet = this_response["text"]
+        relevance[FILE_LAYER, response_ct - 1] = 1
+
+        phrase_match_idxs = matcher.matches(snippet, doc_id)
+        if trace_record is not None and "hits" in trace_record:
+            trace_record["hits"].append({"rank": response_ct, "doc_id": doc_id, "text": snippet,
+                                         "phrase_matches": sorted(phrase_match_idxs & set(file_match_idxs))})
+        for match_idx in file_match_idxs:
+            if match_ranks[FILE_LAYER, match_idx] == 0:
+                match_ranks[FILE_LAYER, match_idx] = response_ct
+
+            if match_idx in phrase_match_idxs:
+                relevance[FILE_AND_PHRASE_LAYER, response_ct - 1] += 1
+                if match_ranks[FILE_AND_PHRASE_LAYER, match_idx] == 0:
+                    match_ranks[FILE_AND_PHRASE_LAYER, match_idx] = response_ct
+
+def run_queries(customer_id: int, corpus_id: int, query_address: str, jwt_token: str, queries_file: str,
+                concurrency: int = 1, max_qps: float = None, max_retries: int = 5, batch_size: int = 1,
+                cache: ResponseCache = None, offline: bool = False, k_values: [int] = DEFAULT_K_VALUES,
+                phrase_match: str = "exact", fuzzy_threshold: float = 0.6, shard: (int, int) = None,
+                partial: PartialResultWriter = None, accumulator: MetricAccumulator = None, num_results: int = None,
+                doc_index: DocumentIndex = None, overlap_threshold: float = 0.5, trace: TraceWriter = None,
+                history: RunRecorder = None, bootstrap_resamples: int = 0, confidence: float = 0.95,
+                seed: int = None):
     """This runs all test queries, parses the results, and calculates metrics which are returned.
     Args:
         customer_id: Unique customer ID in vectara platform.
         corpus_id: ID of the corpus to which data needs to be indexed.
         query_address: Address of the querying server. e.g., serving.vectara.io
-        jwt_token: A valid Auth token.
+        jwt_token: A valid Auth token, or a TokenProvider that supplies one.
         queries_file: Path to the file containing the queries to run in this evaluation.
+        concurrency: Maximum number of requests in flight at the same time. 1 runs the requests serially.
+            Responses are scored as they arrive, and the metrics are the same whatever the concurrency.
+        max_qps: Optional maximum number of requests sent per second.
+        max_retries: Maximum number of retries for each request if it is throttled or fails with a server error.
+        batch_size: Number of queries sent together in each request.
+        cache: Optional response cache. Queries found in it are scored without being sent.
+        offline: If True then the queries are scored entirely from the cache, without any network access.
+        k_values: The cut-offs (K) for which the @K metrics are computed
+        phrase_match: How snippets are compared with expected phrases, one of PHRASE_MATCH_MODES (see PhraseMatcher)
+        fuzzy_threshold: Fraction of a phrase's words that must appear in a row for a fuzzy phrase match
+        shard: Optional (shard index, number of shards) to only run the queries of one shard (see _get_query_shard())
+        partial: Optional writer to which the raw match data of each query is written, for merge_partial_results()
+        accumulator: Optional MetricAccumulator to which the totals of the queries are added, e.g. to combine them
+            with those of other bundles
+        num_results: Number of results requested and scored for each query. Defaults to the largest K.
+        doc_index: The bundle's DocumentIndex, for the aligned phrase match mode
+        overlap_threshold: Fraction of a phrase's span that a snippet must cover for an aligned phrase match
+        trace: Optional TraceWriter to which a record of each query is written
+        history: Optional RunRecorder in which the outcome of each query is recorded
+        bootstrap_resamples: If not 0, the metrics also get bootstrap confidence intervals ('confidence_intervals',
+            see bootstrap_confidence_intervals()) from this many resamples of the queries
+        confidence: Confidence level of the intervals
+        seed: Optional seed of the bootstrap resamples
 
     Returns:
-        (response, True) in case of success and returns (error, False) in case of failure.
-
+        Dict from metric name to its value over the queries that were run (see compute_metrics()), plus
+        'confidence_intervals' with bootstrap_resamples, or {"no_queries_found_in": queries_file} if there were no
+        queries to run. Failed queries count as having no matches.
     """
     print('Running queries from ' + queries_file)
+    queries = _iter_queries(queries_file)
+    if shard is not None:
+        shard_index, num_shards = shard
+        queries = (this_query for this_query in queries if _get_query_shard(this_query.num, num_shards) == shard_index)
+
+    #See compute_metrics() for information on the structure of the relevance rows and the ranks of the matches
+    depth = _get_result_depth(k_values, num_results)
+    blocks = RelevanceBlocks(k_values, depth, keep_values=bootstrap_resamples > 0)
+    query_nums = []
+
+    #Run each query and record the metrics as its response arrives
+    num_failed = 0
+    for this_query, response_set, latency in _execute_queries(customer_id, corpus_id, query_address, jwt_token,
+                                                              queries, concurrency, max_qps, max_retries,
+                                                              batch_size, cache, offline, depth):
+        row = blocks.new_row(len(this_query.matches), this_query.num)
+        if bootstrap_resamples > 0:
+            query_nums.append(this_query.num)
+        trace_record = None
+        if trace is not None:
+            trace_record = {"num": this_query.num, "query": this_query.query, "failed": response_set is None,
+                            "latency_ms": round(latency * 1000, 3) if latency is not None else None, "doc_ids": []}
+            if trace.level == "hits":
+                trace_record["hits"] = []
+
+        #If the query failed, just ignore it (its row stays all 0) and continue on with the next query
+        if response_set is None:
+            logging.error("Query %s failed, so not counting its metrics.", this_query.num)
+            num_failed += 1
+        else:
+            with PROFILER.span("query.match"):
+                _record_matches(this_query, response_set, blocks.relevance[:, row], blocks.match_ranks[:, row],
+                                phrase_match, fuzzy_threshold, doc_index, overlap_threshold, trace_record)
+
+        if trace_record is not None:
+            trace_record["matches"] = [
+                {"file_num": file_num, "phrase": phrase,
+                 "file_rank": int(blocks.match_ranks[FILE_LAYER, row, match_idx]),
+                 "phrase_rank": int(blocks.match_ranks[FILE_AND_PHRASE_LAYER, row, match_idx])}
+                for match_idx, (file_num, phrase) in enumerate(this_query.matches)]
+            trace.write(trace_record)
+
+        if partial is not None:
+            partial.write(this_query.num, len(this_query.matches), response_set is None,
+                          blocks.relevance[:, row], blocks.match_ranks[:, row])
+        if history is not None:
+            history.add_query(this_query, response_set is None, latency, blocks.relevance[:, row],
+                              blocks.match_ranks[:, row])
+
+    totals = blocks.finish()
+    print(f'Scored {totals.count} queries ({num_failed} failed)')
+    if accumulator is not None:
+        accumulator.merge(totals)
+    if totals.count == 0:
+        return {"no_queries_found_in": queries_file}
+
+    #Create 'metrics' dict to store aggregated query metrics
+    metrics = totals.means()
+
+    #Resample the queries in order of their number, so that the intervals don't depend on the order responses arrived
+    if bootstrap_resamples > 0:
+        order = np.argsort(query_nums, kind="stable")
+        with PROFILER.span("metrics.bootstrap", resamples=bootstrap_resamples):
+            metrics["confidence_intervals"] = bootstrap_confidence_intervals(
+                {name: values[order] for name, values in blocks.values().items()}, bootstrap_resamples, confidence,
+                seed)
+
+    return metrics
+
+def _get_sweep_configs(sweep_file: str):
+    """ Reads the configurations of a sweep from a JSON file. The file holds either a grid, a dict from the dotted
+    path of a query body parameter (see _apply_overrides()) to the list of its values, of which every combination is
+    a configuration, or a list of configurations, each a dict from parameter path to value. For example:
+        {"num_results": [10, 20], "corpus_key.lexical_interpolation_config.lambda": [0, 0.025, 0.1]}
+
+    Returns:
+        List of configurations, each a dict from parameter path to value
+
+    Raises:
+        ValueError: If the file isn't a grid or a list of configurations, or a parameter path of a configuration
+            can't be set in a query object
+    """
+    with open(sweep_file) as grid_file:
+        grid = json.load(grid_file)
+    if isinstance(grid, dict):
+        if not all(isinstance(values, list) and values for values in grid.values()):
+            raise ValueError(f"Every parameter of the grid in {sweep_file} must have a non-empty list of values")
+        configs = [dict(zip(grid, values)) for values in itertools.product(*grid.values())]
+    elif isinstance(grid, list) and grid and all(isinstance(config, dict) for config in grid):
+        configs = grid
+    else:
+        raise ValueError(f"{sweep_file} must hold a grid (a dict of lists of values) or a list of configurations")
+    #Check every configuration against a query object, so that a bad path fails before any query is sent
+    for config in configs:
+        try:
+            _get_query_obj(0, 0, "", overrides=config)
+        except ValueError as error:
+            raise ValueError(f"{sweep_file}: {error}") from None
+    return configs
+
+def _get_sweep_label(config: {}):
+    """ Returns a short description of a sweep configuration, with the last part of each parameter path. """
+    return ", ".join(f"{path.split('.')[-1]}={json.dumps(value)}" for path, value in config.items()) or "default"
+
+def run_sweep(customer_id: int, corpus_id: int, query_address: str, jwt_token: str, queries_file: str,
+              configs: [{}], concurrency: int = 1, max_qps: float = None, max_retries: int = 5, batch_size: int = 1,
+              cache: ResponseCache = None, offline: bool = False, k_values: [int] = DEFAULT_K_VALUES,
+              phrase_match: str = "exact", fuzzy_threshold: float = 0.6, num_results: int = None,
+              doc_index: DocumentIndex = None, overlap_threshold: float = 0.5):
+    """ Runs the test queries with each configuration of a sweep over query body parameters, and computes the metrics
+    of each configuration.
+
+    Every (configuration, query) pair goes through the same pool of workers, connections and token as one run of the
+    queries would, so the sweep takes about as long as one run with as many queries as there are pairs, rather than
+    one whole run per configuration. Pairs whose query objects are identical (e.g. a query that is in the query set
+    twice, or configurations that only differ in parameters the query doesn't use) are only sent once, and each of
+    them is scored from the same response.
+
+    Every configuration is scored over the same number of results, the largest K (or 'num_results'), whatever
+    number of results it requests, so that the metrics of configurations that request different numbers of results
+    can be compared.
+
+    Args:
+        customer_id: Unique customer ID in vectara platform.
+        corpus_id: ID of the corpus that is searched.
+        query_address: Address of the querying server. e.g., serving.vectara.io
+        jwt_token: A valid Auth token, or a TokenProvider that supplies one.
+        queries_file: Path to the file containing the queries to run in this evaluation.
+        configs: The configurations, each a dict from the dotted path of a query body parameter to its value
+            (see _get_sweep_configs())
+        concurrency: Maximum number of requests in flight at the same time.
+        max_qps: Optional maximum number of requests sent per second.
+        max_retries: Maximum number of retries for each request if it is throttled or fails with a server error.
+        batch_size: Number of queries sent together in each request.
+        cache: Optional response cache. Queries found in it are scored without being sent.
+        offline: If True then the queries are scored entirely from the cache, without any network access.
+        k_values: The cut-offs (K) for which the @K metrics are computed
+        phrase_match: How snippets are compared with expected phrases, one of PHRASE_MATCH_MODES (see PhraseMatcher)
+        fuzzy_threshold: Fraction of a phrase's words that must appear in a row for a fuzzy phrase match
+        num_results: Number of results that are scored for each configuration, and requested by configurations
+            that don't set 'num_results'. Defaults to the largest K.
+        doc_index: The bundle's DocumentIndex, for the aligned phrase match mode
+        overlap_threshold: Fraction of a phrase's span that a snippet must cover for an aligned phrase match
+
+    Returns:
+        Dict with 'configs', a list with the parameters, label, metrics and number of failed queries of each
+        configuration, 'best', a dict from metric name to the configuration with the highest value of it, and the
+        number of (configuration, query) 'pairs', of distinct query objects that were 'requested', and the 'depth'
+        that every configuration was scored at
+    """
+    print(f'Running a sweep of {len(configs)} configurations of the queries from {queries_file}')
     queries = _get_queries_list(queries_file)
+    depth = _get_result_depth(k_values, num_results)
+    blocks = [RelevanceBlocks(k_values, depth) for _ in configs]
+    num_failed = [0] * len(configs)
+
+    #Each distinct query object is sent once, as a query whose overrides are the configuration's, and its response
+    #is scored for every (configuration, query) pair that has that query object. Unlike the response cache key,
+    #this key includes the number of results, since that can change the ranking (e.g. of a reranker).
+    def query_key(query_text: str, config: {}):
+        return json.dumps(_get_query_obj(customer_id, corpus_id, query_text, depth, config), sort_keys=True)
+
+    pairs = {}
+    to_send = []
+    for config_idx, config in enumerate(configs):
+        for this_query in queries:
+            key = query_key(this_query.query, config)
+            if key not in pairs:
+                pairs[key] = []
+                to_send.append(QueryRecord(this_query.num, this_query.query, this_query.matches, config))
+            pairs[key].append((config_idx, this_query))
+    print(f'{len(to_send)} distinct requests for {len(configs) * len(queries)} (configuration, query) pairs')
+
+    for sent_query, response_set, latency in _execute_queries(customer_id, corpus_id, query_address, jwt_token,
+                                                              to_send, concurrency, max_qps, max_retries,
+                                                              batch_size, cache, offline, depth):
+        for config_idx, this_query in pairs[query_key(sent_query.query, sent_query.overrides)]:
+            config_blocks = blocks[config_idx]
+            row = config_blocks.new_row(len(this_query.matches), this_query.num)
+            if response_set is None:
+                logging.error("Query %s failed with configuration %s, so not counting its metrics.", this_query.num,
+                              _get_sweep_label(configs[config_idx]))
+                num_failed[config_idx] += 1
+                continue
+            with PROFILER.span("query.match"):
+                _record_matches(this_query, response_set, config_blocks.relevance[:, row],
+                                config_blocks.match_ranks[:, row], phrase_match, fuzzy_threshold, doc_index,
+                                overlap_threshold)
+
+    results = {"configs": [], "best": {}, "pairs": len(configs) * len(queries), "requested": len(to_send),
+               "depth": depth}
+    for config, config_blocks, failed in zip(configs, blocks, num_failed):
+        totals = config_blocks.finish()
+        results["configs"].append({"params": config, "label": _get_sweep_label(config),
+                                   "metrics": totals.means() if totals.count else {}, "failed": failed})
+
+    #All the metrics are better when higher. Ties go to the earliest configuration.
+    for name in results["configs"][0]["metrics"]:
+        best_idx = max(range(len(configs)), key=lambda config_idx: (
+            results["configs"][config_idx]["metrics"].get(name, float("-inf")), -config_idx))
+        results["best"][name] = {"config": best_idx, "label": results["configs"][best_idx]["label"],
+                                 "value": results["configs"][best_idx]["metrics"][name]}
+    return results
+
+def _print_sweep(sweep: {}, k_values: [int]):
+    """ Prints the main metrics of each configuration of a sweep (see run_sweep()), and the best configuration for
+    each of them. """
+    max_k = max(k_values)
+    names = ["file_match_mean_reciprocal_rank", "file_match_and_phrase_mean_reciprocal_rank",
+             f"file_match_ndcg_at_{max_k}", f"file_and_phrase_match_ndcg_at_{max_k}",
+             f"file_match_recall_at_{max_k}", f"file_and_phrase_match_recall_at_{max_k}"]
+    headers = ["file MRR", "phrase MRR", f"file nDCG@{max_k}", f"phrase nDCG@{max_k}", f"file R@{max_k}",
+               f"phrase R@{max_k}"]
+    print(f'\n{"#":>3} ' + " ".join(f"{header:>13}" for header in headers) + "  configuration")
+    for config_idx, config in enumerate(sweep["configs"]):
+        values = " ".join(f'{config["metrics"].get(name, float("nan")):>13.4f}' for name in names)
+        print(f'{config_idx:>3} {values}  {config["label"]}')
+    print()
+    for name in names:
+        if name in sweep["best"]:
+            best = sweep["best"][name]
+            print(f'Best {name}: {best["value"]:.4f} with #{best["config"]} ({best["label"]})')
+
+def _get_load_test_schedule(rates: [float], step_seconds: float, profile: str = "step", arrivals: str = "fixed",
+                            seed: int = None):
+    """ Returns the times at which the requests of an open-loop load test are sent.
+
+    Args:
+        rates: Target rates (queries per second), one for each step of the test
+        step_seconds: Duration of each step
+        profile: 'step' holds each rate for the whole of its step. 'ramp' changes the rate linearly from each rate to
+            the next one over the step (the last rate is held for the last step).
+        arrivals: 'fixed' sends the requests at evenly spaced times. 'poisson' draws the time between requests from
+            an exponential distribution, so the requests arrive as a Poisson process with the target rate.
+        seed: Optional seed for the random arrival times
+
+    Returns:
+        List of (offset in seconds from the start of the test, step number) tuples, in time order
+    """
+
+    rng = random.Random(seed)
+    schedule = []
+    for step, rate in enumerate(rates):
+        step_start = step * step_seconds
+        end_rate = rates[step + 1] if profile == "ramp" and step + 1 < len(rates) else rate
+        #The expected number of requests sent by time t into the step is rate * t + slope * t^2. The i-th request is
+        #sent when it reaches i (or, for Poisson arrivals, the sum of i draws from an exponential distribution), so
+        #a ramp that starts at 0 QPS still sends its requests as the rate rises.
+        slope = (end_rate - rate) / (2 * step_seconds)
+        count = 0.0
+        while True:
+            count += rng.expovariate(1) if arrivals == "poisson" else 1
+            #Root of slope * t^2 + rate * t - count = 0, in a form that is also stable when the slope is 0
+            discriminant = rate * rate + 4 * slope * count
+            if discriminant < 0 or rate + math.sqrt(discriminant) <= 0:
+                break
+            offset = 2 * count / (rate + math.sqrt(discriminant))
+            if offset >= step_seconds:
+                break
+            schedule.append((step_start + offset, step))
+    return schedule
+
+def run_load_test(customer_id: int, corpus_id: int, query_address: str, jwt_token: str, queries_file: str,
+                  rates: [float], step_seconds: float, profile: str = "step", arrivals: str = "fixed",
+                  max_in_flight: int = 256, seed: int = None, num_results: int = NUM_RESULTS):
+    """ Replays the bundle's queries open-loop at target rates, and measures how the query latency changes with load.
+
+    Requests are sent at the times given by _get_load_test_schedule(), whether or not earlier requests have finished.
+    The latency of each request is measured from its scheduled send time rather than from when it was actually sent,
+    so that delays in sending (e.g. when all 'max_in_flight' requests are busy) are counted instead of hidden
+    (i.e. it avoids coordinated omission). Requests aren't retried.
+
+    Args:
+        customer_id: Unique customer ID in vectara platform.
+        corpus_id: ID of the corpus that will be searched.
+        query_address: Address of the querying server. e.g., serving.vectara.io
+        jwt_token: A valid Auth token, or a TokenProvider that supplies one.
+        queries_file: Path to the file containing the queries, which are sent in a round-robin order
+        rates: Target rates (queries per second), one for each step of the test
+        step_seconds: Duration of each step
+        profile: 'step' or 'ramp' (see _get_load_test_schedule())
+        arrivals: 'fixed' or 'poisson' (see _get_load_test_schedule())
+        max_in_flight: Maximum number of requests in flight at the same time
+        seed: Optional seed for the random arrival times
+        num_results: Number of results to request for each query
+
+    Returns:
+        Dict with the results of each step: the target and achieved rates, the number of requests sent, the number
+        of errors and the error rate, and the latency percentiles.
+    """
 
+    queries = _get_queries_list(queries_file)
     if len(queries) == 0:
         return {"no_queries_found_in": queries_file}
+    query_jsons = [_get_query_json(customer_id, corpus_id, this_query.query, num_results) for this_query in queries]
+    post_headers = {
+        "customer-id": f"{customer_id}"
+    }
+    url = _get_endpoint_url(query_address, "/v1/query")
+
+    schedule = _get_load_test_schedule(rates, step_seconds, profile, arrivals, seed)
+    steps = [{"latency": LatencyHistogram(), "send_lag": LatencyHistogram(), "sent": 0, "ok": 0, "errors": 0}
+             for _ in rates]
+    lock = threading.Lock()
+
+    with _get_http_session(max_in_flight) as session, \
+            concurrent.futures.ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        def send(scheduled_time, step, query_json):
+            sent_time = time.perf_counter()
+            try:
+                response = _authorized(lambda auth_headers: session.post(
+                    url, data=query_json, verify=True, headers={**post_headers, **auth_headers}), jwt_token)()
+                ok = response.status_code == 200
+            except requests.exceptions.RequestException:
+                ok = False
+            latency = time.perf_counter() - scheduled_time
+            with lock:
+                steps[step]["latency"].record(latency)
+                steps[step]["send_lag"].record(sent_time - scheduled_time)
+                steps[step]["ok" if ok else "errors"] += 1
+
+        print(f'Running a {profile} load test of {len(schedule)} queries over {len(rates) * step_seconds:.0f}s '
+              f'at {rates} queries per second ({arrivals} arrivals)')
+        start_time = time.perf_counter()
+        for request_ct, (offset, step) in enumerate(schedule):
+            scheduled_time = start_time + offset
+            delay = scheduled_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            steps[step]["sent"] += 1
+            executor.submit(send, scheduled_time, step, query_jsons[request_ct % len(query_jsons)])
+
+    results = {"profile": profile, "arrivals": arrivals, "step_seconds": step_seconds, "steps": []}
+    for step, (rate, stats) in enumerate(zip(rates, steps)):
+        end_rate = rates[step + 1] if profile == "ramp" and step + 1 < len(rates) else rate
+        results["steps"].append({
+            "target_qps": (rate + end_rate) / 2,
+            "achieved_qps": stats["ok"] / step_seconds,
+            "sent": stats["sent"],
+            "errors": stats["errors"],
+            "error_rate": stats["errors"] / stats["sent"] if stats["sent"] else 0.0,
+            "latency": stats["latency"].summary(),
+            "send_lag": stats["send_lag"].summary(),
+        })
+        print(f'Step {step + 1}: target {results["steps"][-1]["target_qps"]:.1f} qps, '
+              f'achieved {results["steps"][-1]["achieved_qps"]:.1f} qps, '
+              f'error rate {results["steps"][-1]["error_rate"]:.2%}, '
+              f'p50 {results["steps"][-1]["latency"]["p50_ms"]:.1f}ms, '
+              f'p99 {results["steps"][-1]["latency"]["p99_ms"]:.1f}ms')
+    return results
+
+def run_bundle(args: argparse.Namespace, bundle: str, corpus_id: int, token: TokenProvider,
+               latency_samples: str = None, trace: str = None):
+    """ Runs the evaluation (or the load test) of one bundle. A corpus is created and the bundle's data is uploaded
+    to it first if no corpus ID is given (or the data is synced to the corpus if asked to).
 
-    #Initialize arrays of size 'queries.length' to store the metrics for the queries
-    #See compute_metrics() for information on the required structure of these variables
-    num_matches_on_file_top_1 = [[0] * 1 for i in range(len(queries))]
-    num_matches_on_file_top_3 = [[0] * 3 for i in range(len(queries))]
-    num_matches_on_file_top_5 = [[0] * 5 for i in range(len(queries))]
-    num_matches_on_file_top_10 = [[0] * 10 for i in range(len(queries))]
-
-    num_matches_on_file_and_phrase_top_1 = [0] * len(queries)
-    num_matches_on_file_and_phrase_top_3 = [0] * len(queries)
-    num_matches_on_file_and_phrase_top_5 = [0] * len(queries)
-    num_matches_on_file_and_phrase_top_10 = [0] * len(queries)
-
-    first_matches_on_file = [0] * len(queries)
-    first_matches_on_file_and_phrase = [0] * len(queries)
-
-    #Run each query and record the metrics
-    for this_query in queries:
-        print(this_query)
-        #Skip any queries that were not parsed properly
-        if 'num' not in this_query:
-            continue
-        print('Running ' + str(this_query["num"]) + '. ' + this_query["query"])
-
-        #Run query
-        response = _run_query(customer_id, corpus_id, query_address, jwt_token, this_query)
-
-        #If the query failed, just ignore it and continue on with the next query
-        if response.status_code != 200:
-            logging.error("Query %s failed, so not counting its metrics. Failure details: code %d, reason %s, text %s",
-                          this_query["num"],
-                          response.status_code,
-                          response.reason,
-                          response.text)
-            continue
+    Args:
+        args: The parsed command line arguments
+        bundle: Which test bundle is being used
+        corpus_id: ID of the corpus that contains the bundle's data, or None to create one
+        token: The TokenProvider, or None if the run is offline
+        latency_samples: Optional path of a JSONL file to which the raw timing of every request is written
+        trace: Optional path of a JSONL file to which a trace of every query is written (see TraceWriter)
 
-        #This contains the raw results from running this query
-        response_dict = json.loads(response.text)
-
-        #Get array of document IDs with the ID stripped down to just the number prefix for the originating file name
-        doc_ids = []
-        for doc in response_dict["responseSet"][0]["document"]:
-            doc_file_name = os.path.basename(doc["id"])
-            doc_ids.append(doc_file_name.split('-')[0])
-
-        #For each item in this query's 'matches' array:
-        # get the result number for the first time a matching doc was returned
-        # get the result number for the first time both a matching doc and its phrase were returned
-        # get the number of results within the top 1 that match on a doc; and top3... and top 5... and top 10
-        # get the number of results within the top 1 that match on a doc and its phrase; and top3... and top 5... and top 10
-        found_match_on_file = False
-        found_match_on_file_and_phrase = False
-        for match in this_query["matches"]:
-            print("Checking match [" + match["file-num"] + "]: " + match["phrase"])
-            response_ct = 0
-            for this_response in response_dict["responseSet"][0]["response"]:
-                response_ct += 1
-                snippet = this_response["text"]
-                doc_id = doc_ids[this_response["documentIndex"]]
-                #print("  Response " + str(response_ct) + ": [" + str(doc_id) + "]. " + str(snippet))
-
-                if match["file-num"] == doc_id:
-                    print("  Found file match for query " + str(this_query["num"]) + " at response spot " + str(response_ct))
-                    print("    Response " + str(response_ct) + ": [" + str(doc_id) + "]. " + str(snippet))
-                    #Record counts for p@k metrics
-                    if response_ct <= 1:
-                        num_matches_on_file_top_1[this_query["num"]-1][response_ct-1] = 1
-                    if response_ct <= 3:
-                        num_matches_on_file_top_3[this_query["num"]-1][response_ct-1] = 1
-                    if response_ct <= 5:
-                        num_matches_on_file_top_5[this_query["num"]-1][response_ct-1] = 1
-                    if response_ct <= 10:
-                        num_matches_on_file_top_10[this_query["num"]-1][response_ct-1] = 1
-                    #Record count for first match metric if we haven't already found a match for this query
-                    if found_match_on_file == False or response_ct < first_matches_on_file[this_query["num"]-1]:
-                        first_matches_on_file[this_query["num"]-1] = response_ct
-                        found_match_on_file = True
-
-                if match["file-num"] == doc_id and strings_overlap(snippet, match["phrase"]):
-                    print("  Found file and phrase match for query " + str(this_query["num"]) + " at response spot " + str(response_ct))
-                    print("    Response " + str(response_ct) + ": [" + str(doc_id) + "]. " + str(snippet))
-                    #Record counts for p@k metrics
-                    num_matches_on_file_and_phrase_top_1[this_query["num"]-1] += (1 if response_ct <= 1 else 0)
-                    num_matches_on_file_and_phrase_top_3[this_query["num"]-1] += (1 if response_ct <= 3 else 0)
-                    num_matches_on_file_and_phrase_top_5[this_query["num"]-1] += (1 if response_ct <= 5 else 0)
-                    num_matches_on_file_and_phrase_top_10[this_query["num"]-1] += (1 if response_ct <= 10 else 0)
-                    #Record count for first match metric if we haven't already found a match for this query
-                    if found_match_on_file_and_phrase == False or response_ct < first_matches_on_file_and_phrase[this_query["num"]-1]:
-                        first_matches_on_file_and_phrase[this_query["num"]-1] = response_ct
-                        found_match_on_file_and_phrase = True
-
-        print('\n')
+    Returns:
+        (results, accumulator) where 'results' is the dict that is saved to the results file, and 'accumulator'
+        is the MetricAccumulator of the bundle's queries (None for a load test)
+    """
+    start_time = time.perf_counter()
+    queries_file = "bundles/" + bundle + "/queries.csv"
+
+    # Create a corpus and upload the test data if we were not given a corpus ID
+    sync_data = args.sync_data
+    new_corpus = corpus_id is None
+    indexing_latency = None
+    if new_corpus:
+        result, status, corpus_id = create_corpus(args.customer_id,
+                                                  args.admin_endpoint,
+                                                  token,
+                                                  bundle)
+        logging.info("Created corpus to store the test data response: %s", result.text)
+        sync_data = True
+
+    # Upload the data for this evaluation bundle (only the new and changed files if it was uploaded before)
+    if sync_data:
+        uploaded_at = {}
+        with PROFILER.span("upload"):
+            result, status = upload_data(args.customer_id,
+                                  corpus_id,
+                                  args.indexing_endpoint,
+                                  "bundles/" + bundle + "/data",
+                                  token,
+                                  args.upload_concurrency,
+                                  args.max_retries,
+                                  _get_manifest_path(args.manifest_dir, args.indexing_endpoint, args.customer_id,
+                                                     corpus_id, bundle),
+                                  uploaded_at=uploaded_at,
+                                  new_corpus=new_corpus)
+        logging.info("Data for %s bundle indexed: %s", bundle, result)
+
+        # Wait until the uploaded files can be found, so that documents still being indexed aren't misses
+        if uploaded_at and args.indexing_timeout > 0:
+            with PROFILER.span("readiness"):
+                indexing_latency = wait_until_searchable(args.customer_id,
+                                                         corpus_id,
+                                                         args.serving_endpoint,
+                                                         token,
+                                                         queries_file,
+                                                         uploaded_at,
+                                                         args.indexing_timeout,
+                                                         max_retries=args.max_retries)
+            logging.info("Indexing latency: %s", indexing_latency)
+
+    print('Using the following corpus ID for the test queries: ' + str(corpus_id))
+
+    accumulator = None
+    if args.load_test:
+        with PROFILER.span("load-test"):
+            results = run_load_test(args.customer_id,
+                                    corpus_id,
+                                    args.serving_endpoint,
+                                    token,
+                                    queries_file,
+                                    args.load_qps,
+                                    args.load_step_seconds,
+                                    args.load_profile,
+                                    args.load_arrivals,
+                                    args.load_max_in_flight,
+                                    args.load_seed,
+                                    _get_result_depth(args.k_values, args.num_results))
+    elif args.sweep is not None:
+        cache = None
+        if args.cache_dir is not None:
+            cache = ResponseCache(args.cache_dir, args.cache_max_age_days, args.cache_max_size_mb)
+        doc_index = None
+        if args.phrase_match == "aligned":
+            with PROFILER.span("doc-index"):
+                doc_index = DocumentIndex("bundles/" + bundle, os.path.join(args.doc_index_dir, bundle))
+
+        # Run the queries with every configuration of the sweep at the same time
+        with PROFILER.span("sweep"):
+            results = run_sweep(args.customer_id,
+                                corpus_id,
+                                args.serving_endpoint,
+                                token,
+                                queries_file,
+                                _get_sweep_configs(args.sweep),
+                                args.query_concurrency,
+                                args.max_qps,
+                                args.max_retries,
+                                args.query_batch_size,
+                                cache,
+                                args.offline,
+                                args.k_values,
+                                args.phrase_match,
+                                args.fuzzy_threshold,
+                                args.num_results,
+                                doc_index,
+                                args.overlap_threshold)
+        if cache is not None:
+            cache.close()
+        if doc_index is not None:
+            doc_index.close()
+        _print_sweep(results, args.k_values)
+        results["latency"] = REQUEST_STATS.summary()
+    else:
+        cache = None
+        if args.cache_dir is not None:
+            cache = ResponseCache(args.cache_dir, args.cache_max_age_days, args.cache_max_size_mb)
+
+        # A shard writes the raw match data of its queries, so that it can be merged with the other shards
+        partial = None
+        if args.shard is not None:
+            partial_filename = f"results/partial-{bundle}-shard-{args.shard[0]}-of-{args.shard[1]}.jsonl.gz"
+            partial = PartialResultWriter(partial_filename, {
+                "bundle": bundle,
+                "queries_file": queries_file,
+                "corpus_id": corpus_id,
+                "num_shards": args.shard[1],
+                "shard": args.shard[0],
+                "depth": _get_result_depth(args.k_values, args.num_results),
+                "k_values": args.k_values,
+                "phrase_match": args.phrase_match,
+                "fuzzy_threshold": args.fuzzy_threshold,
+                "overlap_threshold": args.overlap_threshold,
+            })
+
+        # The aligned phrase match mode locates snippets in the bundle's files, with an index that is built once
+        doc_index = None
+        if args.phrase_match == "aligned":
+            with PROFILER.span("doc-index"):
+                doc_index = DocumentIndex("bundles/" + bundle, os.path.join(args.doc_index_dir, bundle))
+
+        trace_writer = TraceWriter(trace, args.trace_level) if trace is not None else None
+
+        # Record the outcome of every query in the run history, to compare it with other runs
+        history = None
+        recorder = None
+        if args.record_history:
+            history = RunHistory(args.history_db)
+            recorder = RunRecorder(history, bundle, corpus_id,
+                                   {key: getattr(args, key) for key in HISTORY_CONFIG_KEYS})
+
+        # Run the queries for this evaluation bundle
+        accumulator = MetricAccumulator()
+        with PROFILER.span("queries"):
+            metrics = run_queries(args.customer_id,
+                                  corpus_id,
+                                  args.serving_endpoint,
+                                  token,
+                                  queries_file,
+                                  args.query_concurrency,
+                                  args.max_qps,
+                                  args.max_retries,
+                                  args.query_batch_size,
+                                  cache,
+                                  args.offline,
+                                  args.k_values,
+                                  args.phrase_match,
+                                  args.fuzzy_threshold,
+                                  args.shard,
+                                  partial,
+                                  accumulator,
+                                  args.num_results,
+                                  doc_index,
+                                  args.overlap_threshold,
+                                  trace_writer,
+                                  recorder,
+                                  args.bootstrap_resamples,
+                                  args.confidence,
+                                  args.seed)
+        if cache is not None:
+            cache.close()
+        if doc_index is not None:
+            doc_index.close()
+        if trace_writer is not None:
+            trace_writer.close()
+            logging.info("Query trace written to " + trace)
+        if history is not None:
+            recorder.finish(metrics)
+            history.close()
+            logging.info("Run recorded in %s as run %d", args.history_db, recorder.run_id)
+        if partial is not None:
+            partial.close()
+            logging.info("Partial results of shard %d/%d written to %s",
+                         args.shard[0], args.shard[1], partial_filename)
+
+        # Save the metrics from the query test, and the latency of the requests
+        print("Metrics: " + str(metrics))
+        results = dict(metrics)
+        results["latency"] = REQUEST_STATS.summary()
+        if args.shard is not None:
+            results["shard"] = f"{args.shard[0]}/{args.shard[1]}"
+        if recorder is not None:
+            results["run_id"] = recorder.run_id
+
+    if indexing_latency is not None:
+        results["indexing_latency"] = indexing_latency
+    results["corpus_id"] = corpus_id
+    results["elapsed_seconds"] = time.perf_counter() - start_time
+    if latency_samples is not None:
+        REQUEST_STATS.dump_samples(latency_samples)
+        logging.info("Raw request timings written to " + latency_samples)
+    return results, accumulator
+
+def _run_bundle_in_process(args: argparse.Namespace, bundle: str, corpus_id: int, auth_url: str, token: {},
+                           latency_samples: str = None, profile: str = None, trace: str = None):
+    """ Runs one bundle in a worker process of a multi-bundle run (see run_bundle()).
+
+    The worker starts with the token fetched by the parent process ('token', None if offline), so that the bundles
+    don't each fetch their own, and keeps it fresh with its own TokenProvider. Request statistics are counted
+    separately for each bundle, and if 'profile' is given the bundle's spans are written to that trace file. 'trace'
+    is the bundle's own query trace file, if any.
 
-    #Create 'metrics' dict to store aggregated query metrics
-    metrics = compute_metrics(num_matches_on_file_top_1, num_matches_on_file_top_3,
-                              num_matches_on_file_top_5, num_matches_on_file_top_10,
-                              num_matches_on_file_and_phrase_top_1, num_matches_on_file_and_phrase_top_3,
-                              num_matches_on_file_and_phrase_top_5, num_matches_on_file_and_phrase_top_10,
-                              first_matches_on_file, first_matches_on_file_and_phrase)
+    Returns:
+        The results and accumulator of run_bundle(), and the summary of the bundle's spans (see Profiler.summary()),
+        which is empty if 'profile' isn't given
+    """
+    global REQUEST_STATS, PROFILER
+    logging.basicConfig(format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO)
+    REQUEST_STATS = RequestStats(keep_samples=latency_samples is not None)
+    PROFILER = Profiler(enabled=profile is not None)
+    provider = None
+    if token is not None:
+        provider = TokenProvider(auth_url, args.app_client_id, args.app_client_secret,
+                                 args.token_refresh_margin, args.token_cache, token)
+    try:
+        results, accumulator = run_bundle(args, bundle, corpus_id, provider, latency_samples, trace)
+        return results, accumulator, PROFILER.summary()
+    finally:
+        if provider is not None:
+            provider.close()
+        if profile is not None:
+            PROFILER.write_trace(profile)
+            logging.info("Profile of %s written to %s", bundle, profile)
+
+def _get_bundles(bundle_arg: str):
+    """ Returns the list of bundles given on the command line: a comma-separated list, or 'all' for every bundle in
+    the bundles directory. """
+    if bundle_arg == "all":
+        return sorted(entry.name for entry in os.scandir("bundles") if entry.is_dir())
+    return [bundle.strip() for bundle in bundle_arg.split(",")]
+
+def merge_main(argv: [str]):
+    """ Runs the 'merge' subcommand, which combines the partial results of a sharded run into one results file.
+    Args:
+        argv: The command line arguments after 'merge'
+    """
+    parser = argparse.ArgumentParser(prog="run_eval.py merge",
+                                     description="Merge the partial results of a sharded evaluation")
+    parser.add_argument("partials", nargs="+", help="The partial result files, one for each shard.")
+    parser.add_argument("--k-values", type=lambda value: [int(k) for k in value.split(",")],
+                        help="Comma-separated cut-offs (K) for the @K metrics. Defaults to those of the sharded run.")
+    args = parser.parse_args(argv)
+
+    try:
+        if args.k_values is not None:
+            args.k_values = _get_k_values(args.k_values)
+        metrics = merge_partial_results(args.partials, args.k_values)
+    except ValueError as error:
+        parser.error(str(error))
+    with gzip.open(args.partials[0], "rt") as partial_file:
+        bundle = json.loads(partial_file.readline())["bundle"]
+
+    print("Metrics: " + str(metrics))
+    results_filename = "results/results-" + bundle + "-" + \
+                       datetime.datetime.now().strftime("%m_%d_%Y_%H_%M_%S") + ".json"
+    with open(results_filename, "w") as text_file:
+        text_file.write(json.dumps(metrics))
+    logging.info("Merged evaluation metrics written to " + results_filename)
+
+def compare_main(argv: [str]):
+    """ Runs the 'compare' subcommand, which shows the queries that regressed or improved between two runs in the
+    run history.
+    Args:
+        argv: The command line arguments after 'compare'
+    """
+    parser = argparse.ArgumentParser(prog="run_eval.py compare",
+                                     description="Compare two recorded evaluation runs query by query")
+    parser.add_argument("runs", nargs="*", type=int,
+                        help="IDs of the baseline run and of the run compared with it. Defaults to the two latest "
+                             "runs of --bundle, or of the bundle of the latest run.")
+    parser.add_argument("--history-db", default=DEFAULT_HISTORY_PATH, help="Path of the run history database.")
+    parser.add_argument("--bundle", help="Compare the two latest runs of this bundle.")
+    parser.add_argument("--limit", type=int, default=20,
+                        help="Maximum number of regressed and of improved queries listed.")
+    parser.add_argument("--output", help="Optional path of a JSON file to which the full comparison is written.")
+    parser.add_argument("--resamples", type=int, default=0,
+                        help="If not 0, add the p-value of a paired randomization test of each metric's change, with "
+                             "this many resamples (e.g. 10000). The test reads every query's relevance entries, so "
+                             "it takes seconds rather than milliseconds for large query sets.")
+    parser.add_argument("--seed", type=int, help="Seed of the randomization test, for reproducible p-values.")
+    args = parser.parse_args(argv)
+    if not os.path.exists(args.history_db):
+        parser.error(f"There is no run history at {args.history_db} (runs are recorded with --record-history)")
+
+    start_time = time.perf_counter()
+    history = RunHistory(args.history_db)
+    run_ids = args.runs
+    if not run_ids:
+        #Runs of different bundles have different queries, so by default the latest run is compared with the
+        #run of the same bundle before it
+        bundle = args.bundle
+        if bundle is None:
+            latest = history.latest_runs(limit=1)
+            bundle = history.get_run(latest[0])["bundle"] if latest else None
+        run_ids = history.latest_runs(bundle)[::-1] if bundle is not None else []
+        if len(run_ids) != 2:
+            parser.error(f"Expected two runs of {bundle} to compare, but there are {len(run_ids)}"
+                         if bundle is not None else "Expected two runs to compare, but there are none")
+    if len(run_ids) != 2:
+        parser.error("Expected two runs to compare")
+    try:
+        comparison = history.compare(*run_ids, args.resamples, args.seed)
+    except ValueError as error:
+        parser.error(str(error))
+    history.close()
+    elapsed = time.perf_counter() - start_time
+
+    for label, run in (("Baseline", comparison["baseline"]), ("Run", comparison["run"])):
+        print(f'{label:<8} {run["run_id"]}: {run["bundle"]}, corpus {run["corpus_id"]}, started {run["started_at"]}')
+    if comparison["baseline"]["bundle"] != comparison["run"]["bundle"]:
+        logging.warning("The runs are of different bundles, so queries are matched by number only")
+    for key, (before, after) in comparison["config_changes"].items():
+        print(f'  {key}: {before} -> {after}')
+
+    print(f'\n{"metric":<52} {"baseline":>10} {"run":>10} {"change":>10} {"p-value" if args.resamples else "":>8}')
+    for name, (before, after, change, p_value) in comparison["metric_changes"].items():
+        if change != 0:
+            p_value = f'{p_value:>8.4f}' if p_value is not None else f'{"":>8}'
+            print(f'{name:<52} {before:>10.4f} {after:>10.4f} {change:>+10.4f} {p_value}')
+
+    print(f'\n{len(comparison["regressions"])} queries regressed, {len(comparison["improvements"])} improved, '
+          f'{comparison["unchanged"]} unchanged, {comparison["only_in_baseline"]} only in the baseline and '
+          f'{comparison["only_in_run"]} only in the run (compared in {elapsed:.3f}s)')
+    for title, entries in (("Regressions", comparison["regressions"]), ("Improvements", comparison["improvements"])):
+        if not entries:
+            continue
+        print(f'\n{title} (file rank and file and phrase rank, 0 is no match):')
+        for entry in entries[:args.limit]:
+            failed = " FAILED" if entry["failed"][1] else " (failed before)" if entry["failed"][0] else ""
+            print(f'{entry["num"]:>8}  file {entry["file_rank"][0]:>3} -> {entry["file_rank"][1]:<3}  '
+                  f'phrase {entry["phrase_rank"][0]:>3} -> {entry["phrase_rank"][1]:<3}{failed}  {entry["query"]}')
 
-    return metrics
+    if args.output is not None:
+        with open(args.output, "w") as output_file:
+            json.dump(comparison, output_file)
+        logging.info("Comparison written to " + args.output)
 
 if __name__ == "__main__":
     logging.basicConfig(
         format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO)
 
+    #'run_eval.py merge ...' combines the partial results of a sharded run
+    if len(sys.argv) > 1 and sys.argv[1] == "merge":
+        merge_main(sys.argv[2:])
+        sys.exit()
+
+    #'run_eval.py compare ...' compares two recorded runs query by query
+    if len(sys.argv) > 1 and sys.argv[1] == "compare":
+        compare_main(sys.argv[2:])
+        sys.exit()
+
     parser = argparse.ArgumentParser(description="Vectara evaluation example")
 
     parser.add_argument("--customer-id", type=int, required=True,
                         help="Unique customer ID in Vectara platform.")
-    parser.add_argument("--corpus-id", type=int,
+    parser.add_argument("--corpus-id", type=lambda value: [int(corpus_id) for corpus_id in value.split(",")],
                         help="ID of corpus that contains the indexed data. If this is not provided then "
-                             "a new corpus will be created and this bundle's data will be uploaded to it.")
+                             "a new corpus will be created and this bundle's data will be uploaded to it. With "
+                             "several bundles, a comma-separated list with the corpus ID of each bundle.")
     parser.add_argument("--admin-endpoint", help="The endpoint of admin server.",
                         default="admin.vectara.io")
     parser.add_argument("--indexing-endpoint", help="The endpoint of indexing server.",
                         default="indexing.vectara.io")
     parser.add_argument("--serving-endpoint", help="The endpoint of querying server.",
                         default="serving.vectara.io")
-    parser.add_argument("--app-client-id",  required=True,
-                        help="This app client should have enough rights.")
-    parser.add_argument("--app-client-secret", required=True)
+    parser.add_argument("--app-client-id",
+                        help="This app client should have enough rights. Required unless --offline is used.")
+    parser.add_argument("--app-client-secret",
+                        help="Secret of the app client. Required unless --offline is used.")
     parser.add_argument("--auth-url",  default="",
                         help="The cognito auth url for this customer. If not set then this will "
                              "be constructed using the customer-id.")
-    parser.add_argument("--bundle", help="Which test bundle you want to use for the evaluation.",
-                        default="app-search")
+    parser.add_argument("--token-cache",
+                        help="File in which the auth token is kept so that later runs can reuse it while it is "
+                             "still valid. The file is only readable by the user.")
+    parser.add_argument("--token-refresh-margin", type=float, default=300,
+                        help="How many seconds before the auth token expires a new one is fetched in the background.")
+    parser.add_argument("--bundle", default="app-search",
+                        help="Which test bundle you want to use for the evaluation. Several bundles can be given as a "
+                             "comma-separated list, or 'all' for every bundle, and they are then run at the same time.")
+    parser.add_argument("--sync-data", action="store_true",
+                        help="With --corpus-id, upload the bundle's files that are new or have changed since they were "
+                             "last uploaded to the corpus (or whose upload failed), e.g. to resume an interrupted upload.")
+    parser.add_argument("--manifest-dir", default=".cache/manifests",
+                        help="Directory of the manifests that record which files have been uploaded to each corpus.")
+    parser.add_argument("--indexing-timeout", type=float, default=600,
+                        help="After uploading, wait up to this many seconds for the uploaded files to be searchable "
+                             "before running the queries. 0 starts the queries right away.")
+    parser.add_argument("--upload-concurrency", type=int, default=4,
+                        help="Number of files uploaded at the same time when indexing the bundle's data.")
+    parser.add_argument("--query-concurrency", type=int, default=1,
+                        help="Maximum number of query requests in flight at the same time. 1 runs them serially.")
+    parser.add_argument("--max-qps", type=float,
+                        help="Maximum number of query requests sent per second, to stay under the account's quota.")
+    parser.add_argument("--query-batch-size", type=int, default=1,
+                        help="Number of queries sent together in each query request.")
+    parser.add_argument("--max-retries", type=int, default=5,
+                        help="Maximum number of retries for a request that is throttled or fails with a server error.")
+    parser.add_argument("--k-values", type=lambda value: [int(k) for k in value.split(",")],
+                        default=list(DEFAULT_K_VALUES),
+                        help="Comma-separated cut-offs (K) for the metrics computed over the top K results, "
+                             "e.g. 1,3,5,10,20.")
+    parser.add_argument("--num-results", type=int,
+                        help="Number of results requested for each query. Defaults to the largest K, since only "
+                             "mean reciprocal rank looks deeper (it counts the first relevant result within this "
+                             "depth); the @K metrics and mean average precision only look at the top K.")
+    parser.add_argument("--phrase-match", choices=PHRASE_MATCH_MODES, default="exact",
+                        help="How result snippets are compared with the expected phrases. 'exact' is a case-insensitive "
+                             "containment check, 'normalized' also ignores whitespace and punctuation, 'fuzzy' "
+                             "also accepts a snippet that contains enough of the phrase's words in a row, and "
+                             "'aligned' locates the snippet and the phrase in the bundle's source file and accepts "
+                             "a snippet that covers enough of the phrase.")
+    parser.add_argument("--fuzzy-threshold", type=float, default=0.6,
+                        help="Fraction of a phrase's words that must appear in a row for a fuzzy phrase match.")
+    parser.add_argument("--overlap-threshold", type=float, default=0.5,
+                        help="Fraction of a phrase's characters that a snippet must cover for an aligned phrase match.")
+    parser.add_argument("--doc-index-dir", default=".cache/doc-index",
+                        help="Directory of the indexes of the bundles' files used by the aligned phrase match mode.")
+    parser.add_argument("--load-test", action="store_true",
+                        help="Instead of evaluating relevance, replay the bundle's queries open-loop at the rates "
+                             "given by --load-qps and report the achieved throughput, errors and latency of each step.")
+    parser.add_argument("--load-qps", type=lambda value: [float(rate) for rate in value.split(",")], default=[10.0],
+                        help="Comma-separated target rates (queries per second) of the load test steps, e.g. 10,20,40.")
+    parser.add_argument("--load-step-seconds", type=float, default=30,
+                        help="Duration of each load test step.")
+    parser.add_argument("--load-profile", choices=("step", "ramp"), default="step",
+                        help="'step' holds each rate for its whole step, 'ramp' moves linearly to the next rate.")
+    parser.add_argument("--load-arrivals", choices=("fixed", "poisson"), default="fixed",
+                        help="Send load test queries at evenly spaced times or as a Poisson process.")
+    parser.add_argument("--load-max-in-flight", type=int, default=256,
+                        help="Maximum number of load test queries in flight at the same time.")
+    parser.add_argument("--load-seed", type=int,
+                        help="Seed for the random arrival times of a Poisson load test.")
+    parser.add_argument("--sweep",
+                        help="Path of a JSON file with a grid of query body parameters (a dict from the dotted path "
+                             "of each parameter to a list of its values) or a list of configurations. Instead of one "
+                             "evaluation, the queries are run with every configuration at the same time and the "
+                             "metrics of each configuration are reported, with the best configuration for each metric.")
+    parser.add_argument("--profile",
+                        help="Optional path of a Chrome trace-event JSON file (for chrome://tracing or Perfetto) to "
+                             "which the time spent in each phase of the run is written. A summary of the total and "
+                             "self time of each phase is also printed. With several bundles, each bundle gets its "
+                             "own trace file.")
+    parser.add_argument("--trace",
+                        help="Optional path of a JSONL file to which a record of every query is written: its latency, "
+                             "the document IDs of its results and the ranks at which its expected matches were found. "
+                             "With several bundles, each bundle gets its own trace file.")
+    parser.add_argument("--bootstrap-resamples", type=int, default=0,
+                        help="If not 0, add bootstrap confidence intervals of every metric, from this many resamples "
+                             "of the queries, to the results.")
+    parser.add_argument("--confidence", type=float, default=0.95, help="Confidence level of the bootstrap intervals.")
+    parser.add_argument("--seed", type=int, help="Seed of the bootstrap resamples, for reproducible intervals.")
+    parser.add_argument("--record-history", action="store_true",
+                        help="Record the outcome of every query (its ranks, matches and latency) and the settings of "
+                             "the run in the run history, to compare runs with 'run_eval.py compare'.")
+    parser.add_argument("--history-db", default=DEFAULT_HISTORY_PATH, help="Path of the run history database.")
+    parser.add_argument("--trace-level", choices=TRACE_LEVELS, default="query",
+                        help="'query' writes one summary record per query, 'hits' also lists every result from an "
+                             "expected file with its snippet and the expected phrases it matched.")
+    parser.add_argument("--latency-samples",
+                        help="Optional path of a JSONL file to which the raw timing of every request is written.")
+    parser.add_argument("--cache-dir",
+                        help="Directory of an on-disk cache of query responses. Cached queries are scored "
+                             "without being sent again.")
+    parser.add_argument("--cache-max-age-days", type=float,
+                        help="Cached responses older than this are not used and are evicted from the cache.")
+    parser.add_argument("--cache-max-size-mb", type=float,
+                        help="When the cache grows larger than this, its oldest responses are evicted.")
+    parser.add_argument("--shard", type=lambda value: tuple(int(part) for part in value.split("/")),
+                        help="Only run the queries of shard i of N, given as i/N (0 <= i < N), and write their raw "
+                             "match data to a partial result file. Combine the partial results of all the shards "
+                             "with 'run_eval.py merge'. Requires --corpus-id.")
+    parser.add_argument("--offline", action="store_true",
+                        help="Score the queries entirely from the response cache, with no auth and no network "
+                             "access. Requires --cache-dir and --corpus-id.")
 
     args = parser.parse_args()
+    REQUEST_STATS.keep_samples = args.latency_samples is not None
+    PROFILER.enabled = args.profile is not None
+    try:
+        args.k_values = _get_k_values(args.k_values)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.offline and (args.cache_dir is None or args.corpus_id is None):
+        parser.error("--offline requires --cache-dir and --corpus-id")
+    if args.offline and args.load_test:
+        parser.error("--load-test can't be used with --offline")
+    if args.shard is not None and (len(args.shard) != 2 or not 0 <= args.shard[0] < args.shard[1]):
+        parser.error("--shard must be i/N with 0 <= i < N")
+    if args.shard is not None and (args.corpus_id is None or args.load_test):
+        parser.error("--shard requires --corpus-id and can't be used with --load-test")
+    if args.sweep is not None:
+        if args.load_test or args.shard is not None:
+            parser.error("--sweep can't be used with --load-test or --shard")
+        if args.record_history or args.trace is not None or args.bootstrap_resamples:
+            parser.error("--sweep can't be used with --record-history, --trace or --bootstrap-resamples")
+        try:
+            _get_sweep_configs(args.sweep)
+        except (OSError, ValueError) as error:
+            parser.error(str(error))
+    bundles = _get_bundles(args.bundle)
+    corpus_ids = args.corpus_id if args.corpus_id is not None else [None] * len(bundles)
+    if len(corpus_ids) != len(bundles):
+        parser.error("--corpus-id must have one corpus ID for each bundle")
+    if not args.offline and (args.app_client_id is None or args.app_client_secret is None):
+        parser.error("--app-client-id and --app-client-secret are required unless --offline is used")
 
     if args:
         auth_url = args.auth_url
         if auth_url == "":
             auth_url = f"https://vectara-prod-{args.customer_id}.auth.us-west-2.amazoncognito.com"
 
-        token = _get_jwt_token(auth_url, args.app_client_id, args.app_client_secret)
-
-        if token:
-            # Create a corpus and upload the test data if we were not given a corpus ID
-            if args.corpus_id is None:
-                result, status, created_corpus_id = create_corpus(args.customer_id,
-                                              args.admin_endpoint,
-                                              token,
-                                              args.bundle)
-                logging.info("Created corpus to store the test data response: %s", result.text)
-                args.corpus_id = created_corpus_id
-
-                # Upload the data for this evaluation bundle
-                result, status = upload_data(args.customer_id,
-                                      args.corpus_id,
-                                      args.indexing_endpoint,
-                                      "bundles/" + args.bundle + "/data",
-                                      token)
-                logging.info("Data for %s bundle indexed: %s", args.bundle, result)
-
-            print('Using the following corpus ID for the test queries: ' + str(args.corpus_id))
-
-            # Run the queries for this evaluation bundle
-            metrics = run_queries(args.customer_id,
-                                  args.corpus_id,
-                                  args.serving_endpoint,
-                                  token,
-                                  "bundles/" + args.bundle + "/queries.csv")
-
-            # Save the metrics from the query test to a file
-            print("Metrics: " + str(metrics))
-            results_filename = "results/results-" + args.bundle + "-" + \
-                               datetime.datetime.now().strftime("%m_%d_%Y_%H_%M_%S") + ".json"
-            text_file = open(results_filename, "w")
-            n = text_file.write(json.dumps(metrics))
-            text_file.close()
-
-            logging.info("Evaluation metrics written to " + results_filename)
+        if args.offline:
+            token = None
+        else:
+            #The provider is shared by all the workers and keeps the token fresh for as long as the run takes
+            token = TokenProvider(auth_url, args.app_client_id, args.app_client_secret,
+                                  args.token_refresh_margin, args.token_cache)
+
+        if args.offline or token.get():
+            failures = {}
+            if len(bundles) == 1:
+                try:
+                    results, _ = run_bundle(args, bundles[0], corpus_ids[0], token, args.latency_samples, args.trace)
+                except ValueError as error:
+                    logging.error("The %s bundle failed: %s", bundles[0], error)
+                    sys.exit(1)
+                if args.load_test:
+                    results_filename = "results/loadtest-" + bundles[0] + "-" + \
+                                       datetime.datetime.now().strftime("%m_%d_%Y_%H_%M_%S") + ".json"
+                    logging.info("Load test results written to " + results_filename)
+                elif args.sweep is not None:
+                    results_filename = "results/sweep-" + bundles[0] + "-" + \
+                                       datetime.datetime.now().strftime("%m_%d_%Y_%H_%M_%S") + ".json"
+                    logging.info("Sweep results written to " + results_filename)
+                else:
+                    results_filename = "results/results-" + bundles[0] + "-" + \
+                                       datetime.datetime.now().strftime("%m_%d_%Y_%H_%M_%S") + ".json"
+                    logging.info("Evaluation metrics written to " + results_filename)
+                with open(results_filename, "w") as text_file:
+                    text_file.write(json.dumps(results))
+            else:
+                # Run the bundles at the same time, each in its own process, starting from the token fetched above
+                start_time = time.perf_counter()
+                results = {"bundles": {}}
+                overall = MetricAccumulator()
+                with concurrent.futures.ProcessPoolExecutor(max_workers=len(bundles)) as executor:
+                    futures = {}
+                    for bundle, corpus_id in zip(bundles, corpus_ids):
+                        latency_samples = None
+                        if args.latency_samples is not None:
+                            root, ext = os.path.splitext(args.latency_samples)
+                            latency_samples = f"{root}-{bundle}{ext}"
+                        profile = None
+                        if args.profile is not None:
+                            root, ext = os.path.splitext(args.profile)
+                            profile = f"{root}-{bundle}{ext}"
+                        trace = None
+                        if args.trace is not None:
+                            root, ext = os.path.splitext(args.trace)
+                            trace = f"{root}-{bundle}{ext}"
+                        futures[bundle] = executor.submit(_run_bundle_in_process, args, bundle, corpus_id, auth_url,
+                                                          token.token if token is not None else None,
+                                                          latency_samples, profile, trace)
+                    for bundle, future in futures.items():
+                        #A bundle that fails doesn't discard the results of the others
+                        try:
+                            bundle_results, accumulator, profile_summary = future.result()
+                        except Exception as error:
+                            logging.error("The %s bundle failed: %s", bundle, error)
+                            failures[bundle] = f"{type(error).__name__}: {error}"
+                            continue
+                        results["bundles"][bundle] = bundle_results
+                        PROFILER.merge(profile_summary)
+                        if accumulator is not None:
+                            overall.merge(accumulator)
+
+                # The overall metrics are over all the queries of all the bundles
+                if overall.count > 0:
+                    results["overall"] = overall.means()
+                results["wall_seconds"] = time.perf_counter() - start_time
+                results["sequential_seconds"] = sum(bundle_results["elapsed_seconds"]
+                                                    for bundle_results in results["bundles"].values())
+                if failures:
+                    results["failed_bundles"] = failures
+                print(f'Ran {len(bundles)} bundles in {results["wall_seconds"]:.1f}s '
+                      f'(the bundles took {results["sequential_seconds"]:.1f}s in total)')
+                if results["bundles"]:
+                    results_filename = ("results/loadtest-" if args.load_test else
+                                        "results/sweep-" if args.sweep is not None else "results/results-") + \
+                                       "+".join(bundles) + "-" + \
+                                       datetime.datetime.now().strftime("%m_%d_%Y_%H_%M_%S") + ".json"
+                    with open(results_filename, "w") as text_file:
+                        text_file.write(json.dumps(results))
+                    logging.info("Results of the bundles that finished written to " + results_filename)
+
+            if token is not None:
+                token.close()
+            if args.profile is not None:
+                PROFILER.write_trace(args.profile)
+                print()
+                PROFILER.print_summary()
+                logging.info("Profile written to " + args.profile)
+            if failures:
+                logging.error("%d of %d bundles failed: %s", len(failures), len(bundles),
+                              "; ".join(f"{bundle}: {error}" for bundle, error in failures.items()))
+                sys.exit(1)
         else:
             logging.error("Could not generate an auth token. Please check your credentials.")
@@ -0,0 +1,43 @@
+""" Shared fixtures of the tests. The tests import run_eval and vectara_emulator from the repository root, and run
+from it, since the harness reads the bundles by relative path. """
+
+import os
+import sys
+
+import pytest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+#The emulator serves tokens over plain HTTP
+os.environ.setdefault("AUTHLIB_INSECURE_TRANSPORT", "1")
+
+@pytest.fixture(autouse=True)
+def repo_root(monkeypatch):
+    monkeypatch.chdir(ROOT)
+    return ROOT
+
+#Corpus of the emulator into which the app-search bundle's data is preloaded
+APP_SEARCH_CORPUS_ID = 1
+
+@pytest.fixture(scope="session")
+def emulator():
+    """ Base URL of an in-process emulator with the app-search bundle's data in corpus APP_SEARCH_CORPUS_ID. """
+    import vectara_emulator
+    server = vectara_emulator.start_emulator()
+    vectara_emulator.preload(server, APP_SEARCH_CORPUS_ID, os.path.join(ROOT, "bundles", "app-search", "data"))
+    yield f"http://localhost:{server.server_port}"
+    server.shutdown()
+
+@pytest.fixture(scope="session")
+def queries_file(tmp_path_factory):
+    """ Path of a queries file with the app-search queries three times over, numbered out of order, so that runs
+    have enough queries to be spread over several requests and shards. """
+    with open(os.path.join(ROOT, "bundles", "app-search", "queries.csv")) as queries:
+        lines = [line.rstrip("\n").split("|", 1) for line in queries if line.strip()]
+    path = tmp_path_factory.mktemp("queries") / "queries.csv"
+    with open(path, "w") as queries:
+        for copy in range(3):
+            for num, rest in reversed(lines):
+                queries.write(f"{copy * 100 + int(num)}|{rest}\n")
+    return str(path)
@@ -0,0 +1,28 @@
+""" Tests of reading the text of a bundle's data files. """
+
+import json
+import os
+
+import run_eval
+
+def test_probe_phrase_is_read_from_a_prefix(tmp_path):
+    path = tmp_path / "1-text"
+    lines = [f"line {num} " + "word " * num for num in range(100)]
+    path.write_text("\n".join(lines) + "\n" + "x" * (run_eval.PROBE_PREFIX_BYTES * 2))
+    text = run_eval._read_document_text(str(path), run_eval.PROBE_PREFIX_BYTES)
+    assert text.splitlines() == lines
+    assert run_eval._get_probe_phrase(str(path), 3) == "line 99 word"
+
+def test_cut_off_json_document_keeps_its_complete_texts(tmp_path):
+    path = tmp_path / "1-doc.json"
+    sections = [{"id": str(num), "text": f'Section "{num}" ' + "a" * 1000} for num in range(100)]
+    path.write_text(json.dumps({"title": "Title", "section": sections}))
+    text = run_eval._read_document_text(str(path), 10000)
+    assert text.splitlines()[:2] == ["Title", 'Section "0" ' + "a" * 1000]
+    assert len(text) < 10000
+    assert run_eval._read_document_text(str(path)).splitlines()[-1] == 'Section "99" ' + "a" * 1000
+
+def test_pdf_has_no_text(repo_root):
+    data_dir = os.path.join(repo_root, "bundles", "doc-search", "data")
+    pdf = os.path.join(data_dir, sorted(os.listdir(data_dir))[0])
+    assert run_eval._read_document_text(pdf, run_eval.PROBE_PREFIX_BYTES) is None
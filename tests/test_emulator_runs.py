@@ -0,0 +1,102 @@
+""" Tests of whole evaluation runs against the in-process emulator: however the queries are sent, sharded or cached,
+the metrics are those of a plain serial run. """
+
+import os
+import shutil
+
+import pytest
+
+import run_eval
+from conftest import APP_SEARCH_CORPUS_ID
+
+TOKEN = "emulator-token"
+
+def _run(emulator, queries_file, **kwargs):
+    return run_eval.run_queries(1, APP_SEARCH_CORPUS_ID, emulator, TOKEN, queries_file, **kwargs)
+
+@pytest.fixture(scope="module")
+def serial(emulator, queries_file):
+    """ The metrics of a plain serial run of the queries. """
+    return _run(emulator, queries_file)
+
+def test_serial_run_finds_matches(serial):
+    assert serial["file_match_mean_reciprocal_rank"] > 0
+    assert serial["file_match_mean_r_at_10"] > 0
+
+@pytest.mark.parametrize("concurrency, batch_size, max_qps", [(4, 1, None), (1, 4, None), (3, 4, None),
+                                                              (4, 1, 200)])
+def test_concurrent_and_batched_runs_equal_the_serial_run(emulator, queries_file, serial, concurrency, batch_size,
+                                                          max_qps):
+    assert _run(emulator, queries_file, concurrency=concurrency, batch_size=batch_size, max_qps=max_qps) == serial
+
+def test_shard_merge_equals_the_unsharded_run(emulator, queries_file, serial, tmp_path):
+    num_shards = 3
+    paths = []
+    for shard in range(num_shards):
+        path = str(tmp_path / f"partial-{shard}.jsonl.gz")
+        partial = run_eval.PartialResultWriter(path, {
+            "bundle": "app-search", "queries_file": queries_file, "corpus_id": APP_SEARCH_CORPUS_ID,
+            "num_shards": num_shards, "shard": shard, "depth": 10, "k_values": list(run_eval.DEFAULT_K_VALUES),
+        })
+        _run(emulator, queries_file, shard=(shard, num_shards), partial=partial, concurrency=2)
+        partial.close()
+        paths.append(path)
+    merged = run_eval.merge_partial_results(list(reversed(paths)))
+    shard_counts = merged.pop("shards")
+    with open(queries_file) as queries:
+        assert sum(counts["queries"] for counts in shard_counts.values()) == len(queries.readlines())
+    assert merged == serial
+
+def test_offline_run_from_the_cache_equals_the_online_run(emulator, queries_file, serial, tmp_path):
+    cache = run_eval.ResponseCache(str(tmp_path / "cache"))
+    online = _run(emulator, queries_file, cache=cache, batch_size=4)
+    cache.close()
+    cache = run_eval.ResponseCache(str(tmp_path / "cache"))
+    #No token: every response has to come from the cache, here for fewer results than were cached
+    offline = run_eval.run_queries(1, APP_SEARCH_CORPUS_ID, emulator, None, queries_file, cache=cache,
+                                   offline=True, k_values=[1, 3, 5])
+    cache.close()
+    assert offline == _run(emulator, queries_file, k_values=[1, 3, 5])
+    assert online == serial
+
+def test_bootstrap_intervals_are_reproducible_with_a_seed(emulator, queries_file):
+    serial = _run(emulator, queries_file, bootstrap_resamples=500, seed=7)
+    concurrent = _run(emulator, queries_file, concurrency=4, bootstrap_resamples=500, seed=7)
+    assert concurrent["confidence_intervals"] == serial["confidence_intervals"]
+    lower, upper = serial["confidence_intervals"]["file_match_mean_reciprocal_rank"]
+    assert lower <= serial["file_match_mean_reciprocal_rank"] <= upper
+
+def test_upload_resumes_from_the_manifest(emulator, tmp_path):
+    import vectara_emulator
+    data_dir = tmp_path / "data"
+    source_dir = os.path.join("bundles", "app-search", "data")
+    data_dir.mkdir()
+    for name in sorted(os.listdir(source_dir))[:6]:
+        shutil.copy(os.path.join(source_dir, name), data_dir / name)
+    server = vectara_emulator.start_emulator(config=vectara_emulator.EmulatorConfig(error_rate=0.5))
+    try:
+        address = f"http://localhost:{server.server_port}"
+        manifest_path = run_eval._get_manifest_path(str(tmp_path / "manifests"), address, 1, 1, "app-search")
+
+        #Without retries about half the uploads fail, and only those are uploaded again
+        responses, _ = run_eval.upload_data(1, 1, address, str(data_dir), TOKEN, max_retries=0,
+                                            manifest_path=manifest_path)
+        failed = {path for path, response in responses.items() if response.status_code != 200}
+        server.config.error_rate = 0
+        responses, status = run_eval.upload_data(1, 1, address, str(data_dir), TOKEN, manifest_path=manifest_path)
+        assert status and set(responses) == failed
+
+        #Nothing changed, so nothing is uploaded
+        responses, status = run_eval.upload_data(1, 1, address, str(data_dir), TOKEN, manifest_path=manifest_path)
+        assert status and not responses
+
+        #Only the file that changed is uploaded again, unless the corpus is new
+        changed = sorted(data_dir.iterdir())[0]
+        changed.write_bytes(changed.read_bytes() + b"\nOne more review.\n")
+        responses, status = run_eval.upload_data(1, 1, address, str(data_dir), TOKEN, manifest_path=manifest_path)
+        assert status and set(responses) == {str(changed)}
+        responses, status = run_eval.upload_data(1, 1, address, str(data_dir), TOKEN, manifest_path=manifest_path,
+                                                 new_corpus=True)
+        assert status and len(responses) == 6
+    finally:
+        server.shutdown()
@@ -0,0 +1,32 @@
+""" Tests of the run history and of comparing recorded runs. """
+
+import pytest
+
+import run_eval
+
+def _record(history, bundle):
+    run_id = history.start_run(bundle, 1, {"k_values": [1, 3, 5, 10]})
+    history.finish_run(run_id, {"file_match_mean_reciprocal_rank": 0.5})
+    return run_id
+
+def test_compare_defaults_to_the_latest_runs_of_the_latest_bundle(tmp_path, capsys):
+    path = str(tmp_path / "history.sqlite")
+    history = run_eval.RunHistory(path)
+    baseline = _record(history, "app-search")
+    _record(history, "faq-search")
+    run = _record(history, "app-search")
+    history.close()
+    run_eval.compare_main(["--history-db", path])
+    output = capsys.readouterr().out
+    assert f"Baseline {baseline}: app-search" in output
+    assert f"Run      {run}: app-search" in output
+
+def test_compare_needs_two_runs_of_the_same_bundle(tmp_path, capsys):
+    path = str(tmp_path / "history.sqlite")
+    history = run_eval.RunHistory(path)
+    _record(history, "app-search")
+    _record(history, "faq-search")
+    history.close()
+    with pytest.raises(SystemExit):
+        run_eval.compare_main(["--history-db", path])
+    assert "Expected two runs of faq-search to compare, but there are 1" in capsys.readouterr().err
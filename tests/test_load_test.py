@@ -0,0 +1,25 @@
+""" Tests of the schedule of the open-loop load test. """
+
+import pytest
+
+import run_eval
+
+def test_step_schedule_sends_rate_times_duration():
+    schedule = run_eval._get_load_test_schedule([10, 20], 10)
+    assert sum(1 for _, step in schedule if step == 0) == pytest.approx(100, abs=1)
+    assert sum(1 for _, step in schedule if step == 1) == pytest.approx(200, abs=1)
+    assert [offset for offset, _ in schedule] == sorted(offset for offset, _ in schedule)
+
+@pytest.mark.parametrize("arrivals", ["fixed", "poisson"])
+def test_ramp_from_zero_sends_half_the_end_rate(arrivals):
+    schedule = run_eval._get_load_test_schedule([0, 100], 10, "ramp", arrivals, seed=1)
+    step_offsets = [offset for offset, step in schedule if step == 0]
+    #The rate rises linearly from 0 to 100 QPS, so about 100 * 10 / 2 requests are sent
+    assert len(step_offsets) == pytest.approx(500, rel=0.1)
+    #...and more of them in the second half of the step
+    assert sum(1 for offset in step_offsets if offset >= 5) > 2 * sum(1 for offset in step_offsets if offset < 5)
+
+def test_ramp_down_to_zero_ends_the_step_early():
+    schedule = run_eval._get_load_test_schedule([100, 0], 10, "ramp")
+    assert sum(1 for _, step in schedule if step == 0) == pytest.approx(500, abs=1)
+    assert not [step for _, step in schedule if step == 1]
@@ -0,0 +1,95 @@
+""" Tests of the metrics computed from the relevance of the results. """
+
+import fractions
+import random
+
+import numpy as np
+import pytest
+
+import run_eval
+
+#The metrics of the original script for the responses of _get_responses(), as it computed them: a float sum in order
+#of query number divided by the number of queries. Most of them differ in the last bit from the correctly rounded mean.
+LEGACY_METRICS = {
+    "file_match_mean_r_at_1": 0.3783783783783784,
+    "file_match_mean_r_at_3": 0.3333333333333334,
+    "file_match_mean_r_at_5": 0.30270270270270266,
+    "file_match_mean_r_at_10": 0.31351351351351353,
+    "file_match_mean_reciprocal_rank": 0.5546117546117546,
+    "file_and_phrase_match_mean_r_at_1": 0.24324324324324326,
+    "file_and_phrase_match_mean_r_at_3": 0.18018018018018012,
+    "file_and_phrase_match_mean_r_at_5": 0.15135135135135142,
+    "file_and_phrase_match_mean_r_at_10": 0.16756756756756758,
+    "file_match_and_phrase_mean_reciprocal_rank": 0.39039039039039025,
+}
+
+def _get_responses():
+    """ Returns a fixed list of (query number, file relevance, file and phrase relevance) of the top 10 results of
+    queries that each have one expected match. """
+    rng = random.Random(13)
+    responses = []
+    for num in range(1, 38):
+        file_relevance = [int(rng.random() < 0.3) for _ in range(10)]
+        phrase_relevance = [relevant and int(rng.random() < 0.5) for relevant in file_relevance]
+        responses.append((num, file_relevance, phrase_relevance))
+    return responses
+
+def _score(responses, blocks):
+    for num, file_relevance, phrase_relevance in responses:
+        row = blocks.new_row(1, num)
+        for layer, relevance in ((run_eval.FILE_LAYER, file_relevance),
+                                 (run_eval.FILE_AND_PHRASE_LAYER, phrase_relevance)):
+            blocks.relevance[layer, row, :len(relevance)] = relevance
+            blocks.match_ranks[layer, row, 0] = relevance.index(1) + 1 if 1 in relevance else 0
+    return blocks.finish()
+
+@pytest.mark.parametrize("block_size", [1, 8, 1024])
+def test_legacy_metrics_are_summed_in_query_order(block_size):
+    responses = _get_responses()
+    #Responses arrive in any order, e.g. from concurrent requests
+    random.Random(5).shuffle(responses)
+    metrics = _score(responses, run_eval.RelevanceBlocks(depth=10, block_size=block_size)).means()
+    for name, value in LEGACY_METRICS.items():
+        assert metrics[name] == value, name
+    first_in_top_3 = sum(1 for _, file_relevance, _ in responses if 1 in file_relevance[:3])
+    assert metrics["file_match_percent_first_match_in_top_3"] == first_in_top_3 / len(responses)
+
+def test_merged_legacy_metrics_are_summed_in_query_order():
+    responses = _get_responses()
+    #E.g. the shards of a sharded run, which each have every other query
+    accumulator = _score(responses[1::2], run_eval.RelevanceBlocks(depth=10, block_size=4))
+    accumulator.merge(_score(responses[::2], run_eval.RelevanceBlocks(depth=10, block_size=4)))
+    metrics = accumulator.means()
+    for name, value in LEGACY_METRICS.items():
+        assert metrics[name] == value, name
+    assert list(metrics) == list(_score(responses, run_eval.RelevanceBlocks(depth=10)).means())
+
+def test_new_metrics_are_correctly_rounded():
+    values = np.array([0.1, 0.2, 0.3])
+    accumulator = run_eval.MetricAccumulator()
+    accumulator.add({"ndcg_at_10": values[:1]})
+    accumulator.add({"ndcg_at_10": values[1:]})
+    exact = sum(fractions.Fraction(value) for value in values.tolist()) / len(values)
+    assert accumulator.means()["ndcg_at_10"] == float(exact)
+    assert float(exact) != sum(values.tolist()) / len(values)
+
+def test_k_values_are_sorted():
+    assert run_eval._get_k_values([10, 1, 5, 3]) == [1, 3, 5, 10]
+
+@pytest.mark.parametrize("k_values", [[0, 5], [-1], [5, 10, 5]])
+def test_invalid_k_values_are_rejected(k_values):
+    with pytest.raises(ValueError, match="--k-values"):
+        run_eval._get_k_values(k_values)
+
+def test_bootstrap_and_randomization_test_are_reproducible_with_a_seed():
+    rng = np.random.default_rng(0)
+    values_a = {"mrr": rng.random(200), "r_at_1": rng.integers(0, 2, 200).astype(float)}
+    values_b = {"mrr": values_a["mrr"] + rng.normal(0, 0.1, 200), "r_at_1": rng.integers(0, 2, 200).astype(float)}
+    intervals = run_eval.bootstrap_confidence_intervals(values_a, 2000, seed=3)
+    #Drawing the resamples in chunks of another size doesn't change them
+    assert run_eval.bootstrap_confidence_intervals(values_a, 2000, seed=3, chunk_elements=1000) == intervals
+    assert run_eval.bootstrap_confidence_intervals(values_a, 2000, seed=4) != intervals
+    assert intervals["mrr"][0] < values_a["mrr"].mean() < intervals["mrr"][1]
+    p_values = run_eval.paired_randomization_test(values_a, values_b, 2000, seed=3)
+    assert run_eval.paired_randomization_test(values_a, values_b, 2000, seed=3, chunk_elements=1000) == p_values
+    assert 0 <= p_values["mrr"] <= 1
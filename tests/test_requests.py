@@ -0,0 +1,35 @@
+""" Tests of how requests are built and paced. """
+
+import json
+import os
+import time
+
+import pytest
+import requests
+
+import run_eval
+
+def test_multipart_stream_matches_the_body_requests_builds(tmp_path):
+    path = tmp_path / 'review "1".txt'
+    path.write_bytes(os.urandom(10000) + "Très bien\n".encode())
+    doc_metadata = json.dumps({"filepath": str(path)})
+    sent = []
+    with open(path, "rb") as file_handle:
+        expected = requests.Request("POST", "http://localhost/upload", files={
+            "file": (str(path), file_handle), "doc_metadata": doc_metadata}).prepare()
+    with run_eval.MultipartFileStream("file", str(path), {"doc_metadata": doc_metadata}, chunk_size=4096,
+                                      progress=lambda done, total: sent.append((done, total))) as body:
+        data = b"".join(body)
+    boundary = expected.headers["Content-Type"].split("boundary=")[1]
+    assert data.replace(body.boundary.encode(), boundary.encode()) == expected.body
+    assert len(body) == len(data)
+    assert body.content_type == f"multipart/form-data; boundary={body.boundary}"
+    assert sent[-1] == (len(data), len(data))
+
+def test_token_bucket_keeps_to_its_rate():
+    bucket = run_eval.TokenBucket(50, burst=5)
+    start = time.monotonic()
+    for _ in range(30):
+        bucket.acquire()
+    #The first 5 are the burst, and the other 25 come at 50 per second
+    assert time.monotonic() - start == pytest.approx(0.5, abs=0.1)
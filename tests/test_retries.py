@@ -0,0 +1,22 @@
+""" Tests of the retries of throttled and failed requests. """
+
+import datetime
+import email.utils
+
+import pytest
+
+import run_eval
+
+def test_retry_after_seconds():
+    assert run_eval._get_retry_after_seconds("3") == 3
+    assert run_eval._get_retry_after_seconds(" 0 ") == 0
+
+def test_retry_after_http_date():
+    date = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(seconds=30)
+    assert run_eval._get_retry_after_seconds(email.utils.format_datetime(date, usegmt=True)) == \
+        pytest.approx(30, abs=2)
+    assert run_eval._get_retry_after_seconds("Wed, 21 Oct 2015 07:28:00 GMT") == 0
+
+@pytest.mark.parametrize("retry_after", ["0.25", "-1", "soon", ""])
+def test_other_retry_after_values_are_ignored(retry_after):
+    assert run_eval._get_retry_after_seconds(retry_after) is None
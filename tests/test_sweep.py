@@ -0,0 +1,30 @@
+""" Tests of the configurations of a parameter sweep. """
+
+import json
+
+import pytest
+
+import run_eval
+
+def _write_sweep(tmp_path, sweep):
+    path = tmp_path / "sweep.json"
+    path.write_text(json.dumps(sweep))
+    return str(path)
+
+def test_grid_is_expanded(tmp_path):
+    configs = run_eval._get_sweep_configs(_write_sweep(tmp_path, {
+        "num_results": [10, 20], "corpus_key.lexical_interpolation_config.lambda": [0, 0.025]}))
+    assert len(configs) == 4
+    query_obj = run_eval._get_query_obj(1, 2, "query", overrides=configs[1])
+    assert query_obj["num_results"] == 10
+    assert query_obj["corpus_key"] == [{"customer_id": 1, "corpus_id": 2,
+                                        "lexical_interpolation_config": {"lambda": 0.025}}]
+
+@pytest.mark.parametrize("sweep, key", [
+    ({"num_results.lambda": [0.1]}, "num_results.lambda"),
+    ([{"rerank": 1, "rerank.k": 2}], "rerank.k"),
+    ({"corpus_key.customer_id.x": [1]}, "corpus_key.customer_id.x"),
+])
+def test_path_through_a_scalar_is_rejected_when_loaded(tmp_path, sweep, key):
+    with pytest.raises(ValueError, match=f"'{key}'"):
+        run_eval._get_sweep_configs(_write_sweep(tmp_path, sweep))
@@ -0,0 +1,357 @@
+""" A local stand-in for the parts of the Vectara API that run_eval.py uses, so that the evaluation harness itself
+can be run, tested and benchmarked without credentials or network access.
+
+It serves the token endpoint (/oauth2/token), corpus creation (/v1/create-corpus), file upload (/upload) and the
+query endpoint (/v1/query) over plain HTTP. Uploaded files are split into passages and indexed with a simple BM25
+retriever, so queries return real passages of the uploaded files. Queries to a corpus with no documents return
+placeholder results. Latency, jitter, throttling and errors can be configured. Point run_eval.py at it with e.g.:
+    AUTHLIB_INSECURE_TRANSPORT=1 python3 run_eval.py --auth-url http://localhost:8080 \\
+        --admin-endpoint http://localhost:8080 --indexing-endpoint http://localhost:8080 \\
+        --serving-endpoint http://localhost:8080 ...
+(AUTHLIB_INSECURE_TRANSPORT lets the OAuth client fetch a token over plain HTTP.)
+"""
+
+import argparse
+import collections
+import heapq
+import http.server
+import json
+import logging
+import math
+import os
+import random
+import re
+import threading
+import time
+import urllib.parse
+import zlib
+
+#Words as the retriever sees them
+WORD_PATTERN = re.compile(r"\w+")
+
+#Places where passages are split: the end of a sentence, or a line break or tab (e.g. between fields)
+PASSAGE_BREAK_PATTERN = re.compile(r"(?<=[.!?])\s+|[\r\n\t]+")
+
+#Compressed streams and text strings of a PDF file (see _extract_pdf_text())
+PDF_STREAM_PATTERN = re.compile(rb"stream\r?\n(.*?)\r?\nendstream", re.S)
+PDF_STRING_PATTERN = re.compile(rb"\(((?:[^()\\]|\\.)*)\)")
+
+class EmulatorConfig:
+    """ Settings that control how the emulator responds. """
+
+    def __init__(self, latency_ms: float = 0, jitter_ms: float = 0, throttle_qps: float = None,
+                 error_rate: float = 0):
+        """
+        Args:
+            latency_ms: Time each query and upload takes to answer
+            jitter_ms: Maximum random time added to the latency of each query and upload
+            throttle_qps: Optional maximum number of API requests (other than for tokens) accepted per second.
+                Requests over the limit are rejected with a 429 and a Retry-After header of 1 / throttle_qps
+                seconds, rounded up to a whole number of seconds as the header requires.
+            error_rate: Fraction of API requests (other than for tokens) that fail with a 503
+        """
+        self.latency_ms = latency_ms
+        self.jitter_ms = jitter_ms
+        self.throttle_qps = throttle_qps
+        self.error_rate = error_rate
+
+class PassageIndex:
+    """ BM25 index of the passages of the documents of one corpus. Thread-safe. """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.documents = []
+        #Each passage is (text, index of its document, number of words)
+        self.passages = []
+        #Word -> list of (passage index, number of times the word is in the passage)
+        self.postings = collections.defaultdict(list)
+        self.total_words = 0
+
+    def add_document(self, doc_id: str, text: str, metadata: {} = None):
+        """ Splits a document into passages and indexes them. A document with the same ID is replaced. """
+        passages = [passage.strip() for passage in PASSAGE_BREAK_PATTERN.split(text)]
+        passages = [passage for passage in passages if WORD_PATTERN.search(passage)]
+        with self.lock:
+            for doc_idx, document in enumerate(self.documents):
+                if document["id"] == doc_id:
+                    self._remove_document(doc_idx)
+                    break
+            doc_idx = len(self.documents)
+            self.documents.append({"id": doc_id, "metadata": [{"name": name, "value": str(value)}
+                                                              for name, value in (metadata or {}).items()]})
+            for passage in passages:
+                words = collections.Counter(word.lower() for word in WORD_PATTERN.findall(passage))
+                passage_idx = len(self.passages)
+                num_words = sum(words.values())
+                self.passages.append((passage, doc_idx, num_words))
+                self.total_words += num_words
+                for word, count in words.items():
+                    self.postings[word].append((passage_idx, count))
+
+    def _remove_document(self, doc_idx: int):
+        """ Stops returning the passages of a document. The lock must be held. """
+        self.documents[doc_idx]["id"] = None
+        for word, postings in self.postings.items():
+            self.postings[word] = [(passage_idx, count) for passage_idx, count in postings
+                                   if self.passages[passage_idx][1] != doc_idx]
+
+    def search(self, query: str, num_results: int):
+        """ Returns the response set of a query, with its top num_results passages. """
+        with self.lock:
+            num_passages = len(self.passages)
+            average_words = self.total_words / max(num_passages, 1)
+            scores = collections.defaultdict(float)
+            for word in set(word.lower() for word in WORD_PATTERN.findall(query)):
+                postings = self.postings.get(word)
+                if not postings:
+                    continue
+                idf = math.log(1 + (num_passages - len(postings) + 0.5) / (len(postings) + 0.5))
+                for passage_idx, count in postings:
+                    norm = self.K1 * (1 - self.B + self.B * self.passages[passage_idx][2] / average_words)
+                    scores[passage_idx] += idf * count * (self.K1 + 1) / (count + norm)
+            top = heapq.nlargest(num_results, scores.items(), key=lambda item: item[1])
+
+            #Only return the documents of the passages that were found, renumbered in order of first appearance
+            documents = {}
+            response = []
+            for passage_idx, score in top:
+                text, doc_idx, _ = self.passages[passage_idx]
+                response_doc_idx = documents.setdefault(doc_idx, len(documents))
+                response.append({"text": text, "score": score, "documentIndex": response_doc_idx})
+            return {"response": response, "status": [],
+                    "document": [self.documents[doc_idx] for doc_idx in documents]}
+
+def _extract_pdf_text(data: bytes):
+    """ Best-effort extraction of the text of a PDF file: the strings shown by its (possibly compressed) content
+    streams. Good enough to find passages by their words, but the text of PDFs with custom font encodings is lost. """
+    chunks = []
+    for stream in PDF_STREAM_PATTERN.findall(data):
+        try:
+            stream = zlib.decompress(stream)
+        except zlib.error:
+            pass
+        strings = PDF_STRING_PATTERN.findall(stream)
+        if strings:
+            chunks.append(b"".join(strings).decode("latin-1") + "\n")
+    return "".join(chunks)
+
+def _extract_text(filename: str, data: bytes):
+    """ Returns the text of an uploaded file: the 'title' and 'text' fields of a JSON document, the text of a PDF,
+    or else the file decoded as UTF-8. """
+    if data.startswith(b"%PDF"):
+        return _extract_pdf_text(data)
+    if filename.endswith(".json"):
+        try:
+            texts = []
+            stack = [json.loads(data)]
+            while stack:
+                item = stack.pop()
+                if isinstance(item, dict):
+                    texts.extend(str(item[key]) for key in ("title", "text") if isinstance(item.get(key), str))
+                    stack.extend(reversed([value for value in item.values() if isinstance(value, (dict, list))]))
+                elif isinstance(item, list):
+                    stack.extend(reversed(item))
+            return "\n".join(texts)
+        except ValueError:
+            pass
+    return data.decode("utf-8", errors="replace")
+
+def _parse_multipart(content_type: str, body: bytes):
+    """ Returns the parts of a multipart/form-data body as a dict from field name to (file name, content). """
+    boundary = re.search(r'boundary="?([^";]+)"?', content_type).group(1).encode()
+    parts = {}
+    for part in body.split(b"--" + boundary)[1:]:
+        if part.startswith(b"--"):
+            break
+        headers, _, content = part.partition(b"\r\n\r\n")
+        headers = headers.decode("utf-8", errors="replace")
+        name = re.search(r'name="([^"]*)"', headers)
+        filename = re.search(r'filename="([^"]*)"', headers)
+        if name is not None:
+            parts[name.group(1)] = (filename.group(1) if filename else None, content[:-2])
+    return parts
+
+class EmulatorRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ Handles one request to the emulator. The config is set on the server as 'config', and the corpora as
+    'corpora' (a dict from corpus ID to PassageIndex). """
+
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        logging.debug("%s - " + format, self.address_string(), *args)
+
+    def _send_json(self, status: int, body: {}, headers: {} = None):
+        payload = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def _sleep_latency(self):
+        config = self.server.config
+        delay_ms = config.latency_ms + random.uniform(0, config.jitter_ms)
+        if delay_ms > 0:
+            time.sleep(delay_ms / 1000)
+
+    def _reject(self):
+        """ Sends a throttling or an injected error response if the request should get one, and returns whether
+        it did. """
+        config = self.server.config
+        if config.throttle_qps:
+            with self.server.lock:
+                now = time.monotonic()
+                self.server.throttle_tokens = min(1.0, self.server.throttle_tokens +
+                                                  (now - self.server.throttle_time) * config.throttle_qps)
+                self.server.throttle_time = now
+                throttled = self.server.throttle_tokens < 1
+                if not throttled:
+                    self.server.throttle_tokens -= 1
+            if throttled:
+                self._send_json(429, {"error": "Too many requests"},
+                                {"Retry-After": str(math.ceil(1 / config.throttle_qps))})
+                return True
+        if random.random() < config.error_rate:
+            self._send_json(503, {"error": "Injected error"})
+            return True
+        return False
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        path, _, query_string = self.path.partition("?")
+
+        if path == "/oauth2/token":
+            self._send_json(200, {"access_token": "emulator-token", "token_type": "Bearer", "expires_in": 3600})
+        elif path not in ("/v1/create-corpus", "/upload", "/v1/query"):
+            self._send_json(404, {"error": f"Unknown endpoint {path}"})
+        elif self._reject():
+            pass
+        elif path == "/v1/create-corpus":
+            with self.server.lock:
+                corpus_id = max(self.server.corpora, default=0) + 1
+                self.server.corpora[corpus_id] = PassageIndex()
+            self._send_json(200, {"corpusId": corpus_id, "status": {"code": "OK"}})
+        elif path == "/upload":
+            self._sleep_latency()
+            params = urllib.parse.parse_qs(query_string)
+            parts = _parse_multipart(self.headers.get("Content-Type", ""), body)
+            if "file" not in parts:
+                self._send_json(400, {"error": "No file in the upload"})
+                return
+            filename, content = parts["file"]
+            metadata = json.loads(parts["doc_metadata"][1]) if "doc_metadata" in parts else {}
+            index = self._get_corpus(int(params["o"][0]))
+            index.add_document(os.path.basename(filename), _extract_text(filename, content), metadata)
+            self._send_json(200, {"response": {"status": {"code": "OK"}}, "status": {"code": "OK"}})
+        else:
+            self._sleep_latency()
+            queries = json.loads(body)["query"]
+            self._send_json(200, {"responseSet": [self._query(query) for query in queries], "status": []})
+
+    def _get_corpus(self, corpus_id: int):
+        with self.server.lock:
+            return self.server.corpora.setdefault(corpus_id, PassageIndex())
+
+    def _query(self, query: {}):
+        """ Returns the response set of a query from the corpora it searches, or (placeholder) results if they
+        have no documents. """
+        num_results = query.get("num_results", 10)
+        indexes = [self.server.corpora.get(corpus_key["corpus_id"]) for corpus_key in query.get("corpus_key", [])]
+        indexes = [index for index in indexes if index is not None and index.passages]
+        if not indexes:
+            return {
+                "response": [{"text": query["query"], "score": 1 / rank, "documentIndex": 0}
+                             for rank in range(1, num_results + 1)],
+                "status": [],
+                "document": [{"id": "0-emulator", "metadata": []}],
+            }
+        if len(indexes) == 1:
+            return indexes[0].search(query["query"], num_results)
+
+        #Merge the results of several corpora by score
+        response, documents = [], []
+        for index in indexes:
+            response_set = index.search(query["query"], num_results)
+            for this_response in response_set["response"]:
+                response.append(dict(this_response, documentIndex=this_response["documentIndex"] + len(documents)))
+            documents.extend(response_set["document"])
+        response = sorted(response, key=lambda this_response: this_response["score"], reverse=True)[:num_results]
+        return {"response": response, "status": [], "document": documents}
+
+def preload(server: http.server.HTTPServer, corpus_id: int, dirpath: str):
+    """ Indexes all the files in a directory into a corpus of the emulator, as if they had been uploaded.
+
+    Args:
+        server: The emulator server (see start_emulator())
+        corpus_id: ID of the corpus. It is created if it doesn't exist.
+        dirpath: Path to a directory containing files (and nested directories) to be indexed
+
+    Returns:
+        Number of files indexed
+    """
+    with server.lock:
+        index = server.corpora.setdefault(corpus_id, PassageIndex())
+    num_files = 0
+    for subdir, dirs, files in os.walk(dirpath):
+        for file in files:
+            filepath = os.path.join(subdir, file)
+            with open(filepath, "rb") as f:
+                index.add_document(file, _extract_text(file, f.read()), {"filepath": filepath})
+            num_files += 1
+    return num_files
+
+def _create_server(port: int, config: EmulatorConfig):
+    server = http.server.ThreadingHTTPServer(("localhost", port), EmulatorRequestHandler)
+    server.daemon_threads = True
+    server.config = config if config is not None else EmulatorConfig()
+    server.corpora = {}
+    server.lock = threading.Lock()
+    server.throttle_tokens = 1.0
+    server.throttle_time = time.monotonic()
+    return server
+
+def start_emulator(port: int = 0, config: EmulatorConfig = None):
+    """ Starts the emulator in a background thread.
+
+    Args:
+        port: Port to listen on. 0 picks a free port.
+        config: Settings of the emulator. Defaults to no latency, throttling or errors.
+
+    Returns:
+        The server. Its base URL is f"http://localhost:{server.server_port}", and it is stopped with shutdown().
+    """
+    server = _create_server(port, config)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+if __name__ == "__main__":
+    logging.basicConfig(
+        format="%(asctime)s %(levelname)-8s %(message)s", level=logging.INFO)
+
+    parser = argparse.ArgumentParser(description="Local stand-in for the Vectara API")
+    parser.add_argument("--port", type=int, default=8080, help="Port to listen on.")
+    parser.add_argument("--latency-ms", type=float, default=0, help="Time each query and upload takes to answer.")
+    parser.add_argument("--jitter-ms", type=float, default=0,
+                        help="Maximum random time added to the latency of each query and upload.")
+    parser.add_argument("--throttle-qps", type=float,
+                        help="Maximum number of API requests accepted per second. Others get a 429.")
+    parser.add_argument("--error-rate", type=float, default=0,
+                        help="Fraction of API requests that fail with a 503.")
+    parser.add_argument("--preload", action="append", default=[], metavar="CORPUS_ID=DIR",
+                        help="Index the files of a directory into a corpus at startup, e.g. 1=bundles/app-search/data. "
+                             "Can be given several times.")
+    args = parser.parse_args()
+
+    server = _create_server(args.port, EmulatorConfig(args.latency_ms, args.jitter_ms, args.throttle_qps,
+                                                      args.error_rate))
+    for corpus_and_dir in args.preload:
+        corpus_id, dirpath = corpus_and_dir.split("=", 1)
+        logging.info("Preloaded %d files from %s into corpus %s", preload(server, int(corpus_id), dirpath),
+                     dirpath, corpus_id)
+    logging.info("Vectara emulator listening on http://localhost:%d", args.port)
+    server.serve_forever()